@@ -0,0 +1,45 @@
+"""
+Compare rendering a results tree with render_tree and with the previous
+approach of building the context for every leaf with get_context_for_node.
+
+usage: python benchmarks/bench_render.py [NUM_STUDENTS ...]
+"""
+import copy
+import sys
+import time
+
+from fspathtree import fspathtree
+
+from pyassignmentgrader.utils import get_context_for_node, render_tree
+
+from synthetic import make_results
+
+
+def render_tree_per_leaf(tree):
+    for key in tree.get_all_leaf_node_paths():
+        ctx = get_context_for_node(tree[key.parts[:-1]])
+        if isinstance(tree[key], str):
+            tree[key] = tree[key].format(**ctx)
+    return tree
+
+
+def measure(func, tree):
+    tree = fspathtree(copy.deepcopy(tree))
+    start = time.perf_counter()
+    func(tree)
+    return time.perf_counter() - start, tree.tree
+
+
+def main(sizes):
+    print(f"{'students':>10} {'per leaf (s)':>14} {'top down (s)':>14} {'speedup':>8}")
+    for num_students in sizes:
+        tree = make_results(num_students).data.tree
+        old_time, old = measure(render_tree_per_leaf, tree)
+        new_time, new = measure(render_tree, tree)
+        assert old == new
+        print(f"{num_students:>10} {old_time:>14.3f} {new_time:>14.3f} {old_time/new_time:>8.1f}")
+
+
+if __name__ == "__main__":
+    sizes = [int(a) for a in sys.argv[1:]] or [10, 100]
+    sys.exit(main(sizes))
@@ -0,0 +1,42 @@
+"""
+Compare scoring a results tree with the pure-Python and NumPy CheckTable
+scoring engines.
+
+usage: python benchmarks/bench_scoring.py [NUM_STUDENTS ...]
+"""
+import sys
+import time
+
+from pyassignmentgrader.check_table import CheckTable, numpy
+
+from synthetic import make_results
+
+
+def best_of(func, repeat=3):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(sizes):
+    if numpy is None:
+        print("numpy is not installed, only the python scoring engine is available.")
+        return 1
+
+    print(f"{'students':>10} {'python (s)':>12} {'numpy (s)':>12} {'speedup':>8}")
+    for num_students in sizes:
+        table = CheckTable.compile(make_results(num_students).data)
+        assert table.score("python") == table.score("numpy")
+        python_time = best_of(lambda: table.score("python"))
+        numpy_time = best_of(lambda: table.score("numpy"))
+        print(
+            f"{num_students:>10} {python_time:>12.4f} {numpy_time:>12.4f} {python_time/numpy_time:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    sizes = [int(a) for a in sys.argv[1:]] or [1000, 10000]
+    sys.exit(main(sizes))
@@ -0,0 +1,52 @@
+"""
+Compare the peak memory and run time of summarizing a results file by
+loading it all at once and by streaming it one student at a time.
+
+usage: python benchmarks/bench_summary.py [NUM_STUDENTS ...]
+"""
+import pathlib
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from pyassignmentgrader.results import GradingResults
+
+from synthetic import make_results
+
+
+def measure(func):
+    tracemalloc.start()
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def summarize_loaded(file):
+    results = GradingResults()
+    results.load(file)
+    results.score()
+    return len(results.summary())
+
+
+def summarize_streamed(file):
+    return sum(len(lines) for w, e, lines in GradingResults.iter_summary(file))
+
+
+def main(sizes):
+    print(f"{'students':>10} {'method':>8} {'time (s)':>10} {'peak (MB)':>10}")
+    with tempfile.TemporaryDirectory() as d:
+        file = pathlib.Path(d) / "results.yml"
+        for num_students in sizes:
+            make_results(num_students).dump(file)
+            for name, func in [("load", summarize_loaded), ("stream", summarize_streamed)]:
+                elapsed, peak = measure(lambda: func(file))
+                print(f"{num_students:>10} {name:>8} {elapsed:>10.3f} {peak/1e6:>10.1f}")
+
+
+if __name__ == "__main__":
+    sizes = [int(a) for a in sys.argv[1:]] or [100, 1000]
+    sys.exit(main(sizes))
@@ -0,0 +1,52 @@
+"""
+Compare loading and dumping results files with the pure-Python and
+LibYAML (C) loaders/dumpers.
+
+usage: python benchmarks/bench_yaml.py [NUM_STUDENTS ...]
+"""
+import sys
+import time
+
+import yaml
+
+from synthetic import make_results
+
+
+def best_of(func, repeat=3):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(sizes):
+    if not yaml.__with_libyaml__:
+        print("PyYAML was built without LibYAML, only the pure-Python implementation is available.")
+        return 1
+
+    implementations = [
+        ("python", yaml.SafeLoader, yaml.SafeDumper),
+        ("libyaml", yaml.CSafeLoader, yaml.CSafeDumper),
+    ]
+
+    print(f"{'students':>10} {'size (MB)':>10} {'impl':>8} {'load (s)':>10} {'dump (s)':>10}")
+    for num_students in sizes:
+        results = make_results(num_students)
+        text = yaml.dump(results.data.tree, sort_keys=False, Dumper=yaml.CSafeDumper)
+        repeat = 3 if num_students < 10000 else 1
+        for name, loader, dumper in implementations:
+            load = best_of(lambda: yaml.load(text, Loader=loader), repeat)
+            dump = best_of(
+                lambda: yaml.dump(results.data.tree, sort_keys=False, Dumper=dumper),
+                repeat,
+            )
+            print(
+                f"{num_students:>10} {len(text)/1e6:>10.1f} {name:>8} {load:>10.3f} {dump:>10.3f}"
+            )
+
+
+if __name__ == "__main__":
+    sizes = [int(a) for a in sys.argv[1:]] or [100, 1000, 10000]
+    sys.exit(main(sizes))
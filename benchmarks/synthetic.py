@@ -0,0 +1,63 @@
+import random
+
+import fspathtree
+
+from pyassignmentgrader.results import GradingResults
+from pyassignmentgrader.rubric import GradingRubric
+
+
+def make_rubric(num_checks=20):
+    '''
+    Make a rubric with `num_checks` checks. Every fourth check has
+    secondary checks.
+    '''
+    checks = []
+    for i in range(num_checks):
+        check = {
+            "tag": f"Problem {i+1}",
+            "desc": f"Checking that problem {i+1} is correct.",
+            "weight": 1 + i % 3,
+            "handler": f"test -f problem-{i+1}.txt",
+            "working_directory": "{name}",
+        }
+        if i % 4 == 0:
+            check["secondary_checks"] = {
+                "weight": 0.5,
+                "checks": [
+                    {
+                        "tag": f"Problem {i+1}.{j+1}",
+                        "desc": f"Partial credit {j+1} for problem {i+1}.",
+                        "weight": 1,
+                        "handler": f"test -f problem-{i+1}-{j+1}.txt",
+                    }
+                    for j in range(3)
+                ],
+            }
+        checks.append(check)
+
+    rubric = GradingRubric()
+    rubric.data = fspathtree.fspathtree({"checks": checks})
+    return rubric
+
+
+def make_results(num_students, num_checks=20, seed=0):
+    '''
+    Make a graded GradingResults object for `num_students` students.
+    '''
+    rng = random.Random(seed)
+    rubric = make_rubric(num_checks)
+    results = GradingResults()
+    for i in range(num_students):
+        results.add_student(f"student{i:05}", rubric)
+
+    def grade(list_of_checks):
+        for check in list_of_checks:
+            check["result"] = rng.choice([True, True, False, 0.5])
+            check["notes"] = ["command output:", f"  {rng.random()}"]
+            if check["result"] is False and "secondary_checks" in check:
+                grade(check["secondary_checks/checks"])
+
+    for name in results.data.tree:
+        grade(results.data[f"{name}/checks"])
+
+    return results
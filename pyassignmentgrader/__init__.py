@@ -1,2 +1,5 @@
+from .journal import *
+from .result_cache import *
 from .results import *
 from .rubric import *
+from .shards import *
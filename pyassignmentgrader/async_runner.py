@@ -0,0 +1,244 @@
+import asyncio
+import subprocess
+
+from .runner import (
+    command_result,
+    get_cache_key,
+    get_check_directory,
+    get_output_log,
+    make_student_context,
+    merge_check_results,
+    resource_limit_exceeded,
+    run_deferred_checks,
+    timed_out,
+)
+from .utils import (
+    OUTPUT_LIMIT,
+    ExecutionContext,
+    OutputCapture,
+    ResourceLimitError,
+    execution_context,
+    get_resource_limits,
+    kill_process_group,
+    limit_command,
+)
+
+
+async def run_command_async(
+    cmd,
+    cwd=".",
+    limit=OUTPUT_LIMIT,
+    log_file=None,
+    timeout=None,
+    max_memory=None,
+    max_cpu_seconds=None,
+):
+    """
+    The asyncio version of utils.run_command.
+
+    The command is started with asyncio.create_subprocess_shell and its (combined
+    stdout and stderr) output is read from the event loop into an OutputCapture.
+    If it runs longer than `timeout` seconds, its process group is killed and
+    subprocess.TimeoutExpired is raised with the capture as its `output`.
+
+    Returns (return code, capture).
+    """
+    capture = OutputCapture(limit, log_file)
+    try:
+        proc = await asyncio.create_subprocess_shell(
+            limit_command(cmd, max_memory, max_cpu_seconds),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            cwd=cwd,
+            start_new_session=True,
+        )
+    except BaseException:
+        capture.close()
+        raise
+
+    async def communicate():
+        while True:
+            data = await proc.stdout.read(1 << 16)
+            if not data:
+                break
+            capture.feed(data)
+        return await proc.wait()
+
+    try:
+        returncode = await asyncio.wait_for(communicate(), timeout)
+    except asyncio.TimeoutError:
+        kill_process_group(proc.pid)
+        await proc.wait()
+        raise subprocess.TimeoutExpired(cmd, timeout, output=capture)
+    finally:
+        capture.close()
+    return returncode, capture
+
+
+async def run_shell_check_async(check, directory, ctx, output_log=None):
+    """
+    Run the shell command handler of `check` in `directory` without blocking the event loop.
+
+    Returns (ret, log) where ret has the same shape run_check returns and log
+    is the text run_check would have printed.
+    """
+    check_name = f"{ctx['student_name']}>{check['tag']}: {check['desc']}"
+    handler = check["handler"]
+    limits = get_resource_limits(check)
+    notes = []
+    log = [f"Running check for '{check_name}'", f"  Calling '{handler}' as shell command"]
+    try:
+        try:
+            returncode, output = await run_command_async(
+                handler,
+                cwd=directory,
+                limit=check.get("output_limit", ctx.get("output_limit", OUTPUT_LIMIT)),
+                log_file=output_log,
+                **limits,
+            )
+        except subprocess.TimeoutExpired as e:
+            ret = timed_out(limits, notes, e.output.text())
+        else:
+            ret = command_result(handler, limits, notes, returncode, output)
+    except Exception as e:
+        log.append(f"Unrecognized handler '{handler}'.")
+        log.append(
+            "Expecting 'manual', a Python function (i.e. 'hw_01:P1'), or a shell command"
+        )
+        log.append("Tried to run handler as a shell command but raised an exception")
+        log.append(f"Exception: {e}")
+        ret = {"result": None, "notes": notes}
+    return ret, "\n".join(log) + "\n"
+
+
+async def run_python_check_async(check, directory, ctx, pool, force=False):
+    """
+    Run the Python function handler of `check` on `pool` (a HandlerWorkerPool)
+    from a thread, so that the event loop is not blocked while it runs.
+
+    Returns (ret, log) like run_shell_check_async.
+    """
+    check_name = f"{ctx['student_name']}>{check['tag']}: {check['desc']}"
+    handler = check["handler"]
+    if "{name}" in handler:
+        handler = handler.format(name=ctx["student_name"])
+    limits = get_resource_limits(check)
+    notes = []
+    log = [f"Running check for '{check_name}'", f"  Calling '{handler}' as Python function"]
+    ctx = dict(ctx)
+    ctx["working_directory"] = ExecutionContext(directory)
+    namespace = {"check": check.tree, "ctx": ctx, "force": force, "notes": notes}
+    try:
+        ret = await asyncio.to_thread(
+            pool.call, handler, namespace, directory, limits["timeout"]
+        )
+    except subprocess.TimeoutExpired:
+        ret = timed_out(limits, notes)
+    except (ResourceLimitError, MemoryError) as e:
+        ret = resource_limit_exceeded(limits, notes, str(e))
+    except Exception as e:
+        log.append(
+            f"There was an error trying to evaluate function call referenced by '{handler}'"
+        )
+        log.append(f"Error Message: {e}")
+        ret = {"result": None, "notes": notes}
+    return ret, "\n".join(log) + "\n"
+
+
+async def run_checks_async(
+    results,
+    students,
+    tag,
+    workspace_directory,
+    force=False,
+    max_procs=8,
+    results_file=None,
+    output_limit=OUTPUT_LIMIT,
+    pool=None,
+):
+    """
+    Run the shell command checks for each student in `students` concurrently on
+    an asyncio event loop, with at most `max_procs` commands running at a time.
+
+    If `pool` (a HandlerWorkerPool) is given, Python function handlers are run
+    on its worker processes concurrently with the shell commands, as many at a
+    time as it has workers. Python function handlers with memory or CPU limits
+    are not sent to the pool.
+
+    Secondary checks are started as soon as the check they belong to fails.
+    Results are merged back into `results` in the order the checks appear in
+    the results tree. Manual checks, and Python function handlers that are not
+    run on the pool, are run serially after everything else has finished.
+    """
+    semaphore = asyncio.Semaphore(max_procs)
+    pool_semaphore = asyncio.Semaphore(pool.workers) if pool is not None else None
+    cache = results.result_cache
+    # each entry is (key,check,directory,ctx). the key is a tuple of indices
+    # that sorts entries into the same order as a serial run would visit them.
+    skipped = []
+    deferred = []
+    finished = []
+
+    def runs_on_pool(check):
+        limits = get_resource_limits(check)
+        return pool is not None and limits["max_memory"] is None and limits["max_cpu_seconds"] is None
+
+    async def run_list(list_of_checks, key, ctx, force):
+        await asyncio.gather(
+            *(
+                run_one(list_of_checks[i], key + (i,), ctx, force)
+                for i in range(len(list_of_checks))
+            )
+        )
+
+    async def run_one(check, key, ctx, force):
+        if tag is not None and check.get("tag", "NO-TAG") != tag:
+            return
+        check_dir = get_check_directory(check, ctx, results)
+        entry = (key, check, check_dir, ctx)
+        handler = check.get("handler", "manual")
+        if not force and check["result"] is not None:
+            skipped.append(entry)
+            ret = {"result": check["result"]}
+        elif handler == "manual" or (":" in handler and not runs_on_pool(check)):
+            deferred.append(entry)
+            return
+        else:
+            with execution_context(check_dir):
+                cache_key = get_cache_key(check, ctx, cache)
+            ret = cache.get(cache_key) if cache is not None else None
+            if ret is not None:
+                check_name = f"{ctx['student_name']}>{check['tag']}: {check['desc']}"
+                log = f"CACHED - inputs for {check_name} have not changed since it was last ran.\n"
+            else:
+                if ":" in handler:
+                    async with pool_semaphore:
+                        ret, log = await run_python_check_async(
+                            check, check_dir, ctx, pool, force
+                        )
+                else:
+                    async with semaphore:
+                        ret, log = await run_shell_check_async(
+                            check, check_dir, ctx, get_output_log(check, ctx)
+                        )
+                if cache is not None:
+                    cache.put(cache_key, ret)
+            finished.append((entry, ret, log))
+
+        # secondary checks depend on the result of their primary check,
+        # so they can only be started once it has finished.
+        if ret["result"] is False and "secondary_checks" in check:
+            await run_list(check["secondary_checks/checks"], key, ctx, False)
+
+    tasks = []
+    for s, student_name in enumerate(students):
+        ctx = make_student_context(
+            results, student_name, workspace_directory, output_limit, results_file
+        )
+        tasks.append(run_list(results.data[student_name]["checks"], (s,), ctx, force))
+    await asyncio.gather(*tasks)
+
+    merge_check_results(results, skipped, finished, results_file)
+    run_deferred_checks(
+        results, deferred, tag, results_file, "Python function and manual"
+    )
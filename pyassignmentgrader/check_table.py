@@ -0,0 +1,486 @@
+import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class CheckTable:
+    '''
+    A flat, column oriented table of every check in a results tree.
+
+    Each row is a check. Rows are stored in the order they appear in the
+    results file, with secondary checks following the check they belong to.
+    Numeric data are kept in typed arrays so that scoring and summarizing are
+    simple passes over the columns instead of repeated path lookups into the
+    fspathtree.
+
+    Checks are also grouped. Each student's list of checks is a group and
+    each list of secondary checks is a group. Groups are stored after all of
+    their secondary check groups, so a single pass over the groups can score
+    every check.
+    '''
+
+    # values of the `kind` column
+    NO_RESULT = 0
+    PASS_FAIL = 1
+    NUMERIC = 2
+    MISSING = 3
+    UNKNOWN = 4
+
+    # values of the `secondary_error` column
+    NO_SECONDARY_CHECKS = 1
+    NO_SECONDARY_WEIGHT = 2
+
+    def __init__(self):
+        self.students = []
+        # row columns
+        self.paths = []
+        self.tags = []
+        self.descs = []
+        self.notes = []
+        self.student = array.array("l")
+        self.parent = array.array("l")
+        self.depth = array.array("l")
+        self.weight = array.array("d")
+        # the tree stores ints and floats, we keep track of which values were
+        # ints so that scores are written back with the same types as before.
+        self.weight_is_int = array.array("b")
+        self.result_is_int = array.array("b")
+        self.kind = array.array("b")
+        self.result = array.array("d")
+        self.secondary_group = array.array("l")
+        self.secondary_weight = array.array("d")
+        self.secondary_weight_is_int = array.array("b")
+        self.secondary_error = array.array("b")
+        self.unknown_result_types = {}
+        # the rows for student s are student_start[s]:student_start[s+1]
+        self.student_start = array.array("l", [0])
+        # group columns. the rows in group g are group_rows[group_start[g]:group_start[g+1]]
+        self.group_start = array.array("l", [0])
+        self.group_rows = array.array("l")
+        self.group_parent = array.array("l")
+        self.group_student = array.array("l")
+        # the group holding each student's top level checks
+        self.student_group = array.array("l")
+        # the row for each check path
+        self.rows = {}
+
+    def __len__(self):
+        return len(self.paths)
+
+    @classmethod
+    def compile(cls, data, students=None):
+        '''
+        Build a table from a results tree (an fspathtree with one key per student).
+
+        If `students` is given, only those students are added to the table.
+        '''
+        table = cls()
+        for name in data.tree if students is None else students:
+            table.students.append(name)
+            checks = data[f"{name}/checks"].tree
+            group = table._add_checks(
+                len(table.students) - 1, checks, f"/{name}/checks", -1, 0
+            )
+            table.student_group.append(group)
+            table.student_start.append(len(table))
+        return table
+
+    def _add_checks(self, student, list_of_checks, path, parent, depth):
+        rows = []
+        for i, check in enumerate(list_of_checks):
+            row = len(self.paths)
+            rows.append(row)
+            self.paths.append(f"{path}/{i}")
+            self.rows[self.paths[row]] = row
+            self.tags.append(check.get("tag", "Check"))
+            self.descs.append(check.get("desc", ""))
+            self.notes.append(check.get("notes", None))
+            self.student.append(student)
+            self.parent.append(parent)
+            self.depth.append(depth)
+            weight = check.get("weight", 1)
+            self.weight.append(weight)
+            self.weight_is_int.append(isinstance(weight, int))
+            self.kind.append(self.NO_RESULT)
+            self.result.append(0)
+            self.result_is_int.append(0)
+            if "result" in check:
+                self.set_result(row, check["result"])
+            else:
+                self.kind[row] = self.MISSING
+
+            self.secondary_group.append(-1)
+            self.secondary_weight.append(0)
+            self.secondary_weight_is_int.append(0)
+            self.secondary_error.append(0)
+            if "secondary_checks" in check:
+                secondary_checks = check["secondary_checks"]
+                if "checks" not in secondary_checks:
+                    self.secondary_error[row] = self.NO_SECONDARY_CHECKS
+                elif "weight" not in secondary_checks:
+                    self.secondary_error[row] = self.NO_SECONDARY_WEIGHT
+                else:
+                    self.secondary_weight[row] = secondary_checks["weight"]
+                    self.secondary_weight_is_int[row] = isinstance(
+                        secondary_checks["weight"], int
+                    )
+                    self.secondary_group[row] = self._add_checks(
+                        student,
+                        secondary_checks["checks"],
+                        f"{path}/{i}/secondary_checks/checks",
+                        row,
+                        depth + 1,
+                    )
+
+        # the group is added after all of its secondary check groups.
+        self.group_rows.extend(rows)
+        self.group_start.append(len(self.group_rows))
+        self.group_parent.append(parent)
+        self.group_student.append(student)
+        return len(self.group_parent) - 1
+
+    def set_result(self, row, result):
+        '''
+        Update the result stored for a row.
+        '''
+        if result is None:
+            self.kind[row] = self.NO_RESULT
+            self.result[row] = 0
+        elif result is True or result is False:
+            self.kind[row] = self.PASS_FAIL
+            self.result[row] = 1 if result else 0
+        elif isinstance(result, (int, float)):
+            self.kind[row] = self.NUMERIC
+            self.result[row] = result
+            self.result_is_int[row] = isinstance(result, int)
+        else:
+            self.kind[row] = self.UNKNOWN
+            self.result[row] = 0
+            self.unknown_result_types[row] = type(result)
+
+    @staticmethod
+    def number(value, is_int):
+        return int(value) if is_int else value
+
+    def failed(self, row):
+        '''
+        Return True if the check in row failed (i.e. its secondary checks should be used).
+        '''
+        return self.kind[row] == self.PASS_FAIL and self.result[row] == 0
+
+    def get_result(self, row):
+        '''
+        Return the result for a row as it would be stored in the results tree.
+        '''
+        if self.kind[row] == self.PASS_FAIL:
+            return self.result[row] == 1
+        if self.kind[row] == self.NUMERIC:
+            return self.number(self.result[row], self.result_is_int[row])
+        return None
+
+    def update_check(self, row, check):
+        '''
+        Update a row with the result and notes of a check that has changed.
+        '''
+        self.notes[row] = check.get("notes", None)
+        if "result" in check:
+            self.set_result(row, check["result"])
+        else:
+            self.kind[row] = self.MISSING
+
+    def student_rows(self, student):
+        return range(self.student_start[student], self.student_start[student + 1])
+
+    def student_groups(self, student):
+        first = self.student_group[student - 1] + 1 if student > 0 else 0
+        return range(first, self.student_group[student] + 1)
+
+    def used_rows(self, rows=None):
+        '''
+        Return the set of rows that count towards a score. Top level checks
+        always count, secondary checks only count if the check they belong
+        to failed.
+
+        `rows` is the rows to look at (all of them by default), the parent of
+        a row must come before it.
+        '''
+        used = set()
+        for row in range(len(self)) if rows is None else rows:
+            parent = self.parent[row]
+            if parent < 0 or (parent in used and self.failed(parent)):
+                used.add(row)
+        return used
+
+    def score(self, engine="python", students=None):
+        '''
+        Score every student.
+
+        Returns a tuple (available, awarded, warnings, errors) where available
+        and awarded are lists with an entry for each student.
+
+        `engine` is "python" or "numpy". The NumPy engine scores all students
+        in one batch and gives the same results, it is faster for large
+        classes but requires numpy to be installed.
+
+        If `students` (a list of student indices) is given, only those students
+        are scored and available and awarded have an entry for each of them.
+        The python engine is always used to score a subset of the students.
+        '''
+        if engine not in ("python", "numpy"):
+            raise ValueError(f"Unknown scoring engine '{engine}'. Expected 'python' or 'numpy'.")
+        if students is None:
+            if engine == "numpy":
+                return self.score_numpy()
+            students = range(len(self.students))
+
+        rows = [row for s in students for row in self.student_rows(s)]
+        groups = [group for s in students for group in self.student_groups(s)]
+        warnings = []
+        errors = []
+        used = self.used_rows(rows)
+
+        # check for problems in the order they appear in the results file.
+        for row in rows:
+            if row not in used:
+                continue
+            kind = self.kind[row]
+            if kind == self.MISSING:
+                raise RuntimeError(
+                    f"Check at {self.paths[row]} does not contain a result."
+                )
+            if kind == self.UNKNOWN:
+                raise RuntimeError(
+                    f"Unexpected result type {self.unknown_result_types[row]}. Expected a bool, float, or None."
+                )
+            if kind == self.NO_RESULT:
+                user = self.students[self.student[row]]
+                msg = f"WARNING: {user} has a check that has not been completed."
+                msg += f"\n"
+                msg += f"         desc: {self.descs[row]}"
+                msg += f"\n"
+                msg += f"         I am skipping the check which means that the computed score MAY BE TOO LOW."
+                warnings.append(msg)
+            if self.failed(row):
+                self.check_secondary_checks(row)
+
+        group_total = {}
+        group_awarded = {}
+        for group in groups:
+            rows = self.group_rows[self.group_start[group] : self.group_start[group + 1]]
+            if len(rows) == 0 or rows[0] not in used:
+                group_total[group] = 0
+                group_awarded[group] = 0
+                continue
+            total = 0
+            awarded = 0
+            total_is_int = True
+            awarded_is_int = True
+            for row in rows:
+                weight = self.weight[row]
+                total += weight
+                total_is_int = total_is_int and self.weight_is_int[row]
+                kind = self.kind[row]
+                if kind == self.PASS_FAIL:
+                    if self.result[row] == 1:
+                        awarded += weight
+                        awarded_is_int = awarded_is_int and self.weight_is_int[row]
+                    elif self.secondary_group[row] >= 0:
+                        g = self.secondary_group[row]
+                        awarded += (
+                            weight
+                            * self.secondary_weight[row]
+                            * group_awarded[g]
+                            / group_total[g]
+                        )
+                        awarded_is_int = False
+                elif kind == self.NUMERIC:
+                    awarded += weight * self.result[row]
+                    awarded_is_int = (
+                        awarded_is_int
+                        and self.weight_is_int[row]
+                        and self.result_is_int[row]
+                    )
+            group_total[group] = self.number(total, total_is_int)
+            group_awarded[group] = self.number(awarded, awarded_is_int)
+
+        available = [group_total[self.student_group[s]] for s in students]
+        awarded = [group_awarded[self.student_group[s]] for s in students]
+        return available, awarded, warnings, errors
+
+    def score_numpy(self):
+        '''
+        Score every student with NumPy. See score().
+
+        The columns are turned into arrays and each level of secondary checks is
+        reduced into its groups at once, starting with the deepest level.
+        '''
+        if numpy is None:
+            raise RuntimeError("The numpy scoring engine requires numpy to be installed.")
+        np = numpy
+
+        num_rows = len(self)
+        num_groups = len(self.group_parent)
+        parent = np.asarray(self.parent, dtype=np.int_)
+        depth = np.asarray(self.depth, dtype=np.int_)
+        kind = np.asarray(self.kind, dtype=np.int8)
+        result = np.asarray(self.result, dtype=np.float64)
+        weight = np.asarray(self.weight, dtype=np.float64)
+        weight_is_int = np.asarray(self.weight_is_int, dtype=bool)
+        result_is_int = np.asarray(self.result_is_int, dtype=bool)
+        secondary_group = np.asarray(self.secondary_group, dtype=np.int_)
+        secondary_weight = np.asarray(self.secondary_weight, dtype=np.float64)
+        secondary_error = np.asarray(self.secondary_error, dtype=np.int8)
+        group_start = np.asarray(self.group_start, dtype=np.int_)
+        group_rows = np.asarray(self.group_rows, dtype=np.int_)
+
+        passed = (kind == self.PASS_FAIL) & (result == 1)
+        failed = (kind == self.PASS_FAIL) & (result == 0)
+
+        # a row is used if it is a top level check, or its parent is used and failed.
+        # parents are always one level up, so this can be done a level at a time.
+        used = parent < 0
+        max_depth = int(depth.max()) if num_rows else -1
+        for d in range(1, max_depth + 1):
+            rows = np.flatnonzero(depth == d)
+            used[rows] = used[parent[rows]] & failed[parent[rows]]
+
+        # check for problems in the order they appear in the results file.
+        problems = used & (
+            (kind == self.MISSING)
+            | (kind == self.UNKNOWN)
+            | (failed & (secondary_error != 0))
+        )
+        if problems.any():
+            row = int(np.argmax(problems))
+            if kind[row] == self.MISSING:
+                raise RuntimeError(
+                    f"Check at {self.paths[row]} does not contain a result."
+                )
+            if kind[row] == self.UNKNOWN:
+                raise RuntimeError(
+                    f"Unexpected result type {self.unknown_result_types[row]}. Expected a bool, float, or None."
+                )
+            self.check_secondary_checks(row)
+
+        warnings = []
+        for row in np.flatnonzero(used & (kind == self.NO_RESULT)):
+            user = self.students[self.student[row]]
+            msg = f"WARNING: {user} has a check that has not been completed."
+            msg += f"\n"
+            msg += f"         desc: {self.descs[row]}"
+            msg += f"\n"
+            msg += f"         I am skipping the check which means that the computed score MAY BE TOO LOW."
+            warnings.append(msg)
+        errors = []
+
+        # the group each row belongs to
+        row_group = np.empty(num_rows, dtype=np.int_)
+        row_group[group_rows] = np.repeat(np.arange(num_groups), np.diff(group_start))
+
+        # rows that make a group's total or awarded points a float
+        total_not_int = np.bincount(row_group, weights=~weight_is_int, minlength=num_groups) > 0
+        numeric = kind == self.NUMERIC
+        uses_secondary = used & failed & (secondary_group >= 0)
+        awarded_not_int = (
+            (passed & ~weight_is_int)
+            | (failed & (secondary_group >= 0))
+            | (numeric & ~(weight_is_int & result_is_int))
+        )
+
+        # the rows of each group are summed in order, like the python engine does.
+        group_total = np.bincount(row_group, weights=weight, minlength=num_groups)
+        group_awarded = np.zeros(num_groups)
+        awarded = np.where(passed, weight, 0.0) + np.where(numeric, weight * result, 0.0)
+        for d in range(max_depth, -1, -1):
+            rows = np.flatnonzero(depth == d)
+            secondary = rows[uses_secondary[rows]]
+            if len(secondary):
+                g = secondary_group[secondary]
+                if (group_total[g] == 0).any():
+                    raise ZeroDivisionError("float division by zero")
+                awarded[secondary] = (
+                    weight[secondary]
+                    * secondary_weight[secondary]
+                    * group_awarded[g]
+                    / group_total[g]
+                )
+            group_awarded += np.bincount(
+                row_group[rows], weights=awarded[rows], minlength=num_groups
+            )
+        awarded_not_int = np.bincount(row_group, weights=awarded_not_int, minlength=num_groups) > 0
+
+        available = [
+            self.number(float(group_total[g]), not total_not_int[g])
+            for g in self.student_group
+        ]
+        awarded = [
+            self.number(float(group_awarded[g]), not awarded_not_int[g])
+            for g in self.student_group
+        ]
+        return available, awarded, warnings, errors
+
+    def check_secondary_checks(self, row):
+        '''
+        Raise an error if the row has a secondary_checks key with missing checks or weight.
+        '''
+        if self.secondary_error[row] == self.NO_SECONDARY_CHECKS:
+            raise RuntimeError(
+                f"Check at {self.paths[row]} contains a secondary_check key, but there are no checks underneath it."
+            )
+        if self.secondary_error[row] == self.NO_SECONDARY_WEIGHT:
+            raise RuntimeError(
+                f"Check at {self.paths[row]} contains a secondary_check key, but there is no weight underneath it."
+            )
+
+    def summary(self, student, prefix=""):
+        '''
+        Return the lines of the grading report for the checks of `student` (an index).
+        '''
+        lines = []
+
+        def add_line(text):
+            lines.append(f"{prefix}{text}")
+
+        # rows whose secondary checks are listed in the report
+        expanded = set()
+        for row in range(self.student_start[student], self.student_start[student + 1]):
+            parent = self.parent[row]
+            if parent >= 0 and parent not in expanded:
+                continue
+            if self.kind[row] == self.MISSING:
+                raise RuntimeError(f"Check at {self.paths[row]} does not contain a result.")
+
+            indent = "    " * self.depth[row]
+            add_line(f"{indent}{self.tags[row]}: {self.descs[row]}")
+            add_line(f"{indent}  weight: {self.number(self.weight[row], self.weight_is_int[row])}")
+
+            if self.kind[row] == self.NO_RESULT:
+                add_line(f"{indent}  result: Not Ran")
+            elif self.kind[row] == self.PASS_FAIL and self.result[row] == 1:
+                add_line(f"{indent}  result: PASS")
+            else:
+                add_line(f"{indent}  result: FAIL")
+
+            if self.notes[row] is not None:
+                add_line(f"{indent}  notes:")
+                for n in self.notes[row]:
+                    add_line(f"{indent}      {n}")
+
+            # numeric results of 0 are reported as failures too
+            has_secondary_checks = self.secondary_group[row] >= 0 or self.secondary_error[row]
+            if (
+                has_secondary_checks
+                and self.kind[row] in (self.PASS_FAIL, self.NUMERIC)
+                and self.result[row] == 0
+            ):
+                self.check_secondary_checks(row)
+                add_line(f"{indent}  Secondary Checks:")
+                add_line(
+                    f"{indent}    weight: {self.number(self.secondary_weight[row], self.secondary_weight_is_int[row])}"
+                )
+                expanded.add(row)
+
+        return lines
@@ -1,7 +1,6 @@
-import inspect
+import asyncio
 import sys
 from pathlib import Path
-from subprocess import PIPE, STDOUT, run
 
 import typer
 import yaml
@@ -10,40 +9,15 @@ from rich import print
 
 from pyassignmentgrader import *
 
+from .async_runner import run_checks_async
+from .preprocessing import print_preprocessing_summary, run_preprocessing
+from .runner import *
 from .ui import console as console_view
 from .utils import *
 
 app = typer.Typer()
 
 
-def make_import_statement(func_spec: str):
-    module_name, function_call = func_spec.split(":")
-    function_toks = function_call.split("(")
-    function_name = function_toks[0]
-    import_statement = f"from {module_name} import {function_name}"
-    import_statement = f"""
-try:
-    {import_statement}
-except Exception as e:
-    print("[red]There was a problem trying to import {function_name} from {module_name}.[/red]")
-    print(f"[red]Error Message: {{e}}[/red]")
-"""
-    return import_statement
-
-
-def make_function_call(func_spec: str):
-    module_name, function_call = func_spec.split(":")
-    function_toks = function_call.split("(")
-    function_name = function_toks[0]
-    if len(function_toks) > 1:
-        function_args = "(" + function_toks[1]
-    else:
-        exec(make_import_statement(func_spec))
-        function_args = str(eval(f"inspect.signature({function_name})"))
-
-    return function_name + function_args
-
-
 @app.command()
 def setup_grading_files(
     config_file: Path,
@@ -55,6 +29,12 @@ def setup_grading_files(
         "-u",
         help="Update the results file with missing checks. i.e. if the rubric has been updated since the results file was created.",
     ),
+    jobs: int = typer.Option(
+        None,
+        "--jobs",
+        "-j",
+        help="Number of per-student preprocessing commands to run at the same time. Defaults to the `preprocessing_workers` config setting, or 1.",
+    ),
 ):
     """
     Setup the grading session described by CONFIG_FILE.
@@ -71,12 +51,16 @@ def setup_grading_files(
     prepressing:
         - mkdir HW-01-grading
         - tar HW-01-submissions.tar.bz2
+
+    Preprocessing commands containing `{name}` are run once for each student.
+    Consecutive per-student steps run concurrently across students, while any
+    other step waits for every step before it to finish.
     """
     if not config_file.exists():
         print(f"[bold red]Config file '{config_file}' does not exist.[/bold red]")
         raise typer.Exit(code=1)
 
-    config = fspathtree(yaml.safe_load(config_file.read_text()))
+    config = fspathtree(load_yaml(config_file.read_text()))
     results_file = Path(config["results"])
     rubric_file = Path(config["rubric"])
 
@@ -109,58 +93,18 @@ def setup_grading_files(
         for student in config["students"]:
             results.update_student(student["name"], rubric)
 
+    if config.get("results_layout", "single") == "sharded":
+        results.use_shards(results_file)
+
     render_tree(results.data)
     results.dump(results_file)
 
     sys.path.append(str(config_file.absolute().parent))
-    for preproc in config.get("preprocessing", []):
-        conf = {"type": None, "cmd": "", "working_directory": Path().absolute()}
-
-        if type(preproc) is str and ":" in preproc:
-            conf["type"] = "python"
-            conf["cmd"] = preproc
-
-        if type(preproc) is str and ":" not in preproc:
-            conf["type"] = "shell"
-            conf["cmd"] = preproc
-
-        if type(preproc) is fspathtree:
-            conf = preproc.tree
-            if "type" not in conf:
-                if ":" in conf["cmd"]:
-                    conf["type"] = "python"
-                else:
-                    conf["type"] = "shell"
-
-        # expand to multiple commands if needed
-        if "{name}" in conf["cmd"]:
-            confs = []
-            for student in config["students"]:
-                confs.append(copy.deepcopy(conf))
-                confs[-1]["cmd"] = confs[-1]["cmd"].format(name=student["name"])
-        else:
-            confs = [conf]
-
-        for conf in confs:
-            if conf["type"] == "python":
-                exec(make_import_statement(conf["cmd"]))
-                wd = Path(conf.get("working_directory", ".")).absolute()
-                with working_dir(wd):
-                    try:
-                        eval(make_function_call(conf["cmd"]))
-                    except Exception as e:
-                        print(
-                            f"[red]There was an error trying to evaluate function call referenced by '{conf['cmd']}'[/red]"
-                        )
-                        print(f"[red]Error Message: {e}[/red]")
-
-            if conf["type"] == "shell":
-                print(f"[green]cmd[/green]: {conf['cmd']}")
-                ret = run(conf["cmd"], shell=True, cwd=conf["working_directory"])
-                if ret.returncode != 0:
-                    print(
-                        f"[yellow]Preprocessing command `{conf['cmd']}` returned non-zero exist status.[/yellow]"
-                    )
+    if len(config.get("preprocessing", [])) > 0:
+        steps = run_preprocessing(
+            config, jobs if jobs is not None else config.get("preprocessing_workers", 1)
+        )
+        print_preprocessing_summary(steps)
 
 
 @app.command()
@@ -183,10 +127,12 @@ def write_example_config_file(
     data["rubric_file"] = "HW-01-rubic.yml"
     data["results_file"] = "HW-01-result.yml"
     data["preprocessing/0"] = "mkdir HW-01-grading"
-    data["preprocessing/1/cmd"] = "tar -xjf ../gradebook*tar.bz2"
+    data["preprocessing/1/type"] = "extract"
+    data["preprocessing/1/archive"] = "../gradebook*tar.bz2"
     data["preprocessing/1/working_directory"] = "HW-01-grading"
+    data["preprocessing/1/max_member_size"] = "50M"
 
-    config_file.write_text(yaml.safe_dump(data.tree))
+    config_file.write_text(dump_yaml(data.tree))
 
 
 @app.command()
@@ -220,7 +166,7 @@ def write_example_rubric_file(
     data["checks/2/handler"] = "HW_01_checks:Problem3"
     data["checks/2/working_directory"] = "."
 
-    rubric_file.write_text(yaml.safe_dump(data.tree))
+    rubric_file.write_text(dump_yaml(data.tree))
 
 
 @app.command()
@@ -239,6 +185,27 @@ def run_checks(
     ui: str = typer.Option(
         "tui", "--user-interface", "-u", help="Select user interface to use."
     ),
+    jobs: int = typer.Option(
+        1,
+        "--jobs",
+        "-j",
+        help="Number of worker processes to run automated checks on (cli interface only). Manual checks are run after all automated checks have finished.",
+    ),
+    prefetch: int = typer.Option(
+        2,
+        "--prefetch",
+        help="Number of upcoming checks to run handlers for in the background (tui interface only).",
+    ),
+    use_async: bool = typer.Option(
+        False,
+        "--async",
+        help="Run shell command checks concurrently on an asyncio event loop (cli interface only). Python function checks are run concurrently too if `handler_workers` is set. Other checks are run after everything else has finished.",
+    ),
+    max_procs: int = typer.Option(
+        8,
+        "--max-procs",
+        help="Maximum number of shell commands to run at the same time with --async.",
+    ),
 ):
     """
     Run checks in a grading results file that have not been run yet.
@@ -248,7 +215,7 @@ def run_checks(
         print(f"[bold red]Config file '{config_file}' does not exist.[/bold red]")
         raise typer.Exit(code=1)
 
-    config = fspathtree(yaml.safe_load(config_file.read_text()))
+    config = fspathtree(load_yaml(config_file.read_text()))
     results_file = Path(config["results"])
 
     if not results_file.exists():
@@ -256,56 +223,107 @@ def run_checks(
         raise typer.Exit(1)
     results = GradingResults()
     results.load(results_file)
+    if config.get("results_journal", False):
+        results.open_journal(
+            results_file, config.get("results_journal_compact_every", 500)
+        )
+    if config.get("result_cache", False):
+        results.open_result_cache(results_file)
 
     sys.path.append(str(results_file.absolute().parent))
+    clear_handler_cache()
 
     workspace_directory = assignment_directory / config.get("workspace_directory", ".")
+    # with a sharded results file, only the shards for these students are loaded.
+    students = [s for s in results.student_names() if not student or s == student]
 
     if ui == "cli":
         try:
-            # with working_dir(workspace_directory):
-            for student_name in results.data.tree:
-                if student and student_name != student:
-                    continue
-
-                print()
-                print()
-                print(f"Grading assignment for {student_name}")
-
-                wd = Path(
-                    results.data.get(f"{student_name}/working_directory", ".")
-                ).absolute()
-                with working_dir(wd) as student_dir:
-                    ctx = fspathtree()
-                    ctx["student_name"] = student_name
-                    ctx["student_dir"] = student_dir
-                    ctx["list_of_checks"] = results.data[student_name]["checks"]
-                    ctx["workspace_directory"] = config_file.parent / config.get(
-                        "workspace_directory", "grading_workspace"
-                    )
-                    run_list_of_checks(
-                        results.data[student_name]["checks"], tag, ctx, force
+            if use_async:
+                with handler_pool(make_handler_pool(config, results, students)) as pool:
+                    asyncio.run(
+                        run_checks_async(
+                            results,
+                            students,
+                            tag,
+                            config_file.parent
+                            / config.get("workspace_directory", "grading_workspace"),
+                            force,
+                            max_procs,
+                            results_file,
+                            config.get("output_limit", OUTPUT_LIMIT),
+                            pool,
+                        )
                     )
+            elif jobs > 1:
+                run_checks_in_parallel(
+                    results,
+                    students,
+                    tag,
+                    config_file.parent
+                    / config.get("workspace_directory", "grading_workspace"),
+                    force,
+                    jobs,
+                    results_file,
+                    config.get("output_limit", OUTPUT_LIMIT),
+                )
+            else:
+                # with working_dir(workspace_directory):
+                # the serial runner calls one handler at a time, so it only needs one worker.
+                with handler_pool(make_handler_pool(config, results, students, 1)):
+                    for student_name in students:
+                        print()
+                        print()
+                        print(f"Grading assignment for {student_name}")
+
+                        with execution_context(
+                            results.get_working_directory(f"/{student_name}", start="/")
+                            or "."
+                        ) as student_dir:
+                            ctx = fspathtree()
+                            ctx["student_name"] = student_name
+                            ctx["student_dir"] = student_dir.path
+                            ctx["list_of_checks"] = results.data[student_name]["checks"]
+                            ctx["workspace_directory"] = config_file.parent / config.get(
+                                "workspace_directory", "grading_workspace"
+                            )
+                            ctx["output_limit"] = config.get("output_limit", OUTPUT_LIMIT)
+                            ctx["artifacts_directory"] = get_artifacts_directory(results_file)
+                            run_list_of_checks(
+                                results.data[student_name]["checks"],
+                                tag,
+                                ctx,
+                                force,
+                                results,
+                            )
+                        results.checkpoint(results_file)
 
         except Exception as e:
             print("[red]An exception was thrown while trying to run checks.[/red]")
             print(f"[red]Error Message: {e}[/red]")
         finally:
-            results.dump(results_file.open("w"))
+            results.save(results_file)
 
     elif ui == "tui":
-        current_directory = pathlib.Path().absolute()
+        controller = None
         try:
             check_paths = list(
                 sorted(
-                    map(
-                        lambda p: results.data[p / ".."].path(),
-                        results.data.find("/*/checks/*/result"),
+                    (
+                        results.data[student_name][p / ".."].path()
+                        for student_name in students
+                        for p in results.data[student_name].find("checks/*/result")
                     ),
                     key=lambda p: int(p.parts[3]),
                 )
             )
-            controller = console_view.GradingItemController(results, check_paths)
+            controller = console_view.GradingItemController(
+                results,
+                check_paths,
+                results_file,
+                prefetch=prefetch,
+                output_limit=config.get("output_limit", OUTPUT_LIMIT),
+            )
             view = controller.view
 
             loop = console_view.urwid.MainLoop(
@@ -314,10 +332,13 @@ def run_checks(
                 input_filter=view.input_filter,
                 unhandled_input=view.input_handler,
             )
+            controller.attach(loop)
             loop.run()
         finally:
-            os.chdir(current_directory)
-            results.dump(results_file)
+            # stop the handlers still running in the background so that we can exit.
+            if controller is not None:
+                controller.detach()
+            results.save(results_file)
 
     else:
         print(f"[red]Unrecognized user interface '{ui}'[/red]")
@@ -325,104 +346,30 @@ def run_checks(
         raise typer.Exit(1)
 
 
-def run_list_of_checks(list_of_checks, tag, ctx, force=False):
-    for check in list_of_checks:
-        if tag is not None and check.get("tag", "NO-TAG") != tag:
-            continue
-        wd = Path(check.get("working_directory", ".")).absolute()
-        with working_dir(wd) as check_dir:
-            print()
-            ret = run_check(check, ctx, force)
-            check["result"] = ret["result"]
-            check["notes"] = ret["notes"]
-            # check["notes"].tree.clear()
-            # for note in ret["notes"]:
-            #     check["notes"].tree.append(note)
-
-            if ret["result"] is True:
-                print("  [green]PASS[/green]")
-            if ret["result"] is False:
-                print("  [red]FAIL[/red]")
-            if ret["result"] is None:
-                print("  [yellow]NO RESULT[/yellow]")
-            print("  NOTES:")
-            for n in ret["notes"]:
-                print("    ", n)
-
-            if check["result"] is False and "secondary_checks" in check:
-                wwd = Path(
-                    check.get("secondary_checks/working_directory", ".")
-                ).absolute()
-                with working_dir(wwd) as secondary_checks_dir:
-                    run_list_of_checks(check["secondary_checks/checks"], tag, ctx)
-
-
-def run_check(check, ctx, force=False):
-    check_name = f"{ctx['student_name']}>{check['tag']}: {check['desc']}"
-    notes = []
-    if not force and check["result"] is not None:
-        print(f"[green]SKIPPING[/green] - {check_name} has already been ran.")
-        return {"result": check["result"], "notes": notes}
-
-    handler = check.get("handler", "manual")
-    print(f"Running check for '{check_name}'")
-    if handler == "manual":
-        # run and return result of manual check
-        print("Manual Check")
-        response = ""
-        while response.lower() not in ["y", "n", "yes", "no", "s", "skip"]:
-            if len(response) > 0:
-                print(f"Unrecognized response [yellow]{response}[/yellow]")
-            response = input("Did this check pass? [y/n] ")
-        if response.lower().startswith("s"):
-            return {"result": None, "notes": notes}
-
-        result = response.lower().startswith("y")
-
-        if response[0].islower():
-            response = input("Add note (enter 'EOF' to stop): ")
-            while response.lower() != "eof":
-                notes.append(response)
-                response = input("Add note (enter 'EOF' to stop): ")
-
-        return {"result": result, "notes": notes}
-
-    if ":" in handler:
-        # run and return result of a python function check
-        if "{name}" in handler:
-            handler = handler.format(name=check.path().parts[1])
-        print(f"  Calling '{handler}' as Python function")
-        exec(make_import_statement(handler))
-        try:
-            return eval(make_function_call(handler))
-        except Exception as e:
-            print(
-                f"[red]There was an error trying to evaluate function call referenced by '{handler}'[/red]"
-            )
-            print(f"[red]Error Message: {e}[/red]")
-            return {"result": None, "notes": notes}
+@app.command()
+def compact_results(config_file: Path):
+    """
+    Write the changes recorded in the results journal into the results file.
 
-    try:
-        # run and return result of shell command
-        print(f"  Calling '{handler}' as shell command")
-        ret = run(handler, shell=True, stdout=PIPE, stderr=STDOUT)
-        if ret.returncode == 0:
-            return {"result": True, "notes": notes}
-        else:
-            notes.append("Command finished with a non-zero exit code.")
-            notes.append(f"command: {handler}.")
-            notes.append("command output:" + ret.stdout.decode("utf-8"))
-            return {"result": False, "notes": notes}
-    except Exception as e:
-        print(f"Unrecognized handler '{handler}'.")
-        print(
-            "Expecting 'manual', a Python function (i.e. 'hw_01:P1'), or a shell command"
-        )
-        print("Tried to run handler as a shell command but raised an exception")
-        print(f"Exception: {e}")
-        return {"result": None, "notes": notes}
+    When `results_journal: true` is set in CONFIG_FILE, run-checks appends
+    changed checks to a journal next to the results file instead of rewriting
+    the whole file. This writes the results file in the usual YAML layout and
+    removes the journal.
+    """
+    if not config_file.exists():
+        print(f"[bold red]Config file '{config_file}' does not exist.[/bold red]")
+        raise typer.Exit(code=1)
+
+    config = fspathtree(load_yaml(config_file.read_text()))
+    results_file = Path(config["results"])
+
+    if not results_file.exists():
+        print(f"[bold red]Results file '{results_file}' does not exists.[/bold red]")
+        raise typer.Exit(1)
 
-    return {"result": None, "notes": notes}
+    results = GradingResults()
+    results.load(results_file)
+    results.compact(results_file)
 
 
 @app.command()
@@ -432,7 +379,7 @@ def print_summary(config_file: Path):
         print(f"[bold red]Config file '{config_file}' does not exist.[/bold red]")
         raise typer.Exit(code=1)
 
-    config = fspathtree(yaml.safe_load(config_file.read_text()))
+    config = fspathtree(load_yaml(config_file.read_text()))
     results_file = Path(config["results"])
 
     if not results_file.exists():
@@ -440,14 +387,13 @@ def print_summary(config_file: Path):
         raise typer.Exit(1)
 
     try:
-        results = GradingResults()
-        results.load(results_file)
-        warnings, errors = results.score()
-        for w in warnings:
-            print(f"[yellow]{w}[/yellow]")
-        for e in errors:
-            print(f"[red]{e}[/red]")
-        print("\n".join(results.summary()))
+        # students are read, scored, and printed one at a time.
+        for warnings, errors, lines in GradingResults.iter_summary(results_file):
+            for w in warnings:
+                print(f"[yellow]{w}[/yellow]")
+            for e in errors:
+                print(f"[red]{e}[/red]")
+            print("\n".join(lines))
 
     except Exception as e:
         print("[red]An exception was thrown while trying to score results.[/red]")
@@ -0,0 +1,148 @@
+import os
+import re
+import stat
+import tarfile
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path, PurePosixPath
+
+# `{name}` is replaced with an alternation of the student names. members inside
+# a student's directory or prefixed by their name (i.e. LMS gradebook exports
+# like `HW01_jdoe_attempt_2023-01-01_main.py`) are matched.
+DEFAULT_MEMBER_PATTERN = r"(?:^|[/_]){name}[/_](?P<path>.+)$"
+
+
+def compile_member_pattern(pattern, names):
+    """
+    Compile a member name pattern into a regular expression.
+
+    `pattern` is a regular expression that must either contain the `{name}`
+    placeholder, which matches any of `names`, or a `name` group. If it has a
+    `path` group, the text it matches is used as the path of the file in the
+    student's directory. Otherwise the member's file name is used.
+    """
+    if "{name}" in pattern:
+        alternatives = "|".join(
+            re.escape(name) for name in sorted(names, key=len, reverse=True)
+        )
+        pattern = pattern.replace("{name}", f"(?P<name>{alternatives})")
+    regex = re.compile(pattern)
+    if "name" not in regex.groupindex:
+        raise ValueError(
+            f"Member pattern '{pattern}' needs a `{{name}}` placeholder or a `name` group."
+        )
+    return regex
+
+
+def route_member(member_name, regex, destinations):
+    """
+    Return the path `member_name` should be written to, or None if it does not
+    belong to a student.
+
+    `destinations` maps student names to their (absolute) directories. Paths
+    that would end up outside of the student's directory are rejected.
+    """
+    match = regex.search(member_name)
+    if match is None or match.group("name") not in destinations:
+        return None
+    if "path" in regex.groupindex and match.group("path"):
+        relative = PurePosixPath(match.group("path"))
+    else:
+        relative = PurePosixPath(PurePosixPath(member_name).name)
+    if relative.is_absolute() or ".." in relative.parts or len(relative.parts) == 0:
+        return None
+    return destinations[match.group("name")] / relative
+
+
+def iter_archive_members(archive):
+    """
+    Iterate over the regular files in a tar or zip archive in a single pass.
+
+    Yields (member name, size, mode, read) where `read()` returns the member's
+    content. Tar archives (compressed or not) are read as a stream, so `read`
+    must be called before the next member is requested.
+    """
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as zf:
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                mode = info.external_attr >> 16
+                if stat.S_IFMT(mode) != 0 and not stat.S_ISREG(mode):
+                    continue
+                yield info.filename, info.file_size, mode, lambda info=info: zf.read(info)
+        return
+
+    with tarfile.open(archive, "r|*") as tf:
+        for member in tf:
+            if not member.isfile():
+                continue
+            read = lambda member=member: tf.extractfile(member).read()
+            yield member.name, member.size, member.mode, read
+
+
+def write_member(path, data, mode):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    if mode & 0o111:
+        os.chmod(path, 0o755)
+    return len(data)
+
+
+def extract_submissions(
+    archives,
+    destinations,
+    pattern=DEFAULT_MEMBER_PATTERN,
+    max_member_size=None,
+    workers=4,
+):
+    """
+    Extract the files in `archives` into student directories in one pass.
+
+    Each member of each archive is routed to the directory in `destinations`
+    (a dict of student name to directory) of the student its name matches
+    (see `compile_member_pattern`). Members are read from the archive one at a
+    time and written to disk on a pool of `workers` threads. Members larger
+    than `max_member_size` bytes and members that do not belong to any student
+    are skipped.
+
+    Returns a dict with the number of files and bytes written, the skipped
+    members, and the students that did not have any files in the archives.
+    """
+    destinations = {name: Path(d).absolute() for name, d in destinations.items()}
+    regex = compile_member_pattern(pattern, destinations.keys())
+    summary = {"files": 0, "bytes": 0, "too_large": [], "unmatched": [], "missing": []}
+    found = set()
+    # the pending write for each path. members written to the same path (i.e.
+    # several submission attempts) are written in archive order.
+    pending = {}
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+
+        def drain(limit):
+            while len(pending) > limit:
+                done, _ = wait(pending.values(), return_when=FIRST_COMPLETED)
+                for path in [p for p, f in pending.items() if f in done]:
+                    summary["bytes"] += pending.pop(path).result()
+
+        for archive in archives:
+            for name, size, mode, read in iter_archive_members(archive):
+                path = route_member(name, regex, destinations)
+                if path is None:
+                    summary["unmatched"].append(name)
+                    continue
+                if max_member_size is not None and size > max_member_size:
+                    summary["too_large"].append(name)
+                    continue
+                data = read()
+                if path in pending:
+                    summary["bytes"] += pending.pop(path).result()
+                # limit the number of members held in memory.
+                drain(2 * max(workers, 1))
+                pending[path] = pool.submit(write_member, path, data, mode)
+                summary["files"] += 1
+                found.add(regex.search(name).group("name"))
+        drain(0)
+
+    summary["missing"] = [name for name in destinations if name not in found]
+    return summary
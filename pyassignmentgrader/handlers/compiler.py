@@ -0,0 +1,186 @@
+import ast
+import builtins
+import copy
+import functools
+import importlib
+import inspect
+
+
+class HandlerSpecError(Exception):
+    pass
+
+
+class Argument:
+    '''
+    An argument in a handler call.
+
+    Literal arguments (strings, numbers, lists, ...) are parsed once with
+    `ast.literal_eval`. Bare names (e.g. `ctx`) are looked up in the namespace
+    the handler is called with. Anything else is compiled once and evaluated
+    in that namespace when the handler is called.
+    '''
+
+    LITERAL = 0
+    NAME = 1
+    EXPRESSION = 2
+
+    def __init__(self, node, spec):
+        self.starred = False
+        if isinstance(node, ast.Starred):
+            self.starred = True
+            node = node.value
+        try:
+            self.kind = self.LITERAL
+            self.value = ast.literal_eval(node)
+            # mutable literals are copied for each call, the same way the
+            # expression would create a new object each time it was evaluated.
+            self.mutable = isinstance(self.value, (list, dict, set))
+            return
+        except (ValueError, TypeError):
+            # not a literal, or a literal that can not be built (i.e. `{[1]}`,
+            # a set of lists). it is evaluated when the handler is called.
+            pass
+        if isinstance(node, ast.Name):
+            self.kind = self.NAME
+            self.value = node.id
+            return
+        self.kind = self.EXPRESSION
+        self.value = compile(
+            ast.Expression(node), f"<handler '{spec}'>", "eval"
+        )
+
+    def evaluate(self, namespace):
+        if self.kind == self.LITERAL:
+            return copy.deepcopy(self.value) if self.mutable else self.value
+        if self.kind == self.NAME:
+            if self.value in namespace:
+                return namespace[self.value]
+            if hasattr(builtins, self.value):
+                return getattr(builtins, self.value)
+            raise NameError(f"name '{self.value}' is not defined")
+        return eval(self.value, {"__builtins__": builtins}, namespace)
+
+
+class CallPlan:
+    '''
+    A handler spec (`module:function(args)`) compiled into the imported
+    function and a list of parsed arguments, so that calling the handler
+    does not need to compile any code.
+    '''
+
+    def __init__(self, spec, module_name, function_name, function, args, kwargs):
+        self.spec = spec
+        self.module_name = module_name
+        self.function_name = function_name
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+
+    def bind(self, namespace={}):
+        '''
+        Evaluate the arguments in `namespace` and return (args, kwargs).
+        '''
+        args = []
+        for arg in self.args:
+            if arg.starred:
+                args.extend(arg.evaluate(namespace))
+            else:
+                args.append(arg.evaluate(namespace))
+        kwargs = {}
+        for name, arg in self.kwargs:
+            if name is None:
+                kwargs.update(arg.evaluate(namespace))
+            else:
+                kwargs[name] = arg.evaluate(namespace)
+        return args, kwargs
+
+    def partial(self, namespace={}):
+        '''
+        Return the function with its arguments bound.
+        '''
+        args, kwargs = self.bind(namespace)
+        return functools.partial(self.function, *args, **kwargs)
+
+    def __call__(self, namespace={}):
+        args, kwargs = self.bind(namespace)
+        return self.function(*args, **kwargs)
+
+
+# imported handler functions, keyed by (module name, function name)
+_function_cache = {}
+# compiled call plans, keyed by handler spec
+_plan_cache = {}
+
+
+def clear_cache():
+    _function_cache.clear()
+    _plan_cache.clear()
+
+
+def import_function(module_name, function_name):
+    key = (module_name, function_name)
+    if key not in _function_cache:
+        module = importlib.import_module(module_name)
+        _function_cache[key] = getattr(module, function_name)
+    return _function_cache[key]
+
+
+def split_handler_spec(spec: str):
+    '''
+    Split a handler spec into (module name, function name, call text).
+
+    The call text is None if the spec does not have an argument list.
+    '''
+    if ":" not in spec:
+        raise HandlerSpecError(
+            f"Handler spec '{spec}' does not have the form 'module:function(args)'."
+        )
+    module_name, function_call = spec.split(":", 1)
+    function_name = function_call.split("(")[0].strip()
+    if "(" in function_call:
+        return module_name.strip(), function_name, function_call
+    return module_name.strip(), function_name, None
+
+
+def compile_handler(spec: str):
+    '''
+    Compile a handler spec into a CallPlan. Plans are cached by spec, and the
+    imported functions are cached by module and function name, so each handler
+    is imported and parsed once.
+
+    If the spec does not have an argument list, the function's parameters
+    that do not have default values are looked up by name when the handler
+    is called.
+    '''
+    if spec in _plan_cache:
+        return _plan_cache[spec]
+
+    module_name, function_name, call = split_handler_spec(spec)
+    function = import_function(module_name, function_name)
+
+    args = []
+    kwargs = []
+    if call is None:
+        for parameter in inspect.signature(function).parameters.values():
+            if parameter.default is not inspect.Parameter.empty:
+                continue
+            if parameter.kind in (parameter.VAR_POSITIONAL, parameter.VAR_KEYWORD):
+                continue
+            args.append(Argument(ast.Name(id=parameter.name, ctx=ast.Load()), spec))
+    else:
+        try:
+            node = ast.parse(call.strip(), mode="eval").body
+        except SyntaxError as e:
+            raise HandlerSpecError(f"Could not parse the handler spec '{spec}': {e}")
+        if not isinstance(node, ast.Call):
+            raise HandlerSpecError(
+                f"Handler spec '{spec}' does not have the form 'module:function(args)'."
+            )
+        for arg in node.args:
+            args.append(Argument(arg, spec))
+        for keyword in node.keywords:
+            kwargs.append((keyword.arg, Argument(keyword.value, spec)))
+
+    plan = CallPlan(spec, module_name, function_name, function, args, kwargs)
+    _plan_cache[spec] = plan
+    return plan
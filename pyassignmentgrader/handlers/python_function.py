@@ -1,6 +1,8 @@
 import pyparsing as pp
-import inspect
 import functools
+import inspect
+
+from .compiler import compile_handler
 
 
 def wrap_func_in_generator(func,*args,**kwargs):
@@ -8,6 +10,23 @@ def wrap_func_in_generator(func,*args,**kwargs):
     return
     
 
+# the number of distinct handler specs to keep parsed. a rubric rarely has more than a few hundred.
+SPEC_CACHE_SIZE = 1024
+
+@functools.lru_cache(maxsize=SPEC_CACHE_SIZE)
+def parse_function_spec(function_spec):
+    '''
+    Parse a function specification into (module name, function name, function args).
+
+    Results are cached, so navigating between checks in the console does not re-run
+    the parser for specs that have already been seen. Use `parse_function_spec.cache_info()`
+    to get the hit/miss statistics.
+    '''
+    parse_results = PythonFunctionHandler.parsers.function_specification.parse_string(function_spec,parse_all=True)
+    function_args = parse_results["function_signature"] if "function_signature" in parse_results else None
+    return parse_results["module_name"],parse_results["function_name"],function_args
+
+
 class PythonFunctionHandler:
     class parsers:
         module_name = pp.Word(pp.alphas+"_"+".",pp.alphas+pp.nums+"_"+".")
@@ -17,28 +36,21 @@ class PythonFunctionHandler:
 
         function_specification = module_name("module_name") + ":" + function_name("function_name") + pp.Optional(function_signature)("function_signature")
     
-    def make_import_statement(self,parse_results):
-        code = f"from {parse_results['module_name']} import {parse_results['function_name']}"
-        return code
-    
     def __init__(self,function_spec,ctx={}):
         self.function = None
         self.function_spec = function_spec if function_spec.endswith(")") else function_spec+"()"
         self.ctx = ctx # context object
         function_spec = self.function_spec.format(**self.ctx)
         try:
-            parse_results = self.parsers.function_specification.parse_string(function_spec,parse_all=True)
+            self.module_name,self.function_name,self.function_args = parse_function_spec(function_spec)
         except Exception as e:
             raise RuntimeError(f"Could not parse the function specification '{self.function_spec}': {e}")
-        self.module_name = parse_results["module_name"]
-        self.function_name = parse_results["function_name"]
-        self.function_args = parse_results["function_signature"] if "function_signature" in parse_results else None
         try:
-            exec(self.make_import_statement(parse_results))
-        except Exception:
+            plan = compile_handler(function_spec)
+        except (ImportError,AttributeError):
             raise RuntimeError(f"Could not import function '{self.function_name}' from module '{self.module_name}'.")
         # We need to bind any user-defined arguments to the function call here.
-        self.function = eval(f"functools.partial({parse_results['function_name']},{self.function_args})")
+        self.function = plan.partial({"ctx":self.ctx})
         self.function_signature = inspect.signature(self.function)
         self.current_generator = None
 
@@ -0,0 +1,110 @@
+import json
+import pathlib
+
+
+class ResultsJournal:
+    '''
+    An append-only log of changes made to a results file.
+
+    Each line of the journal is a JSON record holding the path to a check
+    and the keys of the check that changed:
+
+    {"path": "/jdoe/checks/0", "result": true, "notes": ["Looks good"]}
+
+    Saving only appends the checks that changed since the last save, so
+    the cost of a save does not depend on the size of the results file.
+    The journal is replayed on top of the results file when it is loaded
+    and compacting it writes the results file in the usual YAML layout.
+    '''
+
+    keys = ("result", "notes", "status")
+
+    def __init__(self, file: pathlib.Path, compact_every=500):
+        self.file = pathlib.Path(file)
+        self.compact_every = compact_every
+        self.pending = {}
+        self.records = 0
+        if self.file.exists():
+            with self.file.open() as f:
+                self.records = sum(1 for line in f)
+
+    @staticmethod
+    def path_for(results_file: pathlib.Path):
+        results_file = pathlib.Path(results_file)
+        return results_file.with_name(results_file.name + ".journal")
+
+    def record(self, check):
+        '''
+        Mark a check node as changed. It will be written on the next flush.
+        '''
+        self.pending[str(check.path())] = check
+
+    def flush(self):
+        '''
+        Append all pending checks to the journal.
+        '''
+        if len(self.pending) == 0:
+            return
+        lines = []
+        for path, check in self.pending.items():
+            record = {"path": path}
+            for key in self.keys:
+                if key in check:
+                    value = check[key]
+                    record[key] = value.tree if hasattr(value, "tree") else value
+            lines.append(json.dumps(record, default=str))
+        self.records += len(lines)
+        with self.file.open("a+b") as f:
+            # make sure a partially written record does not swallow the first new one.
+            if f.tell() > 0:
+                f.seek(f.tell() - 1)
+                if f.read(1) != b"\n":
+                    lines.insert(0, "")
+            f.write(("\n".join(lines) + "\n").encode("utf-8"))
+        self.pending.clear()
+
+    def clear(self):
+        '''
+        Discard pending changes and remove the journal file.
+        '''
+        self.pending.clear()
+        self.records = 0
+        if self.file.exists():
+            self.file.unlink()
+
+    @staticmethod
+    def read(file: pathlib.Path):
+        '''
+        Return the records in journal `file`, in the order they were written.
+
+        An incomplete last line (i.e. the grader was killed during a write) is ignored.
+        '''
+        records = []
+        with pathlib.Path(file).open() as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+        return records
+
+    @staticmethod
+    def apply(records, data):
+        '''
+        Apply journal records to the fspathtree `data`. Records for checks that
+        no longer exist are skipped.
+        '''
+        for record in records:
+            record = dict(record)
+            path = record.pop("path")
+            if path not in data:
+                continue
+            for key, value in record.items():
+                data[f"{path}/{key}"] = value
+
+    @staticmethod
+    def replay(file: pathlib.Path, data):
+        '''
+        Apply the records in journal `file` to the fspathtree `data`.
+        '''
+        ResultsJournal.apply(ResultsJournal.read(file), data)
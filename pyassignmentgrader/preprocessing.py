@@ -0,0 +1,311 @@
+import copy
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from subprocess import PIPE, STDOUT, run
+
+from fspathtree import fspathtree
+from rich import print
+
+from .extract import DEFAULT_MEMBER_PATTERN, extract_submissions
+from .runner import resolve_handler
+from .utils import ExecutionContext, parse_size, working_dir
+
+
+def get_preprocessing_step(preproc):
+    """
+    Return the configuration for a single entry of the `preprocessing` section.
+
+    An entry is either a string (a shell command, or a Python function if it
+    contains a ':') or a mapping with a `cmd` key and optional `type` and
+    `working_directory` keys. Mappings with `type: extract` describe a
+    submission archive to extract instead (see `run_extract_step`).
+    """
+    conf = {"type": None, "cmd": "", "working_directory": Path().absolute()}
+
+    if type(preproc) is str and ":" in preproc:
+        conf["type"] = "python"
+        conf["cmd"] = preproc
+
+    if type(preproc) is str and ":" not in preproc:
+        conf["type"] = "shell"
+        conf["cmd"] = preproc
+
+    if type(preproc) is fspathtree:
+        conf = copy.deepcopy(preproc.tree)
+        if conf.get("type", None) == "extract":
+            # a missing archive is reported when the step is run.
+            conf.setdefault("cmd", f"extract {conf.get('archive', '')}".strip())
+        if "type" not in conf:
+            if ":" in conf["cmd"]:
+                conf["type"] = "python"
+            else:
+                conf["type"] = "shell"
+
+    # the scheduler changes the working directory of the process to run Python
+    # functions, so shell commands need an absolute directory.
+    conf["working_directory"] = Path(conf.get("working_directory", ".")).absolute()
+    return conf
+
+
+def get_preprocessing_tasks(config):
+    """
+    Expand the `preprocessing` section of `config` into a graph of tasks.
+
+    Steps with a `{name}` in their command are expanded to one task per student
+    (a `{name}` in their working directory is replaced too).
+    A student's task depends on the task for the same student in the previous
+    per-student step, so each student moves through consecutive per-student
+    steps independently of the others. All other steps are barriers: they wait
+    for every task before them and every task after them waits for them.
+
+    Returns a list of tasks. Each task is a dict with the step index, the
+    student name (None for barriers), the step configuration and the indices
+    of the tasks it depends on.
+    """
+    tasks = []
+    barrier = None
+    # the last task for each student since the last barrier
+    last = {}
+    for i, preproc in enumerate(config.get("preprocessing", [])):
+        conf = get_preprocessing_step(preproc)
+        if "{name}" in conf["cmd"]:
+            for student in config["students"]:
+                name = student["name"]
+                task_conf = copy.deepcopy(conf)
+                task_conf["cmd"] = task_conf["cmd"].format(name=name)
+                task_conf["working_directory"] = Path(
+                    str(task_conf["working_directory"]).replace("{name}", name)
+                )
+                deps = set()
+                if name in last:
+                    deps.add(last[name])
+                elif barrier is not None:
+                    deps.add(barrier)
+                last[name] = len(tasks)
+                tasks.append({"step": i, "student": name, "conf": task_conf, "deps": deps})
+        else:
+            deps = set(last.values())
+            if barrier is not None and len(deps) == 0:
+                deps.add(barrier)
+            barrier = len(tasks)
+            last = {}
+            tasks.append({"step": i, "student": None, "conf": conf, "deps": deps})
+    return tasks
+
+
+def run_preprocessing_command(conf):
+    """
+    Run a shell preprocessing command and return (return code, output, duration).
+    """
+    start = time.perf_counter()
+    ret = run(
+        conf["cmd"], shell=True, cwd=conf["working_directory"], stdout=PIPE, stderr=STDOUT
+    )
+    return ret.returncode, ret.stdout.decode(errors="replace"), time.perf_counter() - start
+
+
+def run_extract_step(conf, config, workers=1):
+    """
+    Extract a submission archive straight into the students' directories.
+
+    The step's keys are
+
+    archive: a glob pattern (relative to the step's working directory) for the archive(s) to extract.
+    destination: the directory to put each student's files in. `{name}` is replaced with the
+                 student's name. Defaults to the student's `working_directory`, or their name.
+    pattern: a regular expression matched against member names (see `extract.compile_member_pattern`).
+    max_member_size: skip members larger than this (i.e. '10M').
+    workers: the number of threads to write files with.
+
+    Returns (return code, output, duration) like `run_preprocessing_command`.
+    """
+    start = time.perf_counter()
+    if "archive" not in conf:
+        return 1, "Extract step needs an `archive` key with the archive(s) to extract.\n", time.perf_counter() - start
+    wd = Path(conf["working_directory"])
+    archives = sorted(wd.glob(conf["archive"]))
+    if len(archives) == 0:
+        return 1, f"No archive matching '{conf['archive']}' found.\n", time.perf_counter() - start
+
+    destinations = {}
+    for student in config["students"]:
+        name = student["name"]
+        destination = conf.get("destination", student.get("working_directory", "{name}"))
+        destinations[name] = wd / destination.replace("{name}", name)
+
+    try:
+        summary = extract_submissions(
+            archives,
+            destinations,
+            conf.get("pattern", DEFAULT_MEMBER_PATTERN),
+            parse_size(conf.get("max_member_size", None)),
+            conf.get("workers", workers),
+        )
+    except Exception as e:
+        return 1, f"Error extracting {', '.join(map(str, archives))}: {e}\n", time.perf_counter() - start
+
+    output = [f"Extracted {summary['files']} file(s) ({summary['bytes']} bytes) from {', '.join(a.name for a in archives)}."]
+    if len(summary["too_large"]) > 0:
+        output.append(f"Skipped {len(summary['too_large'])} file(s) larger than {conf['max_member_size']}:")
+        output += [f"  {name}" for name in summary["too_large"]]
+    if len(summary["unmatched"]) > 0:
+        output.append(f"Skipped {len(summary['unmatched'])} file(s) that did not match a student.")
+    if len(summary["missing"]) > 0:
+        output.append(f"No files found for: {', '.join(summary['missing'])}")
+    return 0, "\n".join(output) + "\n", time.perf_counter() - start
+
+
+def run_preprocessing_function(conf, config):
+    """
+    Call a Python function preprocessing step and return (failed, duration).
+
+    The process working directory is changed to the step's working directory
+    while the function runs, so it can use relative paths. The directory is
+    also available as `ctx["working_directory"]`. Shell commands running on
+    other threads are not affected, their working directories are absolute.
+    """
+    start = time.perf_counter()
+    failed = False
+    handler = resolve_handler(conf["cmd"])
+    directory = ExecutionContext(Path(conf["working_directory"]))
+    with working_dir(directory.path):
+        try:
+            if handler is not None:
+                handler({"config": config, "conf": conf, "ctx": {"working_directory": directory}})
+            else:
+                failed = True
+        except Exception as e:
+            print(
+                f"[red]There was an error trying to evaluate function call referenced by '{conf['cmd']}'[/red]"
+            )
+            print(f"[red]Error Message: {e}[/red]")
+            failed = True
+    return failed, time.perf_counter() - start
+
+
+def run_preprocessing(config, workers=1):
+    """
+    Run the `preprocessing` section of `config`.
+
+    Shell commands are run on a pool of `workers` threads as soon as the tasks
+    they depend on have finished (see `get_preprocessing_tasks`). Python
+    functions are called in-process, one at a time, from the calling thread
+    (see `run_preprocessing_function`).
+    Output from each shell command is printed when it finishes.
+
+    Returns a list with the summary of each step (see `summarize_preprocessing`).
+    """
+    tasks = get_preprocessing_tasks(config)
+    # the tasks waiting on each task
+    dependents = [[] for task in tasks]
+    waiting = []
+    for t, task in enumerate(tasks):
+        for d in task["deps"]:
+            dependents[d].append(t)
+        waiting.append(len(task["deps"]))
+
+    records = [None] * len(tasks)
+    ready = [t for t in range(len(tasks)) if waiting[t] == 0]
+    running = {}
+
+    def finish(t, failed, duration, start):
+        records[t] = {"failed": failed, "duration": duration, "start": start}
+        for d in dependents[t]:
+            waiting[d] -= 1
+            if waiting[d] == 0:
+                ready.append(d)
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        while len(ready) > 0 or len(running) > 0:
+            # start ready tasks in the order they appear in the config file.
+            ready.sort()
+            while len(ready) > 0:
+                t = ready.pop(0)
+                conf = tasks[t]["conf"]
+                if conf["type"] == "shell":
+                    running[pool.submit(run_preprocessing_command, conf)] = (
+                        t,
+                        time.perf_counter(),
+                    )
+                elif conf["type"] == "extract":
+                    running[pool.submit(run_extract_step, conf, config, workers)] = (
+                        t,
+                        time.perf_counter(),
+                    )
+                elif conf["type"] == "python":
+                    start = time.perf_counter()
+                    failed, duration = run_preprocessing_function(conf, config)
+                    finish(t, failed, duration, start)
+                else:
+                    print(
+                        f"[yellow]Unknown preprocessing type '{conf['type']}' for `{conf['cmd']}`.[/yellow]"
+                    )
+                    finish(t, True, 0, time.perf_counter())
+                ready.sort()
+
+            if len(running) == 0:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in sorted(done, key=lambda f: running[f][0]):
+                t, start = running.pop(future)
+                conf = tasks[t]["conf"]
+                returncode, output, duration = future.result()
+                print(f"[green]cmd[/green]: {conf['cmd']}")
+                sys.stdout.write(output)
+                if returncode != 0:
+                    print(
+                        f"[yellow]Preprocessing command `{conf['cmd']}` returned non-zero exist status.[/yellow]"
+                    )
+                finish(t, returncode != 0, duration, start)
+
+    return summarize_preprocessing(config, tasks, records)
+
+
+def summarize_preprocessing(config, tasks, records):
+    """
+    Collect the timing and failures of each preprocessing step.
+
+    Returns a list with a dict for each step giving the step's command, the
+    number of tasks it was expanded to, the students whose task failed (or
+    whether the step failed, for barriers), the wall-clock time from the start
+    of its first task to the end of its last one, and its slowest task.
+    """
+    steps = []
+    for i, preproc in enumerate(config.get("preprocessing", [])):
+        conf = get_preprocessing_step(preproc)
+        step_records = [
+            (task, record) for task, record in zip(tasks, records) if task["step"] == i
+        ]
+        summary = {
+            "step": i,
+            "cmd": conf["cmd"],
+            "tasks": len(step_records),
+            "failed": [task["student"] for task, record in step_records if record["failed"]],
+            "wall_time": 0.0,
+            "max_time": 0.0,
+        }
+        if len(step_records) > 0:
+            summary["wall_time"] = max(
+                r["start"] + r["duration"] for t, r in step_records
+            ) - min(r["start"] for t, r in step_records)
+            summary["max_time"] = max(r["duration"] for t, r in step_records)
+        steps.append(summary)
+    return steps
+
+
+def print_preprocessing_summary(steps):
+    print()
+    print("Preprocessing summary")
+    for step in steps:
+        line = f"  {step['step']}: `{step['cmd']}` ran {step['tasks']} command(s) in {step['wall_time']:.2f} s"
+        if step["tasks"] > 1:
+            line += f" (slowest {step['max_time']:.2f} s)"
+        print(line)
+        if len(step["failed"]) > 0:
+            names = [name for name in step["failed"] if name is not None]
+            if len(names) > 0:
+                print(f"     [yellow]{len(names)} failed: {', '.join(names)}[/yellow]")
+            else:
+                print("     [yellow]failed[/yellow]")
@@ -0,0 +1,151 @@
+import copy
+import hashlib
+import inspect
+import json
+import os
+import pathlib
+
+from .handlers.compiler import compile_handler
+
+
+class ResultCache:
+    '''
+    A cache of check results keyed by the content of the check's inputs.
+
+    The key for a check is a hash of
+
+    - the handler spec (and, for Python handlers, the source file the function is defined in),
+    - the directory the check runs in,
+    - the check's timeout, output, memory and CPU limits,
+    - the content of the check's input files.
+
+    The input files are the files listed (as glob patterns relative to the
+    check's directory) under the check's `inputs` key, or every file in the
+    check's directory if it does not have one. If none of these have changed
+    since the check was last ran, its result is reused instead of running the
+    handler again.
+
+    The cache is stored as JSON next to the results file.
+    '''
+
+    def __init__(self, file: pathlib.Path = None):
+        self.file = pathlib.Path(file) if file is not None else None
+        self.entries = {}
+        self.changed = False
+        # file digests, keyed by path. each entry is (size, mtime, digest) so that
+        # files are only hashed again if they have been modified.
+        self.file_digests = {}
+        if self.file is not None and self.file.exists():
+            try:
+                self.entries = json.loads(self.file.read_text())
+            except json.JSONDecodeError:
+                self.entries = {}
+
+    @staticmethod
+    def path_for(results_file: pathlib.Path):
+        results_file = pathlib.Path(results_file)
+        return results_file.with_name(results_file.name + ".cache")
+
+    def file_digest(self, path: pathlib.Path):
+        stat = path.stat()
+        key = str(path)
+        if key in self.file_digests:
+            size, mtime, digest = self.file_digests[key]
+            if size == stat.st_size and mtime == stat.st_mtime_ns:
+                return digest
+        h = hashlib.sha256()
+        with path.open("rb") as f:
+            for block in iter(lambda: f.read(1 << 16), b""):
+                h.update(block)
+        digest = h.hexdigest()
+        self.file_digests[key] = (stat.st_size, stat.st_mtime_ns, digest)
+        return digest
+
+    @staticmethod
+    def walk_files(directory: pathlib.Path):
+        '''
+        Return the files under `directory` (walking it once).
+        '''
+        return [
+            pathlib.Path(root, name)
+            for root, dirs, names in os.walk(directory)
+            for name in names
+            if os.path.isfile(os.path.join(root, name))
+        ]
+
+    def input_files(self, directory: pathlib.Path, inputs=None):
+        '''
+        Return a sorted list of the input files in `directory`.
+        '''
+        if inputs is None:
+            return sorted(self.walk_files(directory))
+        files = set()
+        directories = set()
+        for pattern in inputs:
+            for path in directory.glob(pattern):
+                if path.is_dir():
+                    directories.add(path)
+                elif path.is_file():
+                    files.add(path)
+        # the files in a directory that is inside another matched directory
+        # are already picked up when that directory is walked.
+        for path in directories:
+            if not any(parent in directories for parent in path.parents):
+                files.update(self.walk_files(path))
+        return sorted(files)
+
+    def key_for(self, check, handler: str, directory: pathlib.Path):
+        '''
+        Return the cache key for running `handler` for `check` in `directory`,
+        or None if the check cannot be cached.
+        '''
+        h = hashlib.sha256()
+        h.update(handler.encode("utf-8"))
+        if ":" in handler:
+            try:
+                function = compile_handler(handler).function
+                source_file = pathlib.Path(inspect.getsourcefile(function))
+                h.update(self.file_digest(source_file).encode("utf-8"))
+            except Exception:
+                return None
+        directory = pathlib.Path(directory).absolute()
+        h.update(str(directory).encode("utf-8"))
+        # the limits change the result a check can have (i.e. a timeout).
+        limits = {name: check.get(name, None) for name in ("timeout", "output_limit", "max_memory", "max_cpu_seconds")}
+        h.update(json.dumps(limits, sort_keys=True, default=str).encode("utf-8"))
+        inputs = check.get("inputs", None)
+        if inputs is not None:
+            inputs = [inputs] if isinstance(inputs, str) else list(inputs)
+        if directory.is_dir():
+            for path in self.input_files(directory, inputs):
+                h.update(os.fsencode(path.relative_to(directory)))
+                h.update(self.file_digest(path).encode("utf-8"))
+        return h.hexdigest()
+
+    def get(self, key):
+        '''
+        Return a copy of the cached result for `key`, or None.
+        '''
+        if key is None or key not in self.entries:
+            return None
+        return copy.deepcopy(self.entries[key])
+
+    def put(self, key, ret):
+        '''
+        Cache the result returned by a handler. Checks that did not produce a result,
+        or were stopped by a timeout or resource limit, are not cached.
+        '''
+        if key is None or ret.get("result", None) is None or ret.get("status", None) is not None:
+            return
+        notes = ret.get("notes", [])
+        notes = notes.tree if hasattr(notes, "tree") else notes
+        self.entries[key] = json.loads(
+            json.dumps({"result": ret["result"], "notes": list(notes)}, default=str)
+        )
+        self.changed = True
+
+    def save(self):
+        if self.file is None or not self.changed:
+            return
+        self.file.write_text(json.dumps(self.entries))
+        self.changed = False
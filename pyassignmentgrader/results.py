@@ -2,8 +2,12 @@ import fspathtree as ft
 import pprint
 import yaml
 import pathlib
+from .check_table import CheckTable
+from .journal import ResultsJournal
+from .result_cache import ResultCache
 from .rubric import GradingRubric
-from .utils import render_tree
+from .shards import ShardedResults
+from .utils import render_tree, load_yaml, dump_yaml, iter_yaml_items, WorkingDirectoryMap
 
 # import tomllib
 
@@ -11,21 +15,59 @@ from .utils import render_tree
 class GradingResults:
     def __init__(self):
         self.data = ft.fspathtree()
+        self.journal = None
+        self.result_cache = None
+        self.check_table = None
+        # the tree the check table was compiled from.
+        self._check_table_tree = None
+        # paths of the checks that changed since the last score.
+        self.dirty = set()
+        self._working_directories = None
 
     def load(self, file:pathlib.Path):
         if hasattr(file,'read_text'):
-            self.data = ft.fspathtree(yaml.safe_load(file.read_text()))
+            tree = load_yaml(file.read_text())
+            # changes that have not been compacted into the results file yet.
+            journal_file = ResultsJournal.path_for(file)
+            if ShardedResults.is_manifest(tree):
+                # shards are loaded when they are accessed, journal records are
+                # applied to each shard when it is loaded.
+                inline = {k: v for k, v in tree.items() if k != ShardedResults.manifest_key}
+                self.data = ft.fspathtree(ShardedResults(file, tree[ShardedResults.manifest_key], self.read_journal(file), inline))
+                return
+            self.data = ft.fspathtree(tree)
+            if journal_file.exists():
+                ResultsJournal.replay(journal_file, self.data)
             return
         if hasattr(file,'read'):
-            self.data = ft.fspathtree(yaml.safe_load(file.read()))
+            self.data = ft.fspathtree(load_yaml(file.read()))
             return
 
         raise RuntimeError(f"Could not figure out how to read {file}. It does not appear to be a pathlib.Path or file handle.")
 
     def dump(self, file:pathlib.Path):
-        text = yaml.dump(self.data.tree, sort_keys=False)
+        tree = self.data.tree
+        if isinstance(tree, ShardedResults):
+            if hasattr(file,'write_text'):
+                if pathlib.Path(file) != tree.manifest_file:
+                    # the shards are moving, so all of them need to be written.
+                    for name in tree:
+                        tree[name]
+                    tree.loaded_text.clear()
+                    tree.manifest_file = pathlib.Path(file)
+                tree.dump()
+                self.clear_journal(file)
+                return
+            tree = dict(tree.items())
+        try:
+            text = dump_yaml(tree, sort_keys=False)
+        except yaml.representer.RepresenterError:
+            # a handler put something that is not a plain type into the results.
+            # don't lose the results because of it.
+            text = yaml.dump(tree, sort_keys=False)
         if hasattr(file,'write_text'):
             file.write_text(text)
+            self.clear_journal(file)
             return
         if hasattr(file,'write'):
             file.write(text)
@@ -34,6 +76,117 @@ class GradingResults:
 
         raise RuntimeError(f"Could not figure out how to write text to {file}. It does not appear to be a pathlib.Path or file handle.")
 
+    def clear_journal(self, file:pathlib.Path):
+        '''
+        Remove the journal for `file` after the results file has been written.
+        '''
+        # the results file now contains everything that was in the journal.
+        journal_file = ResultsJournal.path_for(file)
+        if self.journal is not None and self.journal.file == journal_file:
+            self.journal.clear()
+        elif journal_file.exists():
+            journal_file.unlink()
+
+    @staticmethod
+    def read_journal(file:pathlib.Path):
+        '''
+        Return the journal records for results file `file`, grouped by student name.
+        '''
+        journal = {}
+        journal_file = ResultsJournal.path_for(file)
+        if journal_file.exists():
+            for record in ResultsJournal.read(journal_file):
+                journal.setdefault(record["path"].split("/")[1], []).append(record)
+        return journal
+
+    def use_shards(self, file:pathlib.Path):
+        '''
+        Switch to the sharded layout, storing each student in their own file
+        next to `file`, which holds the manifest (see ShardedResults).
+
+        The shards are written on the next save.
+        '''
+        if isinstance(self.data.tree, ShardedResults):
+            return
+        shards = ShardedResults(file)
+        for name, tree in self.data.tree.items():
+            shards[name] = tree
+        self.data = ft.fspathtree(shards)
+
+    def open_journal(self, file:pathlib.Path, compact_every=500):
+        '''
+        Record changes to a journal instead of rewriting the results file on every save.
+
+        The journal is compacted into the results file when it grows past
+        `compact_every` records.
+        '''
+        self.journal = ResultsJournal(ResultsJournal.path_for(file), compact_every)
+
+    def open_result_cache(self, file:pathlib.Path):
+        '''
+        Reuse the results of checks whose inputs have not changed (see ResultCache).
+        The cache is stored next to `file` and written on every save.
+        '''
+        self.result_cache = ResultCache(ResultCache.path_for(file))
+
+    def mark_changed(self, check):
+        '''
+        Mark a check node as changed so that it is written on the next save
+        and its student is scored again by rescore().
+        '''
+        self.dirty.add(str(check.path()))
+        if self._working_directories is not None:
+            self._working_directories.update(check)
+        if self.journal is not None:
+            self.journal.record(check)
+
+    @property
+    def working_directories(self):
+        '''
+        The WorkingDirectoryMap for the results tree. It is rebuilt if the tree is replaced.
+        '''
+        if self._working_directories is None or self._working_directories.tree is not self.data.tree:
+            self._working_directories = WorkingDirectoryMap(self.data)
+        return self._working_directories
+
+    def get_working_directory(self, node, start=None):
+        '''
+        Return the working directory for a node (or path) in the results tree,
+        see get_working_directory_for_node and WorkingDirectoryMap.get.
+        '''
+        path = node.path() if hasattr(node, "path") else node
+        return self.working_directories.get(path, start)
+
+    def save(self, file:pathlib.Path):
+        '''
+        Save changes to the results file.
+
+        If a journal is open, only the checks marked as changed are written
+        and the results file is only rewritten when the journal is compacted.
+        '''
+        if self.result_cache is not None:
+            self.result_cache.save()
+        if self.journal is None:
+            self.dump(file)
+            return
+        self.journal.flush()
+        if self.journal.records >= self.journal.compact_every:
+            self.compact(file)
+
+    def checkpoint(self, file:pathlib.Path):
+        '''
+        Save changes to the results file if a journal is open. Without a journal,
+        saving rewrites the whole results file, so that is left to save().
+        '''
+        if self.journal is not None:
+            self.save(file)
+
+    def compact(self, file:pathlib.Path):
+        '''
+        Write the results file in the YAML layout and remove the journal.
+        '''
+        self.dump(file)
+
 
     def add_student(self, name: str, rubric: GradingRubric):
         if name not in self.data:
@@ -41,6 +194,8 @@ class GradingResults:
             # add the student name to a context for this tree so we can use it in
             # sub-nodes.
             self.data[name]['context/name'] = name
+            if self._working_directories is not None:
+                self._working_directories.invalidate(name)
         else:
             raise RuntimeError(f"Student '{name}' is already in the grading results.")
 
@@ -55,6 +210,21 @@ class GradingResults:
             self.data[ f"/{name}/{missing_key}"] = empty_results[f"{missing_key}"]
 
         self.data[name]['context/name'] = name
+        if self._working_directories is not None:
+            self._working_directories.invalidate(name)
+
+    def student_names(self):
+        '''
+        Return the names of the students in the results. Top-level keys that
+        are not students (i.e. `working_directory`) are skipped. The shards of
+        a sharded results file are not loaded.
+        '''
+        tree = self.data.tree
+        if isinstance(tree, ShardedResults):
+            return tree.students()
+        return [
+            name for name, node in tree.items() if isinstance(node, dict) and "checks" in node
+        ]
 
     # def get_all_check_keys(self):
     #     self.data.get_all_leaf_node_paths(
@@ -62,107 +232,71 @@ class GradingResults:
     #             )
 
 
-    def __score(self, list_of_checks):
-        warnings = []
-        errors = []
-        total = 0
-        awarded = 0
-        for key in list_of_checks.get_all_leaf_node_paths(
-            predicate=lambda p: len(p.parts) == 2 and p.name == "result",
-        ):
-            total += list_of_checks.get(key/"../weight",1)
-
-        user = list_of_checks.path().parts[1]
-        for i in range(len(list_of_checks)):
-            check = list_of_checks[i]
-            if "result" not in check:
-                raise RuntimeError(
-                    f"Check at {check.path()} does not contain a result."
-                )
-            if check["result"] is None:
-                msg = f"WARNING: {user} has a check that has not been completed."
-                msg += f"\n"
-                msg += f"         desc: {check['desc']}"
-                msg += f"\n"
-                msg += f"         I am skipping the check which means that the computed score MAY BE TOO LOW."
-                warnings.append(msg)
-                continue
-
-            weight = check.get("weight", 1)
-            if check["result"] is True:
-                awarded += weight
-            elif check["result"] is False:
-                if "secondary_checks" in check:
-                    if "secondary_checks/checks" not in check:
-                        raise RuntimeError(
-                            f"Check at {check.path()} contains a secondary_check key, but there are no checks underneath it."
-                        )
-                    if "secondary_checks/weight" not in check:
-                        raise RuntimeError(
-                            f"Check at {check.path()} contains a secondary_check key, but there is no weight underneath it."
-                        )
-                    t, a, w, e = self.__score(check["secondary_checks/checks"])
-                    warnings += w
-                    errors += e
-                    awarded += weight * check["secondary_checks/weight"] * a / t
-            elif isinstance( check["result"], (int,float) ):
-                awarded += weight*check["result"]
-            else:
-                raise RuntimeError(f"Unexpected result type {type(check['result'])}. Expected a bool, float, or None.")
-
-        return total, awarded, warnings, errors
-
-
-    def score(self):
-        warnings = []
-        errors = []
-        for user in self.data.tree:
-            checks = self.data[f"{user}/checks"]
-
-            t, a, w, e = self.__score(checks)
-            warnings += w
-            errors += e
-
-            checks["../available"] = t
-            checks["../awarded"] = a
-            checks["../score"] = a / t
+    def compile(self, students=None):
+        '''
+        Compile the results tree into a CheckTable that score() and summary() work from.
+        '''
+        self.check_table = CheckTable.compile(
+            self.data, self.student_names() if students is None else students
+        )
+        self._check_table_tree = self.data.tree
+        self.dirty.clear()
+        return self.check_table
+
+    def score(self, engine="python", students=None):
+        '''
+        Score every student (or the students named in `students`) and store
+        their available and awarded points and score. `engine` selects the
+        CheckTable scoring engine ("python" or "numpy").
+        '''
+        table = self.compile(students)
+        available, awarded, warnings, errors = table.score(engine)
+        self.store_scores(table.students, available, awarded)
 
         return warnings, errors
 
-    def __checks_summary(self, list_of_checks, prefix=""):
-        lines = []
+    def rescore(self):
+        '''
+        Score the students that have checks marked as changed since the last
+        score() or rescore() again.
+
+        The changed checks are updated in the CheckTable from the last score
+        and only the checks of their students are scored. Everything is
+        scored again if the checks do not match the table anymore.
+        '''
+        table = self.check_table
+        if not self.check_table_is_current():
+            return self.score()
+
+        students = set()
+        for path in self.dirty:
+            if path not in table.rows:
+                # checks were added or a new student is being graded.
+                names = list(table.students)
+                names += sorted({p.split("/")[1] for p in self.dirty} - set(names))
+                return self.score(students=names)
+            row = table.rows[path]
+            table.update_check(row, self.data[path].tree)
+            students.add(table.student[row])
+
+        students = sorted(students)
+        available, awarded, warnings, errors = table.score(students=students)
+        self.store_scores([table.students[s] for s in students], available, awarded)
+        self.dirty.clear()
+        return warnings, errors
 
-        def add_line(text):
-            lines.append(f"{prefix}{text}")
+    def check_table_is_current(self):
+        '''
+        Return True if the check table was compiled from the current results tree.
+        Checks marked as changed since then still need to be updated in it.
+        '''
+        return self.check_table is not None and self._check_table_tree is self.data.tree
 
-        for check in list_of_checks:
-            tag = check.get("tag", "Check")
-            desc = check.get("desc", "")
-            add_line(f"{tag}: {desc}")
-
-            weight = check.get("weight", 1)
-            add_line(f"  weight: {weight}")
-
-            if check["result"] is None:
-                add_line(f"  result: Not Ran")
-            elif check["result"] is True:
-                add_line(f"  result: PASS")
-            else:
-                add_line(f"  result: FAIL")
-
-            if "notes" in check:
-                add_line(f"  notes:")
-                for n in check["notes"]:
-                    add_line(f"      {n}")
-
-
-            if check['result'] == False and "secondary_checks" in check:
-                add_line(f"  Secondary Checks:")
-                add_line(f"    weight: {check['secondary_checks/weight']}")
-                lines += self.__checks_summary(
-                    check["secondary_checks/checks"], prefix + "    "
-                )
-        return lines
+    def store_scores(self, students, available, awarded):
+        for user, a, b in zip(students, available, awarded):
+            self.data[f"{user}/available"] = a
+            self.data[f"{user}/awarded"] = b
+            self.data[f"{user}/score"] = b / a
 
     def summary(self, prefix=""):
         lines = []
@@ -170,13 +304,64 @@ class GradingResults:
         def add_line(text):
             lines.append(f"{prefix}{text}")
 
-        for user in self.data.tree:
+        if not self.check_table_is_current():
+            self.compile()
+        elif len(self.dirty) > 0:
+            self.rescore()
+        table = self.check_table
+        for s, user in enumerate(table.students):
             add_line(f"Grading report for '{user}':")
-            checks = self.data[f"{user}/checks"]
-            lines += self.__checks_summary(checks)
+            lines += table.summary(s, prefix)
 
             # add_line(f"Points: {self.data[f'{user}/awarded']}")
             # add_line(f"Total: {self.data[f'{user}/available']}")
             add_line(f"Score: {self.data[f'{user}/score']*100:.2f}%")
 
         return lines
+
+    @staticmethod
+    def iter_students(file:pathlib.Path):
+        '''
+        Iterate over the students in a results file, yielding (name, tree) pairs
+        one student at a time instead of loading the whole file.
+
+        The file can be a single YAML document with a key for each student, or
+        several documents with one (or more) students in each. If it is the
+        manifest of a sharded results file, the shards are read one at a time.
+        Changes in the results journal are applied to each student as it is read.
+        '''
+        file = pathlib.Path(file)
+        journal = GradingResults.read_journal(file)
+
+        def iter_file(file):
+            with file.open() as f:
+                for name, tree in iter_yaml_items(f):
+                    if name == ShardedResults.manifest_key and isinstance(tree, dict):
+                        for shard in tree.values():
+                            yield from iter_file(file.parent / shard)
+                        continue
+                    yield name, tree
+
+        for name, tree in iter_file(file):
+            if not isinstance(tree, dict) or "checks" not in tree:
+                continue
+            if name in journal:
+                data = ft.fspathtree({name: tree})
+                ResultsJournal.apply(journal[name], data)
+            yield name, tree
+
+    @staticmethod
+    def iter_summary(file:pathlib.Path, prefix=""):
+        '''
+        Score and summarize a results file one student at a time.
+
+        Yields a (warnings, errors, lines) tuple for each student, where lines
+        is the student's part of the report that summary() would return.
+        '''
+        for name, tree in GradingResults.iter_students(file):
+            table = CheckTable.compile(ft.fspathtree({name: tree}))
+            available, awarded, warnings, errors = table.score()
+            lines = [f"{prefix}Grading report for '{name}':"]
+            lines += table.summary(0, prefix)
+            lines.append(f"{prefix}Score: {awarded[0]/available[0]*100:.2f}%")
+            yield warnings, errors, lines
@@ -2,6 +2,7 @@ import fspathtree as ft
 import yaml
 import copy
 import pathlib
+from .utils import load_yaml, dump_yaml
 
 
 class GradingRubric:
@@ -35,10 +36,10 @@ class GradingRubric:
 
     def load(self, file:pathlib.Path):
         if hasattr(file,'read_text'):
-            self.data = ft.fspathtree(yaml.safe_load(file.read_text()))
+            self.data = ft.fspathtree(load_yaml(file.read_text()))
             return
         if hasattr(file,'read'):
-            self.data = ft.fspathtree(yaml.safe_load(file.read()))
+            self.data = ft.fspathtree(load_yaml(file.read()))
             return
 
         raise RuntimeError(f"Could not figure out how to read {file}. It does not appear to be a pathlib.Path or file handle.")
@@ -47,7 +48,7 @@ class GradingRubric:
 
 
     def dump(self, file:pathlib.Path):
-        text = yaml.safe_dump(self.data.tree, sort_keys=False)
+        text = dump_yaml(self.data.tree, sort_keys=False)
         file.write_text(text)
 
     def make_empty_grading_results(self):
@@ -0,0 +1,563 @@
+import contextlib
+import copy
+import io
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+from subprocess import TimeoutExpired
+
+from fspathtree import fspathtree
+from rich import print
+
+from .handlers.compiler import clear_cache, compile_handler, split_handler_spec
+from .utils import *
+from .worker_pool import HandlerWorkerPool
+
+
+def clear_handler_cache():
+    clear_cache()
+    clear_directory_indexes()
+
+
+def resolve_handler(func_spec: str):
+    """
+    Compile `func_spec` into a call plan (see `handlers.compiler`).
+
+    Plans and imported functions are cached, so each distinct handler is imported
+    and parsed once per run instead of once per student. Import and parse errors
+    are printed and None is returned.
+    """
+    try:
+        return compile_handler(func_spec)
+    except Exception as e:
+        module_name, function_name, _ = split_handler_spec(func_spec)
+        print(
+            f"[red]There was a problem trying to import {function_name} from {module_name}.[/red]"
+        )
+        print(f"[red]Error Message: {e}[/red]")
+        return None
+
+
+def get_check_directory(check, ctx, results=None):
+    """
+    Return the directory to run a check in.
+
+    With `results`, the directory is looked up in the results' working directory
+    map relative to the student's directory. Otherwise it is the check's
+    `working_directory`, relative to the current execution context.
+    """
+    if results is not None and "student_dir" in ctx and hasattr(check, "path"):
+        try:
+            return Path(ctx["student_dir"]) / results.get_working_directory(
+                check, start=f"/{ctx['student_name']}"
+            )
+        except KeyError:
+            pass
+    return check.get("working_directory", ".")
+
+
+def run_list_of_checks(list_of_checks, tag, ctx, force=False, results=None):
+    for check in list_of_checks:
+        if tag is not None and check.get("tag", "NO-TAG") != tag:
+            continue
+        with execution_context(get_check_directory(check, ctx, results)) as check_dir:
+            print()
+            cache = results.result_cache if results is not None else None
+            skipped = not force and check["result"] is not None
+            ret = run_cached_check(check, ctx, force, cache)
+            # checks that were skipped are left as they are, like the concurrent runners do.
+            if not skipped:
+                record_check_result(check, ret, results)
+
+            if check["result"] is False and "secondary_checks" in check:
+                with execution_context(
+                    check.get("secondary_checks/working_directory", ".")
+                ) as secondary_checks_dir:
+                    run_list_of_checks(
+                        check["secondary_checks/checks"], tag, ctx, results=results
+                    )
+
+
+def record_check_result(check, ret, results=None):
+    """
+    Copy the result and notes returned by a check handler into the check node
+    and print them. If `results` is given, the check is marked as changed.
+    """
+    check["result"] = ret["result"]
+    check["notes"] = ret["notes"]
+    # checks that timed out or hit a resource limit have a status. clear it if
+    # the check was ran again.
+    if "status" in ret or "status" in check:
+        check["status"] = ret.get("status", None)
+    if results is not None:
+        results.mark_changed(check)
+    # check["notes"].tree.clear()
+    # for note in ret["notes"]:
+    #     check["notes"].tree.append(note)
+
+    if ret.get("status", None) == "timeout":
+        print("  [red]TIMEOUT[/red]")
+    elif ret.get("status", None) == "resource-limit":
+        print("  [red]RESOURCE LIMIT EXCEEDED[/red]")
+    elif ret["result"] is True:
+        print("  [green]PASS[/green]")
+    elif ret["result"] is False:
+        print("  [red]FAIL[/red]")
+    elif ret["result"] is None:
+        print("  [yellow]NO RESULT[/yellow]")
+    print("  NOTES:")
+    for n in ret["notes"]:
+        print("    ", n)
+
+
+def get_cache_key(check, ctx, cache):
+    """
+    Return the result cache key for running `check` in the current execution context,
+    or None if the check should not be cached.
+    """
+    handler = check.get("handler", "manual")
+    if cache is None or handler == "manual":
+        return None
+    if "{name}" in handler:
+        handler = handler.format(name=ctx["student_name"])
+    return cache.key_for(check, handler, get_execution_context().path)
+
+
+def run_cached_check(check, ctx, force=False, cache=None):
+    """
+    Run `check` with `run_check`, reusing the result stored in `cache` if the
+    check's handler and inputs have not changed since it was last ran.
+    """
+    output_log = get_output_log(check, ctx)
+    if cache is None or (not force and check["result"] is not None):
+        return run_check(check, ctx, force, output_log)
+    key = get_cache_key(check, ctx, cache)
+    ret = cache.get(key)
+    if ret is not None:
+        check_name = f"{ctx['student_name']}>{check['tag']}: {check['desc']}"
+        print(f"[green]CACHED[/green] - inputs for {check_name} have not changed since it was last ran.")
+        return ret
+    ret = run_check(check, ctx, force, output_log)
+    cache.put(key, ret)
+    return ret
+
+
+# the HandlerWorkerPool Python function handlers are sent to, if there is one.
+_handler_pool = None
+
+
+def get_handler_pool():
+    return _handler_pool
+
+
+@contextlib.contextmanager
+def handler_pool(pool):
+    """
+    Run Python function handlers on `pool` (a HandlerWorkerPool) instead of in
+    the grader process. Handlers with memory or CPU limits are still run in
+    their own child process. The pool is closed on exit.
+    """
+    global _handler_pool
+    previous = _handler_pool
+    _handler_pool = pool
+    try:
+        yield pool
+    finally:
+        _handler_pool = previous
+        if pool is not None:
+            pool.close()
+
+
+def get_handler_modules(data, students=None):
+    """
+    Return the names of the modules referenced by Python function handlers in a results tree.
+
+    If `students` is given, only their checks are looked at.
+    """
+    modules = set()
+
+    def add_modules(list_of_checks):
+        for check in list_of_checks:
+            handler = check.get("handler", "manual")
+            if isinstance(handler, str) and ":" in handler:
+                modules.add(split_handler_spec(handler)[0])
+            if "secondary_checks" in check:
+                add_modules(check.get("secondary_checks", {}).get("checks", []))
+
+    for name in data.tree if students is None else students:
+        student = data.tree[name]
+        if isinstance(student, dict):
+            add_modules(student.get("checks", []))
+    return sorted(modules)
+
+
+def make_handler_pool(config, results, students, max_workers=None):
+    """
+    Start the HandlerWorkerPool configured by the `handler_workers` key of
+    `config`, with at most `max_workers` workers. Returns None if
+    `handler_workers` is not set.
+    """
+    workers = config.get("handler_workers", 0)
+    if max_workers is not None:
+        workers = min(workers, max_workers)
+    if workers <= 0:
+        return None
+    return HandlerWorkerPool(
+        workers,
+        get_handler_modules(results.data, students),
+        config.get("handler_worker_max_tasks", 100),
+        config.get("handler_worker_max_memory_growth", "512M"),
+    )
+
+
+def timed_out(limits, notes, output=None):
+    notes.append(f"Check timed out after {limits['timeout']} seconds.")
+    if output:
+        notes.append("command output:" + output)
+    return {"result": False, "status": "timeout", "notes": notes}
+
+
+def resource_limit_exceeded(limits, notes, *messages):
+    notes.append(
+        f"Check was stopped for exceeding its resource limits (max_memory: {limits['max_memory']}, max_cpu_seconds: {limits['max_cpu_seconds']})."
+    )
+    notes.extend(m for m in messages if m)
+    return {"result": False, "status": "resource-limit", "notes": notes}
+
+
+def command_result(handler, limits, notes, returncode, output):
+    """
+    Return the check result for a shell command handler that exited with `returncode`.
+    """
+    if limits["max_cpu_seconds"] is not None and killed_by_resource_limit(returncode):
+        return resource_limit_exceeded(
+            limits, notes, f"command: {handler}.", "command output:" + output.text()
+        )
+    if returncode == 0:
+        return {"result": True, "notes": notes}
+    notes.append("Command finished with a non-zero exit code.")
+    notes.append(f"command: {handler}.")
+    notes.append("command output:" + output.text())
+    return {"result": False, "notes": notes}
+
+
+def get_output_log(check, ctx):
+    """
+    Return the file the full output of a shell command check is written to if
+    it does not fit in the results, or None if there is no artifacts directory.
+    """
+    artifacts_directory = ctx.get("artifacts_directory", None)
+    if artifacts_directory is None:
+        return None
+    parts = Path(str(check.path())).parts
+    return Path(artifacts_directory) / parts[1] / (".".join(parts[2:]) + ".log")
+
+
+def get_artifacts_directory(results_file):
+    results_file = Path(results_file).absolute()
+    return results_file.with_name(results_file.name + ".artifacts")
+
+
+def run_check(check, ctx, force=False, output_log=None):
+    """
+    Run the handler for `check` in the current execution context.
+
+    Shell commands are run with the execution context directory as their working
+    directory, and Python functions can access it through `ctx["working_directory"]`.
+
+    Shell command output beyond `output_limit` bytes (a key of the check or the
+    ctx) is left out of the notes. The complete output is written to `output_log`.
+
+    If the check has a `timeout`, `max_memory` or `max_cpu_seconds` key, the handler
+    is run in a child process with those limits. Checks that time out or are
+    killed for exceeding a limit fail with a `status` of "timeout" or "resource-limit".
+    """
+    check_name = f"{ctx['student_name']}>{check['tag']}: {check['desc']}"
+    notes = []
+    if not force and check["result"] is not None:
+        print(f"[green]SKIPPING[/green] - {check_name} has already been ran.")
+        return {"result": check["result"], "notes": notes}
+
+    handler = check.get("handler", "manual")
+    limits = get_resource_limits(check)
+    print(f"Running check for '{check_name}'")
+    if handler == "manual":
+        # run and return result of manual check
+        print("Manual Check")
+        response = ""
+        while response.lower() not in ["y", "n", "yes", "no", "s", "skip"]:
+            if len(response) > 0:
+                print(f"Unrecognized response [yellow]{response}[/yellow]")
+            response = input("Did this check pass? [y/n] ")
+        if response.lower().startswith("s"):
+            return {"result": None, "notes": notes}
+
+        result = response.lower().startswith("y")
+
+        if response[0].islower():
+            response = input("Add note (enter 'EOF' to stop): ")
+            while response.lower() != "eof":
+                notes.append(response)
+                response = input("Add note (enter 'EOF' to stop): ")
+
+        return {"result": result, "notes": notes}
+
+    if ":" in handler:
+        # run and return result of a python function check
+        if "{name}" in handler:
+            handler = handler.format(name=ctx["student_name"])
+        print(f"  Calling '{handler}' as Python function")
+        ctx["working_directory"] = get_execution_context()
+        try:
+            resolved_handler = resolve_handler(handler)
+            if resolved_handler is None:
+                return {"result": None, "notes": notes}
+            namespace = {"check": check, "ctx": ctx, "force": force, "notes": notes}
+            pool = get_handler_pool()
+            if limits["max_memory"] is not None or limits["max_cpu_seconds"] is not None:
+                return call_with_limits(lambda: resolved_handler(namespace), **limits)
+            if pool is not None:
+                return pool.call(
+                    handler, namespace, get_execution_context(), limits["timeout"]
+                )
+            if limits["timeout"] is not None:
+                return call_with_limits(lambda: resolved_handler(namespace), **limits)
+            return resolved_handler(namespace)
+        except TimeoutExpired:
+            return timed_out(limits, notes)
+        except (ResourceLimitError, MemoryError) as e:
+            return resource_limit_exceeded(limits, notes, str(e))
+        except Exception as e:
+            print(
+                f"[red]There was an error trying to evaluate function call referenced by '{handler}'[/red]"
+            )
+            print(f"[red]Error Message: {e}[/red]")
+            return {"result": None, "notes": notes}
+
+    try:
+        # run and return result of shell command
+        print(f"  Calling '{handler}' as shell command")
+        try:
+            returncode, output = run_command(
+                handler,
+                cwd=get_execution_context(),
+                limit=check.get("output_limit", ctx.get("output_limit", OUTPUT_LIMIT)),
+                log_file=output_log,
+                **limits,
+            )
+        except TimeoutExpired as e:
+            return timed_out(limits, notes, e.output.text())
+        return command_result(handler, limits, notes, returncode, output)
+    except Exception as e:
+        print(f"Unrecognized handler '{handler}'.")
+        print(
+            "Expecting 'manual', a Python function (i.e. 'hw_01:P1'), or a shell command"
+        )
+        print("Tried to run handler as a shell command but raised an exception")
+        print(f"Exception: {e}")
+        return {"result": None, "notes": notes}
+
+    return {"result": None, "notes": notes}
+
+
+def make_student_context(
+    results, student_name, workspace_directory, output_limit=OUTPUT_LIMIT, results_file=None
+):
+    """
+    Return the context the concurrent runners evaluate `student_name`'s checks with.
+
+    The context is a plain dict so that it can be sent to worker processes.
+    """
+    student_dir = get_execution_context().enter(
+        results.get_working_directory(f"/{student_name}", start="/") or "."
+    )
+    ctx = {}
+    ctx["student_name"] = student_name
+    ctx["student_dir"] = student_dir.path
+    ctx["list_of_checks"] = copy.deepcopy(results.data[student_name]["checks"].tree)
+    ctx["workspace_directory"] = workspace_directory
+    ctx["output_limit"] = output_limit
+    if results_file is not None:
+        ctx["artifacts_directory"] = get_artifacts_directory(results_file)
+    return ctx
+
+
+def merge_check_results(results, skipped, finished, results_file=None):
+    """
+    Print and record the results of checks that were run concurrently.
+
+    `skipped` is a list of (key,check,directory,ctx) entries for checks that
+    already had a result and `finished` is a list of (entry, ret, log) tuples.
+    They are merged in key order, which is the order a serial run visits them in.
+    """
+    skipped_keys = set(entry[0] for entry in skipped)
+    output = [(entry[0], entry, None, None) for entry in skipped]
+    output += [(entry[0], entry, ret, log) for entry, ret, log in finished]
+    for key, entry, ret, log in sorted(output, key=lambda o: o[0]):
+        check, ctx = entry[1], entry[3]
+        print()
+        if key in skipped_keys:
+            check_name = f"{ctx['student_name']}>{check['tag']}: {check['desc']}"
+            print(f"[green]SKIPPING[/green] - {check_name} has already been ran.")
+            continue
+        sys.stdout.write(log)
+        record_check_result(check, ret, results)
+
+    if results_file is not None:
+        results.checkpoint(results_file)
+
+
+def run_deferred_checks(results, deferred, tag, results_file=None, description="manual"):
+    """
+    Run the (key,check,directory,ctx) entries in `deferred` serially, in key order.
+
+    Whether to skip a check was decided when it was deferred (secondary checks
+    are never forced), so every deferred check is run. Secondary checks of
+    deferred checks that fail are run with `run_list_of_checks`, like the
+    serial runner does.
+    """
+    if len(deferred) > 0:
+        print()
+        print(f"Running {len(deferred)} {description} check(s).")
+    cache = results.result_cache
+    for key, check, check_dir, ctx in sorted(deferred, key=lambda e: e[0]):
+        with execution_context(check_dir):
+            print()
+            ret = run_cached_check(check, fspathtree(ctx), True, cache)
+            record_check_result(check, ret, results)
+            if check["result"] is False and "secondary_checks" in check:
+                with execution_context(
+                    check.get("secondary_checks/working_directory", ".")
+                ):
+                    run_list_of_checks(
+                        check["secondary_checks/checks"],
+                        tag,
+                        fspathtree(ctx),
+                        results=results,
+                    )
+        if results_file is not None:
+            results.checkpoint(results_file)
+
+
+class CheckJob:
+    """
+    An automated check that has been scheduled to run on a worker process.
+
+    The job only carries plain (picklable) data: a copy of the check node,
+    the absolute directory the check should run in, the context the
+    handler is evaluated with, and the file to write long command output to.
+    """
+
+    def __init__(self, key, check, directory, ctx, output_log=None):
+        self.key = key
+        self.check = copy.deepcopy(check.tree)
+        self.directory = directory
+        self.ctx = ctx
+        self.output_log = output_log
+
+
+def _init_check_worker(path):
+    sys.path[:] = path
+
+
+def _run_check_job(job):
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        with execution_context(job.directory):
+            ret = run_check(
+                fspathtree(job.check), fspathtree(job.ctx), True, job.output_log
+            )
+    return ret, log.getvalue()
+
+
+def run_checks_in_parallel(
+    results,
+    students,
+    tag,
+    workspace_directory,
+    force=False,
+    jobs=2,
+    results_file=None,
+    output_limit=OUTPUT_LIMIT,
+):
+    """
+    Run the checks for each student in `students` using a pool of `jobs` worker processes.
+
+    Shell and Python function handlers are run concurrently, each one in its own
+    working directory. The results are merged back into `results` in the order
+    the checks appear in the results tree, regardless of the order the jobs finish in.
+    Manual checks are queued and run serially after all automated checks have finished.
+
+    If `results_file` is given, results are saved after the automated checks have
+    been merged and after each manual check, and long command output is written
+    to its artifacts directory.
+    """
+    # each entry is (key,check,directory,ctx). the key is a tuple of indices
+    # that sorts entries into the same order as a serial run would visit them.
+    skipped = []
+    manual = []
+    finished = []
+    pending = {}
+    cache = results.result_cache
+
+    def schedule(pool, list_of_checks, key, ctx, force):
+        for i in range(len(list_of_checks)):
+            check = list_of_checks[i]
+            if tag is not None and check.get("tag", "NO-TAG") != tag:
+                continue
+            check_dir = get_check_directory(check, ctx, results)
+            entry = (key + (i,), check, check_dir, ctx)
+            if not force and check["result"] is not None:
+                skipped.append(entry)
+                if check["result"] is False and "secondary_checks" in check:
+                    schedule_secondary_checks(pool, entry)
+            elif check.get("handler", "manual") == "manual":
+                manual.append(entry)
+            else:
+                with execution_context(check_dir):
+                    cache_key = get_cache_key(check, ctx, cache)
+                ret = cache.get(cache_key) if cache is not None else None
+                if ret is not None:
+                    check_name = f"{ctx['student_name']}>{check['tag']}: {check['desc']}"
+                    log = f"CACHED - inputs for {check_name} have not changed since it was last ran.\n"
+                    finish(pool, entry, ret, log)
+                    continue
+                job = CheckJob(entry[0], check, check_dir, ctx, get_output_log(check, ctx))
+                pending[pool.submit(_run_check_job, job)] = (entry, cache_key)
+
+    def finish(pool, entry, ret, log):
+        finished.append((entry, ret, log))
+        # secondary checks depend on the result of their primary check,
+        # so they can only be scheduled once it has finished.
+        check = entry[1]
+        if ret["result"] is False and "secondary_checks" in check:
+            schedule_secondary_checks(pool, entry)
+
+    def schedule_secondary_checks(pool, entry):
+        key, check, check_dir, ctx = entry
+        schedule(pool, check["secondary_checks/checks"], key, ctx, False)
+
+    with ProcessPoolExecutor(
+        max_workers=jobs, initializer=_init_check_worker, initargs=(list(sys.path),)
+    ) as pool:
+        for s, student_name in enumerate(students):
+            ctx = make_student_context(
+                results, student_name, workspace_directory, output_limit, results_file
+            )
+            schedule(pool, results.data[student_name]["checks"], (s,), ctx, force)
+
+        while len(pending) > 0:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                entry, cache_key = pending.pop(future)
+                try:
+                    ret, log = future.result()
+                except Exception as e:
+                    ret = {"result": None, "notes": [f"Worker process failed: {e}"]}
+                    log = ""
+                if cache is not None:
+                    cache.put(cache_key, ret)
+                finish(pool, entry, ret, log)
+
+    merge_check_results(results, skipped, finished, results_file)
+    run_deferred_checks(results, manual, tag, results_file)
@@ -0,0 +1,132 @@
+import pathlib
+
+import fspathtree as ft
+
+from .journal import ResultsJournal
+from .utils import load_yaml, dump_yaml
+
+
+class ShardedResults(dict):
+    '''
+    A mapping of student names to their results that are stored in one file
+    per student (a shard) and only loaded when they are accessed.
+
+    The results file holds a small manifest listing the shard for each student:
+
+    results_shards:
+      jdoe: HW-01-results.yml.shards/jdoe.yml
+      rshackleford: HW-01-results.yml.shards/rshackleford.yml
+
+    Shard paths are relative to the manifest. Each shard is a regular results
+    file with a single student in it. When the results are saved, only the
+    shards that were loaded and have changed are written. Top-level keys that
+    are not students (i.e. `working_directory`) are kept in the manifest.
+    '''
+
+    manifest_key = "results_shards"
+
+    # placeholder for shards that have not been loaded yet
+    NOT_LOADED = object()
+
+    def __init__(self, manifest_file: pathlib.Path, shards=None, journal_records=None, inline=None):
+        super().__init__()
+        self.manifest_file = pathlib.Path(manifest_file)
+        self.files = {}
+        # the text each shard was loaded from, so that unchanged shards are not rewritten.
+        self.loaded_text = {}
+        # journal records that have not been applied yet, keyed by student name.
+        self.journal_records = journal_records if journal_records is not None else {}
+        for name, file in (shards or {}).items():
+            self.files[name] = file
+            dict.__setitem__(self, name, self.NOT_LOADED)
+        for name, value in (inline or {}).items():
+            dict.__setitem__(self, name, value)
+
+    @staticmethod
+    def is_manifest(tree):
+        return isinstance(tree, dict) and ShardedResults.manifest_key in tree
+
+    @staticmethod
+    def shard_directory(manifest_file: pathlib.Path):
+        manifest_file = pathlib.Path(manifest_file)
+        return manifest_file.with_name(manifest_file.name + ".shards")
+
+    def shard_path(self, name):
+        return self.manifest_file.parent / self.files[name]
+
+    def is_loaded(self, name):
+        return dict.__getitem__(self, name) is not self.NOT_LOADED
+
+    def load_shard(self, name):
+        text = self.shard_path(name).read_text()
+        tree = load_yaml(text) or {}
+        value = tree.get(name, {})
+        dict.__setitem__(self, name, value)
+        self.loaded_text[name] = text
+        records = self.journal_records.pop(name, None)
+        if records is not None:
+            ResultsJournal.apply(records, ft.fspathtree({name: value}))
+        return value
+
+    def __getitem__(self, name):
+        value = dict.__getitem__(self, name)
+        if value is self.NOT_LOADED:
+            value = self.load_shard(name)
+        return value
+
+    def __setitem__(self, name, value):
+        if not isinstance(value, dict):
+            # not a student, it is stored in the manifest.
+            self.files.pop(name, None)
+            dict.__setitem__(self, name, value)
+            return
+        if name not in self.files:
+            self.files[name] = f"{self.shard_directory(self.manifest_file).name}/{name}.yml"
+        dict.__setitem__(self, name, value)
+
+    def __delitem__(self, name):
+        dict.__delitem__(self, name)
+        self.files.pop(name, None)
+
+    def get(self, name, default=None):
+        if name in self:
+            return self[name]
+        return default
+
+    def values(self):
+        return [self[name] for name in self]
+
+    def items(self):
+        return [(name, self[name]) for name in self]
+
+    def students(self):
+        return [name for name in self if name in self.files]
+
+    def manifest(self):
+        manifest = {name: dict.__getitem__(self, name) for name in self if name not in self.files}
+        manifest[self.manifest_key] = {name: str(self.files[name]) for name in self.students()}
+        return manifest
+
+    def dump(self):
+        '''
+        Write the manifest and every loaded shard that has changed.
+        '''
+        # shards with journal records that were never loaded need to be written
+        # too, the journal is removed after the results are saved.
+        for name in list(self.journal_records):
+            if name in self:
+                self[name]
+        for name in self.students():
+            if not self.is_loaded(name):
+                continue
+            text = dump_yaml({name: dict.__getitem__(self, name)}, sort_keys=False)
+            if self.loaded_text.get(name, None) == text:
+                continue
+            path = self.shard_path(name)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(text)
+            self.loaded_text[name] = text
+
+        text = dump_yaml(self.manifest(), sort_keys=False)
+        if not self.manifest_file.exists() or self.manifest_file.read_text() != text:
+            self.manifest_file.write_text(text)
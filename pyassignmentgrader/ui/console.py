@@ -4,10 +4,13 @@ import os
 import yaml
 import pprint
 import pathlib
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from enum import Enum
 from ..handlers.python_function import *
-from ..utils import ShellCheck, DirStack, get_working_directory_for_node
+from ..utils import OUTPUT_LIMIT, ShellCheck, ExecutionContext, FilePreview, execution_context, dump_yaml, get_resource_limits, kill_process_group, track_process_groups
 
 
 
@@ -18,11 +21,25 @@ class GradingItemController:
         CLEAR = 3
         DO_NOT_CHANGE = 4
 
-    def __init__(self, results, check_paths):
+    def __init__(
+        self,
+        results,
+        check_paths,
+        results_file=None,
+        handler_workers=3,
+        prefetch=2,
+        prefetch_max_age=300,
+        display_page_lines=200,
+        output_limit=OUTPUT_LIMIT,
+    ):
         self.results = results
         self.check_paths = check_paths
+        self.results_file = results_file
+        # the number of bytes of shell command output kept, for checks that do not set `output_limit`.
+        self.output_limit = output_limit
 
         self.root_working_directory = pathlib.Path(self.results.data.get("working_directory", ".")).absolute()
+        self.current_directory = ExecutionContext(self.root_working_directory)
 
         self.view = GradingItemView()
         self.view.ResultSelectButtons[0].set_label("PASS")
@@ -40,6 +57,7 @@ class GradingItemController:
         self.view.save_imp = self.action_save
         self.view.result_action_changed_imp = self.action_result_action_changed
         self.view.pull_from_handler_imp = self.action_pull_from_handler
+        self.view.show_more_imp = self.action_show_more
         self.view.quit_imp = self.action_quit
 
         self.InfoText = self.view.InfoText
@@ -50,13 +68,68 @@ class GradingItemController:
         self.current_check = None
         self.current_handler = None
         self.current_handler_output = None
+        # the lines of file previews in the handler's display that have been paged
+        # in so far, keyed by display key. each entry is a (text, offset) tuple.
+        self.display_pages = {}
+        self.display_pages_output = None
+        self.display_page_lines = display_page_lines
+
+        # handlers are run synchronously until the controller is attached to a main loop.
+        self.handler_workers = handler_workers
+        self.handler_executor = None
+        self.handler_running = False
+        # handler runs (current and prefetched), keyed by (check path, handler spec).
+        # each entry is a (start time, future) tuple.
+        self.handler_cache = {}
+        self.current_handler_key = None
+        # the number of upcoming checks to run handlers for, and the number of
+        # seconds a cached output is used for.
+        self.prefetch = prefetch
+        self.prefetch_max_age = prefetch_max_age
+        self.finished_handlers = queue.SimpleQueue()
+        # the process groups of the shell commands handlers are running.
+        self.running_process_groups = set()
+        self.loop = None
+        self.watch_pipe_fd = None
+
+        # the live score for the student being graded. only the students with
+        # checks that changed are scored again.
+        self.score_error = None
+        self.update_score()
 
         self.result_action = self.ResultAction.DO_NOT_CHANGE
         self.update_info_text()
 
+    def attach(self, loop):
+        '''
+        Run handlers in a background thread pool, delivering their output through
+        a pipe watched by the urwid main loop so that slow handlers do not
+        block the interface.
+        '''
+        self.loop = loop
+        self.handler_executor = ThreadPoolExecutor(max_workers=self.handler_workers)
+        self.watch_pipe_fd = loop.watch_pipe(self.deliver_handler_output)
+
+    def detach(self, timeout=5):
+        '''
+        Stop running handlers in the background. Handlers that have not started
+        are cancelled and the shell commands of running handlers are killed.
+        Waits at most `timeout` seconds for the running handlers to return.
+        '''
+        if self.handler_executor is not None:
+            self.handler_executor.shutdown(wait=False, cancel_futures=True)
+            for pid in list(self.running_process_groups):
+                kill_process_group(pid)
+            # wait() never returns for futures cancelled before they were started.
+            wait([future for start, future in self.handler_cache.values() if not future.done()], timeout)
+            self.handler_executor = None
+        if self.watch_pipe_fd is not None:
+            self.loop.remove_watch_pipe(self.watch_pipe_fd)
+            self.watch_pipe_fd = None
+        self.loop = None
 
     def action_quit(self):
-        pass
+        self.detach()
 
     def action_result_action_changed(self, btn, state):
         if state:
@@ -69,14 +142,52 @@ class GradingItemController:
             self.current_check["notes"] = copy.copy(
                 self.current_handler_output["notes"]
             )
+            self.results.mark_changed(self.current_check)
+            self.update_score()
             self.setup_current_check()
 
+    def action_show_more(self, btn):
+        '''
+        Read the next page of each file preview in the current handler output.
+        '''
+        if not self.current_handler_output or "display" not in self.current_handler_output:
+            return
+        self.sync_display_pages()
+        for key, value in self.current_handler_output["display"].items():
+            if not isinstance(value, FilePreview):
+                continue
+            text, offset = self.display_pages.get(key, ("", None))
+            try:
+                page, offset = value.page(offset, self.display_page_lines)
+            except Exception as e:
+                self.ErrorText.set_text(f"Could not read '{value.path}': {e}")
+                continue
+            self.display_pages[key] = (text + page, offset)
+        self.update_info_text()
+
+    def sync_display_pages(self):
+        # pages belong to the handler output they were read for.
+        if self.display_pages_output is not self.current_handler_output:
+            self.display_pages = {}
+            self.display_pages_output = self.current_handler_output
+
+    def get_display_text(self, key, value):
+        if not isinstance(value, FilePreview):
+            return str(value)
+        if key in self.display_pages:
+            return value.render(*self.display_pages[key])
+        return str(value)
+
     def action_save(self, btn):
         self.save_current_check()
+        if self.results_file is not None:
+            # only the journal is written here. the results file is written on exit.
+            self.results.checkpoint(self.results_file)
         self.setup_current_check()
 
     def save_current_check(self):
         if self.current_check:
+            self.handler_cache.pop(self.get_handler_key(self.current_check), None)
             self.current_check["notes"] = self.NotesText.get_edit_text().split("\n")
             if self.result_action == self.ResultAction.PASS:
                 self.current_check["result"] = True
@@ -84,6 +195,36 @@ class GradingItemController:
                 self.current_check["result"] = False
             if self.result_action == self.ResultAction.CLEAR:
                 self.current_check["result"] = None
+            self.results.mark_changed(self.current_check)
+            self.update_score()
+
+    def get_students(self):
+        '''
+        Return the names of the students being graded, in the order of their first check.
+        '''
+        return list(dict.fromkeys(path.parts[1] for path in self.check_paths))
+
+    def update_score(self):
+        '''
+        Score the students whose checks have changed since the last update.
+        '''
+        try:
+            if self.results.check_table is None:
+                self.results.score(students=self.get_students())
+            else:
+                self.results.rescore()
+            self.score_error = None
+        except Exception as e:
+            self.score_error = str(e)
+
+    def get_score_text(self, student_name):
+        if self.score_error is not None:
+            return ("emph2", f"could not score ({self.score_error})")
+        available = self.results.data.get(f"{student_name}/available", None)
+        awarded = self.results.data.get(f"{student_name}/awarded", None)
+        if available is None or awarded is None or available == 0:
+            return ("emph2", "not scored")
+        return ("good", f"{awarded:.4g}/{available:.4g} ({awarded/available*100:.2f}%)")
 
     def action_goto_next(self, btn):
         self.increment_current_check()
@@ -150,36 +291,169 @@ class GradingItemController:
             if btn.action == self.ResultAction.DO_NOT_CHANGE:
                 btn.toggle_state()
 
-        os.chdir(self.root_working_directory)
+        self.current_directory = ExecutionContext(self.root_working_directory)
+        self.current_handler_key = None
+        self.handler_running = False
         if self.current_check:
-            wd = self.root_working_directory/get_working_directory_for_node(self.current_check)
-            try:
-                os.chdir(wd)
-            except:
-                self.ErrorText.set_text(f"Could not cd into directory '{wd}'")
+            self.current_directory = self.get_check_directory(self.current_check)
+            if self.current_directory is None:
+                wd = self.root_working_directory/self.results.get_working_directory(self.current_check)
+                self.ErrorText.set_text(f"Could not find directory '{wd}'")
+                self.current_directory = ExecutionContext(self.root_working_directory)
 
-            handler = self.current_check["handler"]
             self.current_handler_output = None
-            if handler == "manual":
-                pass
-            elif ":" in handler:
-                func = handler
-                handler = PythonFunctionHandler(func, {})
-                self.current_handler_output = handler.yield_next()
-            else:
-                cmd = handler
-                cwd = self.current_check.get("working_directory", ".")
-                handler = PythonFunctionHandler(
-                    f"pyassignmentgrader.utils:ShellCheck(cmd='{cmd}')", {}
-                )
-                self.current_handler_output = handler.yield_next()
+            handler = self.make_handler(self.current_check, self.current_directory)
+            if handler is not None:
+                self.start_handler(self.current_check, handler, self.current_directory)
 
             self.update_notes_text()
-        else:
-            wd = self.root_working_directory
-            os.chdir(wd)
+        self.prefetch_handlers()
         self.update_info_text()
 
+    def get_check_directory(self, check):
+        '''
+        Return the execution context for the directory a check runs in, or None if it does not exist.
+        '''
+        wd = self.root_working_directory/self.results.get_working_directory(check)
+        if wd.is_dir():
+            return ExecutionContext(wd)
+        return None
+
+    def get_handler_key(self, check):
+        return (str(check.path()), check["handler"])
+
+    def make_handler(self, check, directory):
+        '''
+        Create the handler for a check. Returns None for manual checks.
+        '''
+        handler = check["handler"]
+        ctx = {"working_directory": directory}
+        if handler == "manual":
+            return None
+        if ":" in handler:
+            return PythonFunctionHandler(handler, ctx)
+        # shell commands are run with the same limits the runner uses.
+        ctx["output_limit"] = check.get("output_limit", self.output_limit)
+        ctx.update(get_resource_limits(check))
+        cmd = handler
+        return PythonFunctionHandler(
+            f"pyassignmentgrader.utils:ShellCheck(cmd='{cmd}',cwd=ctx['working_directory'],output_limit=ctx['output_limit'],timeout=ctx['timeout'],max_memory=ctx['max_memory'],max_cpu_seconds=ctx['max_cpu_seconds'])", ctx
+        )
+
+    def submit_handler(self, key, handler, directory):
+        def run():
+            # handlers are run in the execution context for the check's directory
+            # instead of changing the process working directory.
+            with execution_context(directory), track_process_groups(self.running_process_groups):
+                return handler.yield_next()
+
+        if self.handler_executor is None:
+            return run()
+
+        def finished(future):
+            # called from the worker thread, the output is handed to the main loop.
+            if future.cancelled() or self.watch_pipe_fd is None:
+                return
+            self.finished_handlers.put(key)
+            try:
+                os.write(self.watch_pipe_fd, b"\n")
+            except OSError:
+                # the controller was detached while we were finishing.
+                pass
+
+        future = self.handler_executor.submit(run)
+        self.handler_cache[key] = (time.monotonic(), future)
+        future.add_done_callback(finished)
+        return future
+
+    def start_handler(self, check, handler, directory):
+        '''
+        Run the handler for the current check, or reuse the output of a prefetched run.
+        '''
+        key = self.get_handler_key(check)
+        self.current_handler_key = key
+        if self.handler_executor is None:
+            try:
+                self.current_handler_output = self.submit_handler(key, handler, directory)
+            except Exception as e:
+                self.ErrorText.set_text(f"Handler raised an exception: {e}")
+            return
+
+        self.evict_handler_cache()
+        if key in self.handler_cache:
+            future = self.handler_cache[key][1]
+        else:
+            future = self.submit_handler(key, handler, directory)
+        if future.done():
+            self.show_handler_output(future)
+        else:
+            self.handler_running = True
+
+    def prefetch_handlers(self):
+        '''
+        Start the handlers for the next few checks so that their output is
+        ready when we get to them. Prefetched runs for checks we have moved
+        away from are cancelled if they have not started yet.
+        '''
+        if self.handler_executor is None:
+            return
+        begin = max(self.current_check_path_index, 0)
+        end = min(begin + 1 + self.prefetch, len(self.check_paths))
+        keys = set()
+        for i in range(begin, end):
+            check = self.results.data[self.check_paths[i]]
+            key = self.get_handler_key(check)
+            keys.add(key)
+            if key in self.handler_cache or check["handler"] == "manual":
+                continue
+            directory = self.get_check_directory(check)
+            if directory is None:
+                continue
+            try:
+                handler = self.make_handler(check, directory)
+            except Exception:
+                # errors will be reported when we get to the check.
+                continue
+            self.submit_handler(key, handler, directory)
+
+        for key in list(self.handler_cache):
+            if key not in keys and self.handler_cache[key][1].cancel():
+                del self.handler_cache[key]
+
+    def evict_handler_cache(self):
+        '''
+        Remove finished handler runs that are older than prefetch_max_age.
+        '''
+        now = time.monotonic()
+        for key in list(self.handler_cache):
+            start, future = self.handler_cache[key]
+            if future.done() and now - start > self.prefetch_max_age:
+                del self.handler_cache[key]
+
+    def show_handler_output(self, future):
+        self.handler_running = False
+        try:
+            self.current_handler_output = future.result()
+        except Exception as e:
+            self.current_handler_output = None
+            self.ErrorText.set_text(f"Handler raised an exception: {e}")
+
+    def deliver_handler_output(self, data=None):
+        '''
+        Called by the main loop when a handler finishes.
+        '''
+        while True:
+            try:
+                key = self.finished_handlers.get_nowait()
+            except queue.Empty:
+                break
+            if key != self.current_handler_key or key not in self.handler_cache:
+                continue
+            self.show_handler_output(self.handler_cache[key][1])
+            self.update_info_text()
+        # keep watching the pipe
+        return True
+
     def update_notes_text(self):
         lines = self.current_check["notes"]
         self.NotesText.set_edit_text("\n".join(lines))
@@ -200,6 +474,9 @@ class GradingItemController:
         lines.append(("default", "Student: "))
         lines.append(("good", student_name))
         lines.append("\n")
+        lines.append(("default", "Score: "))
+        lines.append(self.get_score_text(student_name))
+        lines.append("\n")
         lines.append("\n")
         lines.append(("default", "========="))
         lines.append("\n")
@@ -229,12 +506,14 @@ class GradingItemController:
                 self.current_check["handler"],
             )
         )
+        if self.handler_running:
+            lines.append(("emph2", " (running...)"))
         lines.append("\n")
         lines.append("RWD: ")
         lines.append(str(self.root_working_directory))
         lines.append("\n")
         lines.append("CWD: ")
-        lines.append(str(pathlib.Path().absolute().relative_to(self.root_working_directory)))
+        lines.append(str(self.current_directory.path.relative_to(self.root_working_directory)))
         lines.append("\n")
         lines.append("\n")
         if self.current_handler_output:
@@ -251,11 +530,19 @@ class GradingItemController:
                     lines.append("\n")
                 lines.append("\n")
             if "display" in self.current_handler_output:
-                for key in self.current_handler_output["display"]:
+                self.sync_display_pages()
+                more = False
+                for key, value in self.current_handler_output["display"].items():
                     lines.append(('emph1',key))
                     lines.append(": ")
-                    lines.append(('emph2',str(self.current_handler_output["display"][key])))
+                    lines.append(('emph2',self.get_display_text(key, value)))
+                    if isinstance(value, FilePreview):
+                        offset = self.display_pages.get(key, ("", value.head_end))[1]
+                        more = more or offset < value.tail_start
                 lines.append("\n")
+                if more:
+                    lines.append(('emph3', "(press 'm' to show more)"))
+                    lines.append("\n")
                 lines.append("\n")
 
         lines.append(("default", "========="))
@@ -264,7 +551,7 @@ class GradingItemController:
 
         lines.append("Current Check:")
         lines.append("\n")
-        lines.append(yaml.safe_dump(self.current_check.tree))
+        lines.append(dump_yaml(self.current_check.tree))
         lines.append("\n")
         lines.append("\n")
 
@@ -348,6 +635,9 @@ class GradingItemView:
     def pull_from_handler(self, *args, **kwargs):
         self.pull_from_handler_imp(*args, **kwargs)
 
+    def show_more(self, *args, **kwargs):
+        self.show_more_imp(*args, **kwargs)
+
     def quit(self, *args, **kwargs):
         self.quit_imp(*args, **kwargs)
         raise urwid.ExitMainLoop()
@@ -409,6 +699,7 @@ class GradingItemView:
         man_lines.append("  p           - goto previous grading item")
         man_lines.append("  N           - goto next ungraded grading item")
         man_lines.append("  P           - goto previous ungraded grading item")
+        man_lines.append("  m           - show more of the files in the handler output")
         man_lines.append("  Space/Enter - select")
         man_lines.append("")
         man_lines.append("Commands:")
@@ -524,6 +815,8 @@ class GradingItemView:
             self.goto_prev_ungraded(None)
         if key in ["U"]:
             self.pull_from_handler(None)
+        if key in ["m"]:
+            self.show_more(None)
 
     def get_palette(self):
         palette = [
@@ -1,13 +1,100 @@
+import codecs
+import collections
+import collections.abc
 import contextlib
+import contextvars
 import os
 import copy
-from pathlib import Path
+import difflib
+import mmap
+import pickle
+import select
+import shlex
+import signal
+import threading
+import time
+from pathlib import Path, PurePosixPath
 import subprocess
+import yaml
 from fspathtree import fspathtree
 
+try:
+    import resource
+except ImportError:
+    # not available on Windows. resource limits are ignored.
+    resource = None
+
+# use the LibYAML bindings if PyYAML was built with them, they are
+# many times faster than the pure-Python loader and dumper.
+try:
+    from yaml import CSafeLoader as YamlLoader, CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeLoader as YamlLoader, SafeDumper as YamlDumper
+
+
+# the composer is needed to build one node at a time. the C parser does not expose
+# its composer, so we pair it with the pure-Python one.
+try:
+    from yaml._yaml import CParser
+    class YamlStreamingLoader(CParser, yaml.composer.Composer, yaml.constructor.SafeConstructor, yaml.resolver.Resolver):
+        def __init__(self, stream):
+            CParser.__init__(self, stream)
+            yaml.composer.Composer.__init__(self)
+            yaml.constructor.SafeConstructor.__init__(self)
+            yaml.resolver.Resolver.__init__(self)
+except ImportError:
+    YamlStreamingLoader = yaml.SafeLoader
+
+
+def load_yaml(text):
+    '''
+    Load YAML text (or a file handle) with the fastest available safe loader.
+    '''
+    return yaml.load(text, Loader=YamlLoader)
+
+def dump_yaml(data, stream=None, **kwargs):
+    '''
+    Dump data to YAML with the fastest available safe dumper.
+    '''
+    return yaml.dump(data, stream, Dumper=YamlDumper, **kwargs)
+
+
+def iter_yaml_items(stream):
+    '''
+    Iterate over the (key, value) pairs of the top level mapping of each document in a YAML stream.
+
+    Only one value is composed and constructed at a time, so memory use depends on
+    the size of the largest value, not the size of the stream.
+    '''
+    loader = YamlStreamingLoader(stream)
+    try:
+        loader.get_event()
+        while not loader.check_event(yaml.StreamEndEvent):
+            loader.get_event()
+            if loader.check_event(yaml.MappingStartEvent):
+                loader.get_event()
+                while not loader.check_event(yaml.MappingEndEvent):
+                    key = loader.compose_node(None, None)
+                    value = loader.compose_node(key, None)
+                    yield loader.construct_object(key, deep=True), loader.construct_object(value, deep=True)
+                    loader.constructed_objects = {}
+                loader.get_event()
+            else:
+                loader.compose_node(None, None)
+            loader.get_event()
+            loader.anchors = {}
+    finally:
+        loader.dispose()
+
 
 @contextlib.contextmanager
 def working_dir(new_dir: Path):
+    '''
+    Change the working directory of the _process_ to new_dir.
+
+    This affects every thread, so the grader uses `execution_context(...)`
+    to run checks instead.
+    '''
     old_dir = Path().absolute()
     new_dir = new_dir.absolute()
     try:
@@ -17,6 +104,9 @@ def working_dir(new_dir: Path):
         os.chdir(old_dir)
 
 class DirStack:
+    '''
+    A stack of process working directories (see `working_dir(...)`).
+    '''
     def __init__(self):
         self.dirs = []
 
@@ -31,6 +121,81 @@ class DirStack:
             path = self.dirs.pop()
             os.chdir(path)
 
+class ExecutionContext:
+    '''
+    The resolved directory that a check runs in.
+
+    Rather than changing the process working directory, relative paths
+    are resolved against `path` explicitly. An ExecutionContext can
+    be passed anywhere a path is expected (i.e. as `cwd=` to subprocess.run).
+    '''
+    def __init__(self, directory='.', parent=None):
+        base = parent.path if parent is not None else Path().absolute()
+        self.path = base/directory
+
+    def resolve(self, path):
+        return self.path/path
+
+    def enter(self, directory):
+        return ExecutionContext(directory, self)
+
+    def __truediv__(self, path):
+        return self.resolve(path)
+
+    def __fspath__(self):
+        return str(self.path)
+
+    def __str__(self):
+        return str(self.path)
+
+    def __repr__(self):
+        return f"ExecutionContext('{self.path}')"
+
+    def __eq__(self, other):
+        if isinstance(other, ExecutionContext):
+            return self.path == other.path
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.path)
+
+
+# the execution context is stored in a context variable, so each thread (and asyncio task)
+# sees its own directory.
+_current_execution_context = contextvars.ContextVar("current_execution_context", default=None)
+
+def get_execution_context():
+    '''
+    Return the current execution context. If no context has been entered, the context
+    for the process working directory is returned.
+    '''
+    ctx = _current_execution_context.get()
+    if ctx is None:
+        ctx = ExecutionContext()
+    return ctx
+
+@contextlib.contextmanager
+def execution_context(directory):
+    '''
+    Enter the execution context for `directory`. A relative directory is
+    resolved against the current execution context, so nesting works the
+    same way as nested calls to `working_dir(...)`, but the process working
+    directory is never changed.
+    '''
+    if not isinstance(directory, ExecutionContext):
+        directory = get_execution_context().enter(directory)
+    token = _current_execution_context.set(directory)
+    try:
+        yield directory
+    finally:
+        _current_execution_context.reset(token)
+
+def resolve_path(path):
+    '''
+    Resolve `path` against the current execution context.
+    '''
+    return get_execution_context().resolve(path)
+
 def get_working_directory_for_node(node:fspathtree):
     '''
     Get the path for a working directory of a node
@@ -55,6 +220,97 @@ def get_working_directory_for_node(node:fspathtree):
         working_directories.append(node['working_directory'])
     return "/".join(working_directories)
 
+class WorkingDirectoryMap:
+    '''
+    A map from the path of each branch node in a tree to its working directory,
+    i.e. what get_working_directory_for_node returns for the node.
+
+    The map is built one top level node (i.e. student) at a time, the first time
+    a path under it is looked up, by walking down from the top level node
+    once. Call `update(node)` after changing a node's `working_directory` key,
+    or `invalidate()` after changing the tree's structure.
+    '''
+    def __init__(self, tree:fspathtree):
+        self.tree = tree.tree
+        # the map for each top level node. each entry maps a path to a tuple
+        # (the node's own working directory, the working directories from the
+        # top of the tree down to the node).
+        self.nodes = {}
+        self.root = self._own_working_directory(self.tree)
+
+    NO_WORKING_DIRECTORY = object()
+
+    @staticmethod
+    def _own_working_directory(node):
+        if isinstance(node, collections.abc.Mapping) and "working_directory" in node:
+            return node["working_directory"]
+        return WorkingDirectoryMap.NO_WORKING_DIRECTORY
+
+    def _build(self, name):
+        entries = {}
+
+        def walk(node, path, components):
+            own = self._own_working_directory(node)
+            if own is not self.NO_WORKING_DIRECTORY:
+                components = components + (own,)
+            entries[path] = (own, components)
+            for key in node.keys() if isinstance(node, collections.abc.Mapping) else range(len(node)):
+                value = node[key]
+                if not fspathtree.is_leaf(value):
+                    walk(value, f"{path}/{key}", components)
+
+        root = () if self.root is self.NO_WORKING_DIRECTORY else (self.root,)
+        walk(self.tree[name], f"/{name}", root)
+        self.nodes[name] = entries
+        return entries
+
+    def components(self, path):
+        '''
+        Return the working directories from the top of the tree down to the node at `path`.
+        '''
+        path = str(path)
+        name = path.split("/")[1] if path != "/" else None
+        if name is None:
+            return () if self.root is self.NO_WORKING_DIRECTORY else (self.root,)
+        entries = self.nodes.get(name, None)
+        if entries is None:
+            entries = self._build(name)
+        return entries[path][1]
+
+    def get(self, path, start=None):
+        '''
+        Return the working directory for the node at `path`. If `start` (the path
+        of an ancestor) is given, the directory is relative to the working
+        directory of `start`.
+        '''
+        components = self.components(path)
+        if start is not None:
+            components = components[len(self.components(start)):]
+        return "/".join(components)
+
+    def update(self, node:fspathtree):
+        '''
+        Invalidate the map for a node's top level node if the node is new or its working directory changed.
+        '''
+        path = str(node.path())
+        if path == "/":
+            if self._own_working_directory(node.tree) != self.root:
+                self.invalidate()
+            return
+        name = path.split("/")[1]
+        entries = self.nodes.get(name, None)
+        if entries is None:
+            return
+        if path not in entries or entries[path][0] != self._own_working_directory(node.tree):
+            self.invalidate(name)
+
+    def invalidate(self, name=None):
+        if name is None:
+            self.nodes.clear()
+            self.root = self._own_working_directory(self.tree)
+        else:
+            self.nodes.pop(name, None)
+
 def get_context_for_node(node:fspathtree):
     '''
     Get the context object for a node in tree.
@@ -90,6 +346,25 @@ checks:
     return ctx
 
 
+def _format_template(template:str, ctx:dict):
+    # most strings in a results tree have no replacement fields (or escaped braces),
+    # formatting would not change them.
+    if "{" in template or "}" in template:
+        return template.format(**ctx)
+    return template
+
+def _render_context(node, ctx:dict):
+    '''
+    Return a copy of a context node with its strings formatted with `ctx`.
+    '''
+    if isinstance(node, collections.abc.Mapping):
+        return {key: _render_context(value, ctx) for key, value in node.items()}
+    if isinstance(node, list):
+        return [_render_context(value, ctx) for value in node]
+    if isinstance(node, str):
+        return _format_template(node, ctx)
+    return copy.deepcopy(node)
+
 def render_tree(tree:fspathtree):
     '''
     Render an fspathree with the tree's context nodes.
@@ -114,17 +389,332 @@ def render_tree(tree:fspathtree):
           context:
             file: file.txt
 
-
+    The tree is rendered in a single top-down pass. The context for each
+    branch node is built once from its parent's context and shared by all of
+    its children, instead of being rebuilt with get_context_for_node() for
+    every leaf. The output is the same, including for context values that
+    are themselves rendered, which are rebuilt when they change.
     '''
+    if tree.path() == tree.path().parent:
+        base = {}
+    else:
+        base = get_context_for_node(tree[tree.path().parent])
+
+    # the branch nodes from the top of the tree down to the node being
+    # rendered, their contexts (None until they are needed), and the keys
+    # leading to each node below the top.
+    stack = []
+    contexts = []
+    keys = []
 
-    for key in tree.get_all_leaf_node_paths():
-        ctx = get_context_for_node( tree[key.parts[:-1] ] )
-        if isinstance(tree[key], (str)):
-            tree[key] = tree[key].format(**ctx)
+    def current_context():
+        for i in range(len(stack)):
+            if contexts[i] is None:
+                parent = contexts[i-1] if i > 0 else base
+                node = stack[i]
+                ctx = parent
+                if isinstance(node, collections.abc.Mapping) and "context" in node:
+                    ctx = dict(parent)
+                    ctx.update(_render_context(node["context"], parent))
+                contexts[i] = ctx
+        return contexts[-1]
 
+    def render(node):
+        stack.append(node)
+        contexts.append(None)
+        for key in node.keys() if isinstance(node, collections.abc.Mapping) else range(len(node)):
+            value = node[key]
+            if not fspathtree.is_leaf(value):
+                keys.append(key)
+                render(value)
+                keys.pop()
+                continue
+            ctx = current_context()
+            if isinstance(value, str):
+                node[key] = _format_template(value, ctx)
+                if node[key] != value and "context" in keys:
+                    # a context value changed, the contexts built from it
+                    # (from the node that owns it down) need to be built again.
+                    for i in range(keys.index("context"), len(contexts)):
+                        contexts[i] = None
+        stack.pop()
+        contexts.pop()
+
+    render(tree.tree)
 
     return tree
 
+# the number of bytes of command output kept in the results for each check.
+OUTPUT_LIMIT = 64*1024
+
+class OutputCapture:
+    '''
+    Collect command output as it is read, keeping the first and last `limit`/2
+    bytes of it in memory. The retained bytes are decoded by `text()`.
+
+    If `log_file` is given, the complete output is written to it as it is
+    read. The log file is removed on close if the output fit in the limit.
+    '''
+    def __init__(self, limit=OUTPUT_LIMIT, log_file=None):
+        self.limit = limit
+        self.head_limit = limit // 2
+        self.tail_limit = limit - self.head_limit
+        self.head = bytearray()
+        self.tail = collections.deque()
+        self.tail_size = 0
+        self.size = 0
+        self.log_file = Path(log_file) if log_file is not None else None
+        self.log = None
+        if self.log_file is not None:
+            self.log_file.parent.mkdir(parents=True, exist_ok=True)
+            self.log = self.log_file.open("wb")
+
+    def feed(self, data:bytes):
+        self.size += len(data)
+        if self.log is not None:
+            self.log.write(data)
+        if len(self.head) < self.head_limit:
+            n = self.head_limit - len(self.head)
+            self.head += data[:n]
+            data = data[n:]
+        if len(data) == 0:
+            return
+        self.tail.append(data)
+        self.tail_size += len(data)
+        # drop whole chunks that are no longer needed
+        while self.tail_size - len(self.tail[0]) >= self.tail_limit:
+            self.tail_size -= len(self.tail.popleft())
+
+    @property
+    def truncated(self):
+        return self.size > self.limit
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+            if not self.truncated:
+                self.log_file.unlink()
+                self.log_file = None
+
+    def text(self):
+        '''
+        Return the retained output as text. If output was dropped, a line saying
+        how much (and where the full output is) is put between the head and the tail.
+        '''
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        if not self.truncated:
+            return decoder.decode(bytes(self.head) + b"".join(self.tail), final=True)
+        tail = b"".join(self.tail)[-self.tail_limit:]
+        text = decoder.decode(bytes(self.head), final=True)
+        text += f"\n... {self.size - len(self.head) - len(tail)} bytes of output omitted"
+        if self.log_file is not None:
+            text += f", full output in '{self.log_file}'"
+        text += " ...\n"
+        decoder.reset()
+        text += decoder.decode(tail, final=True)
+        return text
+
+
+class ResourceLimitError(RuntimeError):
+    pass
+
+
+def parse_size(size):
+    '''
+    Parse a size in bytes. Strings can have a K, M, or G suffix (e.g. '512M').
+    '''
+    if size is None or isinstance(size, (int, float)):
+        return size
+    size = str(size).strip().upper().rstrip("B")
+    for suffix, factor in (("K", 1024), ("M", 1024**2), ("G", 1024**3)):
+        if size.endswith(suffix):
+            return int(float(size[:-1]) * factor)
+    return int(size)
+
+
+def get_resource_limits(node):
+    '''
+    Return the timeout, max_memory, and max_cpu_seconds keys of a check as a dict.
+    '''
+    return {
+        "timeout": node.get("timeout", None),
+        "max_memory": parse_size(node.get("max_memory", None)),
+        "max_cpu_seconds": node.get("max_cpu_seconds", None),
+    }
+
+
+def set_resource_limits(max_memory=None, max_cpu_seconds=None):
+    '''
+    Limit the address space and CPU time of the current process. This is meant
+    to be called in a child process before it runs a handler.
+    '''
+    if resource is None:
+        return
+    if max_memory is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (int(max_memory), int(max_memory)))
+    if max_cpu_seconds is not None:
+        seconds = int(max_cpu_seconds)
+        # the hard limit is a little higher so that the process gets SIGXCPU before SIGKILL.
+        resource.setrlimit(resource.RLIMIT_CPU, (seconds, seconds + 1))
+
+
+def limit_command(cmd, max_memory=None, max_cpu_seconds=None):
+    '''
+    Return a shell command that runs `cmd` with the given resource limits.
+
+    The limits are set with the shell's `ulimit` builtin before `cmd` is started,
+    instead of in a `preexec_fn`, which is not safe to use while other threads
+    are running. If the limits cannot be set, `cmd` is not run.
+    '''
+    if resource is None or (max_memory is None and max_cpu_seconds is None):
+        return cmd
+    limits = []
+    if max_memory is not None:
+        limits.append(f"ulimit -v {max(int(max_memory) // 1024, 1)}")
+    if max_cpu_seconds is not None:
+        seconds = int(max_cpu_seconds)
+        # the hard limit is a little higher so that the process gets SIGXCPU before SIGKILL.
+        # the soft limit is set first, it can not be higher than the hard limit.
+        limits.append(f"ulimit -S -t {seconds}")
+        limits.append(f"ulimit -H -t {seconds + 1}")
+    return " && ".join(limits + [f"exec /bin/sh -c {shlex.quote(cmd)}"])
+
+
+def kill_process_group(pid):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def killed_by_resource_limit(returncode):
+    '''
+    Return True if a return code (from a process or from a shell running it) means the
+    process was killed for using too much CPU time.
+    '''
+    signals = (signal.SIGXCPU, signal.SIGKILL) if hasattr(signal, "SIGXCPU") else (signal.SIGKILL,)
+    return any(returncode in (-s, 128 + s) for s in signals)
+
+
+# the set the process groups started by run_command are added to while they run, if any.
+_process_groups = contextvars.ContextVar("process_groups", default=None)
+
+@contextlib.contextmanager
+def track_process_groups(groups:set):
+    '''
+    Add the process groups of the commands started by run_command in this context to
+    `groups` while they run, so that another thread can kill them with kill_process_group.
+    '''
+    token = _process_groups.set(groups)
+    try:
+        yield groups
+    finally:
+        _process_groups.reset(token)
+
+
+def run_command(cmd, cwd='.', limit=OUTPUT_LIMIT, log_file=None, timeout=None, max_memory=None, max_cpu_seconds=None):
+    '''
+    Run a shell command, streaming its (combined stdout and stderr) output into an OutputCapture.
+
+    The command is run in a new process group with the given resource limits. If it
+    runs longer than `timeout` seconds, the whole process group is killed and
+    subprocess.TimeoutExpired is raised with the capture as its `output`.
+
+    Returns (return code, capture).
+    '''
+    capture = OutputCapture(limit, log_file)
+    try:
+        proc = subprocess.Popen(limit_command(cmd, max_memory, max_cpu_seconds),shell=True,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,cwd=cwd,start_new_session=True)
+    except BaseException:
+        # do not leave an open (and empty) log file behind.
+        capture.close()
+        raise
+    with proc:
+        groups = _process_groups.get()
+        if groups is not None:
+            groups.add(proc.pid)
+        timed_out = threading.Event()
+        def kill():
+            timed_out.set()
+            kill_process_group(proc.pid)
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, kill)
+            timer.start()
+        try:
+            for data in iter(lambda: proc.stdout.read1(1 << 16), b""):
+                capture.feed(data)
+            returncode = proc.wait()
+        finally:
+            capture.close()
+            if timer is not None:
+                timer.cancel()
+            if groups is not None:
+                groups.discard(proc.pid)
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(cmd, timeout, output=capture)
+    return returncode, capture
+
+
+def call_with_limits(func, timeout=None, max_memory=None, max_cpu_seconds=None):
+    '''
+    Call `func` in a forked child process with the given resource limits and return its result.
+
+    The result (or exception) is sent back to the parent with pickle. If the call
+    takes longer than `timeout` seconds, the child's process group is killed and
+    subprocess.TimeoutExpired is raised. If the child dies without returning
+    (e.g. it was killed for exceeding its CPU time), ResourceLimitError is raised.
+    '''
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read_fd)
+            os.setsid()
+            set_resource_limits(max_memory, max_cpu_seconds)
+            try:
+                data = pickle.dumps((True, func()))
+            except BaseException as e:
+                try:
+                    data = pickle.dumps((False, e))
+                except Exception:
+                    data = pickle.dumps((False, RuntimeError(repr(e))))
+            view = memoryview(data)
+            while len(view) > 0:
+                view = view[os.write(write_fd, view):]
+        finally:
+            os._exit(0)
+
+    os.close(write_fd)
+    chunks = []
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    try:
+        while True:
+            wait = None if deadline is None else max(deadline - time.monotonic(), 0)
+            ready, _, _ = select.select([read_fd], [], [], wait)
+            if not ready:
+                kill_process_group(pid)
+                raise subprocess.TimeoutExpired(getattr(func, "__name__", repr(func)), timeout)
+            data = os.read(read_fd, 1 << 16)
+            if data == b"":
+                break
+            chunks.append(data)
+    finally:
+        os.close(read_fd)
+        _, status = os.waitpid(pid, 0)
+        kill_process_group(pid)
+
+    if len(chunks) == 0:
+        raise ResourceLimitError(
+            f"Handler process exited without returning a result (exit status {os.waitstatus_to_exitcode(status)})."
+        )
+    ok, value = pickle.loads(b"".join(chunks))
+    if not ok:
+        raise value
+    return value
+
+
 def hello_world():
     return "Hello World"
 
@@ -134,68 +724,368 @@ def yield_hello_world():
     return
 
 
-def ShellCheck(cmd,cwd='.'):
-
-    result = subprocess.run(cmd,shell=True,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,encoding='utf-8',cwd=cwd)
-    if result.stdout == "":
-        result.stdout = f"command `{cmd}` exited with return code {result.returncode}"
+def ShellCheck(cmd,cwd='.',output_limit=OUTPUT_LIMIT,log_file=None,timeout=None,max_memory=None,max_cpu_seconds=None):
 
     ret = {}
-    ret["result"] = result.returncode == 0
     ret["notes"] = []
+    try:
+        returncode, capture = run_command(cmd,cwd=resolve_path(cwd),limit=output_limit,log_file=log_file,timeout=timeout,max_memory=parse_size(max_memory),max_cpu_seconds=max_cpu_seconds)
+    except subprocess.TimeoutExpired as e:
+        returncode, capture = None, e.output
+        ret["notes"].append(f"Check timed out after {timeout} seconds.")
+    stdout = capture.text()
+    if stdout == "" and returncode is not None:
+        stdout = f"command `{cmd}` exited with return code {returncode}"
+    if max_cpu_seconds is not None and returncode is not None and killed_by_resource_limit(returncode):
+        ret["notes"].append(f"Check was stopped for exceeding its resource limits (max_memory: {max_memory}, max_cpu_seconds: {max_cpu_seconds}).")
+
+    ret["result"] = returncode == 0
     ret["notes"].append("command output:")
-    for line in result.stdout.split("\n"):
+    for line in stdout.split("\n"):
         ret["notes"].append(f"  {line}")
 
 
     return ret
 
 
-def CheckFileExists(filename,cwd,aliases=[]):
-    return CheckFileOrDirExists(filename,cwd,aliases,filetype='file')
-def CheckDirectoryExists(dirname,cwd,aliases=[]):
-    return CheckFileOrDirExists(dirname,cwd,aliases,filetype='dir')
+class DirectoryIndex:
+    '''
+    An index of the entries in a directory, built with os.scandir (once for each
+    subdirectory too if `recursive`).
 
-def CheckFileOrDirExists(filename,cwd,aliases=[],filetype='file'):
-    result = False
-    notes = []
-    with working_dir(Path(cwd)) as wd:
-        if (wd/filename).exists():
-            if filetype == 'file' and (wd/filename).is_file():
-                result = True
-            if filetype == 'dir' and (wd/filename).is_dir():
-                result = True
-            if filetype == 'link' and (wd/filename).is_symlink():
-                result = True
+    Entries are keyed by their path relative to the directory, with '/'
+    separators, and hold the file type information returned by scandir so
+    that looking one up does not need a stat call. The modification time of
+    each scanned directory is kept so that stale indexes can be detected.
+    '''
+    # a directory modified this close to (or after) the scan may be changed
+    # again without its modification time changing (on file systems with
+    # coarse timestamps), so it is scanned again.
+    racy_window = 2*10**9
 
-        if result is False:
-            notes.append(f"Did not find '{filename}' in '{cwd}'.")
-            for alias in aliases:
-                if (wd/alias).exists():
-                    notes.append(f"Found '{alias}' instead, creating a link to expected filename: '{filename}' -> '{alias}'.")
-                    (wd/filename).symlink_to(wd/alias)
-                    result = True
+    def __init__(self, root, recursive=False):
+        self.root = Path(root)
+        self.recursive = recursive
+        # path -> (exists, is_file, is_dir, is_symlink)
+        self.entries = {}
+        # the names in the top-level directory, in the order scandir returned them.
+        self.listing = []
+        self.mtimes = {}
+        self._names = {}
+        self.scan_time = time.time_ns()
+        self._scan(self.root, "")
+
+    def _scan(self, directory, prefix):
+        self.mtimes[str(directory)] = os.stat(directory).st_mtime_ns
+        with os.scandir(directory) as it:
+            for entry in it:
+                path = prefix + entry.name
+                is_symlink = entry.is_symlink()
+                is_file = entry.is_file()
+                is_dir = entry.is_dir()
+                # broken links do not exist
+                self.entries[path] = (is_file or is_dir or not is_symlink, is_file, is_dir, is_symlink)
+                if prefix == "":
+                    self.listing.append(entry.name)
+                if self.recursive and is_dir and not is_symlink:
+                    self._scan(Path(entry.path), path + "/")
+
+    def is_current(self):
+        '''
+        Return True if none of the scanned directories have changed since the index was built.
+        '''
+        try:
+            return all(
+                os.stat(d).st_mtime_ns == mtime and mtime < self.scan_time - self.racy_window
+                for d, mtime in self.mtimes.items()
+            )
+        except OSError:
+            return False
+
+    def get(self, path):
+        return self.entries.get(path, None)
 
-            if result is False:
-                notes.append(f"Found these files in '{cwd}':")
-                for file in wd.glob("*"):
-                    notes.append(f"  {file.relative_to(wd)}")
+    def names(self, basename=False):
+        '''
+        Return the entries grouped by their lower case path (or name, if
+        `basename`), with the shallowest entries first.
+        '''
+        if basename not in self._names:
+            names = {}
+            for path in sorted(self.entries, key=lambda p: p.count("/")):
+                name = path.rsplit("/", 1)[-1] if basename else path
+                names.setdefault(name.lower(), []).append(path)
+            self._names[basename] = names
+        return self._names[basename]
 
+# directory indexes shared by the file checks, keyed by (directory, recursive).
+_directory_indexes = {}
 
+def get_directory_index(directory, recursive=False):
+    '''
+    Return the index for `directory`. It is built the first time it is asked
+    for and then reused until the directory changes.
+    '''
+    key = (str(Path(directory).absolute()), recursive)
+    index = _directory_indexes.get(key, None)
+    if index is None or not index.is_current():
+        index = DirectoryIndex(key[0], recursive)
+        _directory_indexes[key] = index
+    return index
+
+def clear_directory_indexes():
+    _directory_indexes.clear()
+
+def _lookup_entry(wd, name, recursive=False):
+    '''
+    Return the index entry for `name` (relative to `wd`), or None if it does not exist.
+    '''
+    parts = PurePosixPath(Path(name).as_posix()).parts
+    if len(parts) == 0 or parts[0] == "/" or ".." in parts:
+        path = wd/name
+        if not path.exists() and not path.is_symlink():
+            return None
+        return (path.exists(), path.is_file(), path.is_dir(), path.is_symlink())
+    try:
+        if recursive:
+            entry = get_directory_index(wd, True).get("/".join(parts))
+            if entry is not None:
+                return entry
+        return get_directory_index(wd.joinpath(*parts[:-1])).get(parts[-1])
+    except OSError:
+        return None
+
+def _entry_is(entry, filetype):
+    if entry is None or not entry[0]:
+        return False
+    return {'file': entry[1], 'dir': entry[2], 'link': entry[3]}.get(filetype, False)
+
+def _find_similar_entry(wd, names, filetype, ignore_case, fuzzy, recursive):
+    '''
+    Return the path of an entry of the right type that matches one of `names`
+    ignoring case, or that is a close match to one of them. Names are matched
+    against the entries in their own directory, or against every entry under
+    `wd` if `recursive`.
+    '''
+    searches = []
+    for name in names:
+        parts = PurePosixPath(Path(name).as_posix()).parts
+        if len(parts) == 0 or parts[0] == "/" or ".." in parts:
+            continue
+        if recursive:
+            searches.append(("", wd, "/".join(parts)))
+        else:
+            prefix = "".join(part + "/" for part in parts[:-1])
+            searches.append((prefix, wd.joinpath(*parts[:-1]), parts[-1]))
+
+    methods = [method for method, enabled in [("ignore_case", ignore_case), ("fuzzy", fuzzy)] if enabled]
+    for method in methods:
+        for prefix, directory, key in searches:
+            try:
+                index = get_directory_index(directory, recursive)
+            except OSError:
+                continue
+            # names without a directory match entries with the same name in any
+            # subdirectory of a recursive index.
+            candidates = index.names(basename="/" not in key)
+            if method == "ignore_case":
+                matches = candidates.get(key.lower(), [])
+            else:
+                matches = [
+                    path
+                    for m in difflib.get_close_matches(key.lower(), candidates, n=3, cutoff=0.8)
+                    for path in candidates[m]
+                ]
+            for path in matches:
+                if _entry_is(index.get(path), filetype):
+                    return prefix + path
+    return None
+
+def CheckFileExists(filename,cwd,aliases=[],**kwargs):
+    return CheckFileOrDirExists(filename,cwd,aliases,filetype='file',**kwargs)
+def CheckDirectoryExists(dirname,cwd,aliases=[],**kwargs):
+    return CheckFileOrDirExists(dirname,cwd,aliases,filetype='dir',**kwargs)
+
+def CheckFileOrDirExists(filename,cwd,aliases=[],filetype='file',ignore_case=False,fuzzy=False,recursive=False):
+    '''
+    Check that `filename` exists in `cwd`. If it does not, but one of its
+    `aliases` does (or, with `ignore_case` or `fuzzy`, an entry with a
+    similar name does), a link to it is created with the expected name.
+
+    Lookups go through a directory index that is shared by every file check
+    for the same directory. With `recursive`, similar names are searched for
+    in subdirectories too.
+    '''
+    result = False
+    notes = []
+    wd = resolve_path(cwd)
+    result = _entry_is(_lookup_entry(wd, filename, recursive), filetype)
+
+    if result is False:
+        notes.append(f"Did not find '{filename}' in '{cwd}'.")
+        found = None
+        for alias in aliases:
+            entry = _lookup_entry(wd, alias, recursive)
+            if entry is not None and entry[0]:
+                found = alias
+                break
+        if found is None and (ignore_case or fuzzy):
+            found = _find_similar_entry(wd, [filename] + list(aliases), filetype, ignore_case, fuzzy, recursive)
+        if found is not None:
+            notes.append(f"Found '{found}' instead, creating a link to expected filename: '{filename}' -> '{found}'.")
+            (wd/filename).symlink_to(wd/found)
+            result = True
+
+        if result is False:
+            notes.append(f"Found these files in '{cwd}':")
+            try:
+                listing = get_directory_index(wd).listing
+            except OSError:
+                listing = []
+            for name in listing:
+                notes.append(f"  {name}")
 
     return {'result':result,'notes':notes}
 
 def ManualCheck(ctx):
     pass
 
-def CheckFileContents(filename,cwd='.'):
-    with working_dir(Path(cwd)) as wd:
-        ret = {}
-        ret['display'] = {}
-        ret['display']['File Contents'] = "File not found."
-        filepath = wd/filename
-        if filepath.exists():
-            ret['display']['File Contents'] = filepath.read_text()
+# the number of lines previewed from the start and end of a file, and the
+# most bytes read for each of them.
+PREVIEW_HEAD_LINES = 200
+PREVIEW_TAIL_LINES = 20
+PREVIEW_MAX_BYTES = 64*1024
+# a file with a NUL byte in its first BINARY_CHECK_BYTES bytes is treated as binary.
+BINARY_CHECK_BYTES = 8*1024
+
+def _skip_lines(mm, start, stop, lines, max_bytes):
+    '''
+    Return the offset just after `lines` lines from `start`, but not past `stop`
+    or more than `max_bytes` after `start`.
+    '''
+    end = min(stop, start + max_bytes)
+    pos = start
+    for i in range(lines):
+        n = mm.find(b"\n", pos, end)
+        if n < 0:
+            return end
+        pos = n + 1
+    return pos
+
+def _skip_lines_back(mm, start, stop, lines, max_bytes):
+    '''
+    Return the offset of the start of the last `lines` lines before `stop`, but
+    not before `start` or more than `max_bytes` before `stop`.
+    '''
+    if lines == 0:
+        return stop
+    begin = max(start, stop - max_bytes)
+    end = stop
+    # a trailing new line does not start another line
+    if end > begin and mm[end-1:end] == b"\n":
+        end -= 1
+    for i in range(lines):
+        n = mm.rfind(b"\n", begin, end)
+        if n < 0:
+            return begin
+        end = n
+    return end + 1
+
+def _decode(data:bytes):
+    return data.decode("utf-8", errors="replace")
+
+class FilePreview(str):
+    '''
+    A preview of a file holding its first and last few lines.
+
+    The file is read through mmap, so the size of the file does not matter,
+    only the previewed parts of it are read. The preview is a str, so it can be
+    used anywhere handler display text is. The lines between the head and the
+    tail can be read on demand, a page at a time, with `page(...)`.
+
+    Use `preview_file(...)` to create one.
+    '''
+
+    @property
+    def omitted(self):
+        return self.tail_start - self.head_end
+
+    def page(self, offset=None, lines=PREVIEW_HEAD_LINES, max_bytes=PREVIEW_MAX_BYTES):
+        '''
+        Read the next `lines` lines that are not in the preview, starting at `offset`
+        (the end of the head by default).
+
+        Returns (text, offset of the next page).
+        '''
+        if offset is None:
+            offset = self.head_end
+        if offset >= self.tail_start:
+            return "", offset
+        with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            end = _skip_lines(mm, offset, min(self.tail_start, len(mm)), lines, max_bytes)
+            return _decode(mm[offset:end]), end
+
+    def render(self, pages="", offset=None):
+        '''
+        Return the preview text with the `pages` read so far (up to `offset`) between the head and tail.
+        '''
+        if offset is None:
+            offset = self.head_end
+        return _preview_text(self.size, self.binary, self.head_text + pages, self.tail_start - offset, self.tail_text)
+
+def _preview_text(size, binary, head, omitted, tail):
+    if binary:
+        return f"Binary file ({size} bytes)."
+    text = head
+    if omitted > 0:
+        if len(text) > 0 and not text.endswith("\n"):
+            text += "\n"
+        text += f"... {omitted} bytes not shown ...\n"
+    return text + tail
+
+def preview_file(path, head_lines=PREVIEW_HEAD_LINES, tail_lines=PREVIEW_TAIL_LINES, max_bytes=PREVIEW_MAX_BYTES):
+    '''
+    Return a FilePreview with the first `head_lines` and last `tail_lines`
+    lines of a file, each limited to `max_bytes`.
+    '''
+    path = Path(path).absolute()
+    size = path.stat().st_size
+    binary = False
+    head_end = tail_start = size
+    head = tail = b""
+    if size > 0:
+        with path.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            binary = mm.find(b"\0", 0, min(size, BINARY_CHECK_BYTES)) >= 0
+            if not binary:
+                head_end = _skip_lines(mm, 0, size, head_lines, max_bytes)
+                tail_start = max(head_end, _skip_lines_back(mm, head_end, size, tail_lines, max_bytes))
+                head = mm[:head_end]
+                tail = mm[tail_start:]
+
+    head_text = _decode(head)
+    tail_text = _decode(tail)
+    preview = FilePreview(_preview_text(size, binary, head_text, tail_start - head_end, tail_text))
+    preview.path = str(path)
+    preview.size = size
+    preview.binary = binary
+    preview.head_end = head_end
+    preview.tail_start = tail_start
+    preview.head_text = head_text
+    preview.tail_text = tail_text
+    return preview
+
+def CheckFileContents(filename,cwd='.',head=PREVIEW_HEAD_LINES,tail=PREVIEW_TAIL_LINES,max_bytes=PREVIEW_MAX_BYTES):
+    '''
+    Display a preview of a file: its first `head` and last `tail` lines.
+    Binary files are not displayed.
+    '''
+    wd = resolve_path(cwd)
+    ret = {}
+    ret['display'] = {}
+    ret['display']['File Contents'] = "File not found."
+    filepath = wd/filename
+    if filepath.exists():
+        ret['display']['File Contents'] = preview_file(filepath, head, tail, max_bytes)
 
     return ret
 
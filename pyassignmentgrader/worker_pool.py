@@ -0,0 +1,229 @@
+import importlib
+import multiprocessing
+import queue
+import sys
+import threading
+from subprocess import TimeoutExpired
+
+from fspathtree import fspathtree
+
+from .handlers.compiler import compile_handler
+from .utils import ExecutionContext, execution_context, parse_size
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def _memory_usage():
+    '''
+    Return the peak resident set size of the current process in bytes (0 if it is not available).
+    '''
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _worker_main(conn, path, preload):
+    '''
+    The main loop of a worker process. Handler calls are received from `conn`
+    as (spec, namespace, directory) tuples and replies are sent back as
+    (ok, value, memory usage) tuples.
+    '''
+    sys.path[:] = path
+    for module_name in preload:
+        try:
+            importlib.import_module(module_name)
+        except Exception:
+            # import errors are reported when the handler is called.
+            pass
+
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        spec, namespace, directory = request
+        try:
+            for name in ("check", "ctx"):
+                if isinstance(namespace.get(name, None), (dict, list)):
+                    namespace[name] = fspathtree(namespace[name])
+            with execution_context(ExecutionContext(directory)):
+                ret = compile_handler(spec)(namespace)
+            reply = (True, ret)
+        except BaseException as e:
+            reply = (False, e)
+        try:
+            conn.send(reply + (_memory_usage(),))
+        except Exception as e:
+            # the return value (or exception) could not be pickled.
+            conn.send((False, RuntimeError(f"Could not send handler output back to the grader: {e}"), _memory_usage()))
+
+
+class HandlerWorker:
+    def __init__(self, context, path, preload):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main, args=(child_conn, path, preload), daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.tasks = 0
+        self.baseline_memory = None
+        self.memory = 0
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except Exception:
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class HandlerWorkerPool:
+    '''
+    A pool of long-lived worker processes that run Python function handlers.
+
+    Each worker imports the modules in `preload` (e.g. the assignment's checks
+    module) when it starts, then runs handler calls sent to it over a pipe. A
+    handler that crashes, leaks memory, or hangs only takes down its worker,
+    which is replaced. Workers are also replaced after `max_tasks` calls, or
+    when their memory usage has grown by more than `max_memory_growth` bytes
+    since their first call.
+
+    `call` is thread safe, so up to `workers` handlers can run at the same time.
+    '''
+
+    def __init__(
+        self,
+        workers=2,
+        preload=(),
+        max_tasks=100,
+        max_memory_growth="512M",
+        path=None,
+    ):
+        self.context = multiprocessing.get_context("spawn")
+        self.workers = workers
+        self.preload = list(preload)
+        self.max_tasks = max_tasks
+        self.max_memory_growth = parse_size(max_memory_growth)
+        self.path = list(path if path is not None else sys.path)
+        self.lock = threading.Lock()
+        self.idle = queue.SimpleQueue()
+        self.all_workers = set()
+        self.started = 0
+        self.closed = False
+        for i in range(self.workers):
+            self.idle.put(self.start_worker())
+
+    def start_worker(self):
+        worker = HandlerWorker(self.context, self.path, self.preload)
+        with self.lock:
+            self.all_workers.add(worker)
+            self.started += 1
+        return worker
+
+    def retire_worker(self, worker, kill=False):
+        with self.lock:
+            self.all_workers.discard(worker)
+        if kill:
+            worker.kill()
+        else:
+            worker.stop()
+
+    def should_recycle(self, worker):
+        if self.max_tasks is not None and worker.tasks >= self.max_tasks:
+            return True
+        if self.max_memory_growth is not None and worker.baseline_memory is not None:
+            return worker.memory - worker.baseline_memory > self.max_memory_growth
+        return False
+
+    def call(self, spec, namespace, directory, timeout=None):
+        '''
+        Call the handler `spec` with `namespace` in `directory` on a worker and
+        return its output.
+
+        The `check` and `ctx` entries of the namespace are sent as plain trees.
+        Exceptions raised by the handler are raised here. If the call takes longer
+        than `timeout` seconds, the worker is killed and subprocess.TimeoutExpired
+        is raised. If the worker dies, RuntimeError is raised.
+        '''
+        if self.closed:
+            raise RuntimeError("The handler worker pool has been closed.")
+        namespace = dict(namespace)
+        for name in ("check", "ctx"):
+            if hasattr(namespace.get(name, None), "tree"):
+                namespace[name] = namespace[name].tree
+        directory = str(getattr(directory, "path", directory))
+
+        worker = self.idle.get()
+        replacement = None
+        try:
+            worker.conn.send((spec, namespace, directory))
+            if not worker.conn.poll(timeout):
+                self.retire_worker(worker, kill=True)
+                replacement = self.start_worker()
+                raise TimeoutExpired(spec, timeout)
+            try:
+                ok, value, memory = worker.conn.recv()
+            except EOFError:
+                worker.process.join(1)
+                exitcode = worker.process.exitcode
+                self.retire_worker(worker, kill=True)
+                replacement = self.start_worker()
+                raise RuntimeError(
+                    f"The worker process running '{spec}' died (exit code {exitcode})."
+                )
+            worker.tasks += 1
+            worker.memory = memory
+            if worker.baseline_memory is None:
+                worker.baseline_memory = memory
+            if self.should_recycle(worker):
+                self.retire_worker(worker)
+                replacement = self.start_worker()
+            else:
+                replacement = worker
+        except BaseException:
+            if replacement is None:
+                # the request could not be sent, replace the worker to be safe.
+                self.retire_worker(worker, kill=True)
+                replacement = self.start_worker()
+            raise
+        finally:
+            if replacement is not None:
+                if self.closed:
+                    self.retire_worker(replacement)
+                else:
+                    self.idle.put(replacement)
+
+        if not ok:
+            raise value
+        return value
+
+    def close(self):
+        self.closed = True
+        with self.lock:
+            workers = list(self.all_workers)
+            self.all_workers.clear()
+        for worker in workers:
+            worker.stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -314,3 +314,422 @@ def test_rendering_results_file(setup_simple_grading_example_with_rendering):
 
 
 
+
+
+def test_grading_assignment_with_parallel_jobs(setup_basic_grading_example_with_secondary_checks):
+    with working_dir(setup_basic_grading_example_with_secondary_checks) as d:
+        cwd = os.getcwd()
+        rtn = runner.invoke(app, ["setup-grading-files","HW-00-config.yml"])
+        assert rtn.exit_code == 0
+        rtn = runner.invoke(app, ["run-checks","HW-00-config.yml","--user-interface","cli","--jobs","2"])
+        print(rtn.stdout)
+        assert rtn.exit_code == 0
+        assert os.getcwd() == cwd
+
+        grading_results = fspathtree.fspathtree(yaml.safe_load(pathlib.Path("HW-00-results.yml").open()))
+        assert grading_results['jdoe/checks/0/result'] == True
+        assert grading_results['jdoe/checks/1/result'] == False
+        assert grading_results['jdoe/checks/1/secondary_checks/checks/0/result'] == True
+
+        # results are printed in the order the checks appear in the results file.
+        assert rtn.stdout.index("P1: Check for P1") < rtn.stdout.index("P2: Check for P2")
+        assert rtn.stdout.index("P2: Check for P2") < rtn.stdout.index("P2.1: Secondary check for P2")
+
+        rtn = runner.invoke(app, ["print-summary","HW-00-config.yml"])
+        assert "Score: 75.00%" in rtn.stdout
+
+
+def test_grading_assignment_with_async_runner(setup_basic_grading_example_with_secondary_checks):
+    with working_dir(setup_basic_grading_example_with_secondary_checks) as d:
+        cwd = os.getcwd()
+        rtn = runner.invoke(app, ["setup-grading-files","HW-00-config.yml"])
+        assert rtn.exit_code == 0
+        rtn = runner.invoke(app, ["run-checks","HW-00-config.yml","--user-interface","cli","--async","--max-procs","2"])
+        print(rtn.stdout)
+        assert rtn.exit_code == 0
+        assert os.getcwd() == cwd
+
+        grading_results = fspathtree.fspathtree(yaml.safe_load(pathlib.Path("HW-00-results.yml").open()))
+        assert grading_results['jdoe/checks/0/result'] == True
+        assert grading_results['jdoe/checks/1/result'] == False
+        assert grading_results['jdoe/checks/1/secondary_checks/checks/0/result'] == True
+
+        assert rtn.stdout.index("P1: Check for P1") < rtn.stdout.index("P2: Check for P2")
+        assert rtn.stdout.index("P2: Check for P2") < rtn.stdout.index("P2.1: Secondary check for P2")
+
+        rtn = runner.invoke(app, ["print-summary","HW-00-config.yml"])
+        assert "Score: 75.00%" in rtn.stdout
+
+
+def test_rerunning_checks_leaves_skipped_checks_alone(setup_basic_grading_example_without_secondary_checks):
+    with working_dir(setup_basic_grading_example_without_secondary_checks) as d:
+        rtn = runner.invoke(app, ["setup-grading-files","HW-00-config.yml"])
+        assert rtn.exit_code == 0
+        rtn = runner.invoke(app, ["run-checks","HW-00-config.yml","--user-interface","cli"])
+        assert rtn.exit_code == 0
+
+        grading_results = fspathtree.fspathtree(yaml.safe_load(pathlib.Path("HW-00-results.yml").open()))
+        grading_results['jdoe/checks/0/notes'] = ["Looks good"]
+        yaml.safe_dump(grading_results.tree, pathlib.Path("HW-00-results.yml").open('w'))
+
+        for args in [[], ["--jobs", "2"], ["--async"]]:
+            rtn = runner.invoke(app, ["run-checks","HW-00-config.yml","--user-interface","cli"] + args)
+            assert rtn.exit_code == 0
+            assert rtn.stdout.count("SKIPPING") == 2
+            grading_results = fspathtree.fspathtree(yaml.safe_load(pathlib.Path("HW-00-results.yml").open()))
+            assert grading_results['jdoe/checks/0/result'] == True
+            assert grading_results['jdoe/checks/0/notes'].tree == ["Looks good"]
+
+
+def test_grading_assignment_with_results_journal(setup_basic_grading_example_without_secondary_checks):
+    with working_dir(setup_basic_grading_example_without_secondary_checks) as d:
+        config = yaml.safe_load(pathlib.Path("HW-00-config.yml").read_text())
+        config["results_journal"] = True
+        yaml.safe_dump(config, pathlib.Path("HW-00-config.yml").open('w'))
+
+        rtn = runner.invoke(app, ["setup-grading-files","HW-00-config.yml"])
+        assert rtn.exit_code == 0
+        rtn = runner.invoke(app, ["run-checks","HW-00-config.yml","--user-interface","cli"])
+        assert rtn.exit_code == 0
+
+        # only the journal was written
+        assert pathlib.Path("HW-00-results.yml.journal").exists()
+        grading_results = fspathtree.fspathtree(yaml.safe_load(pathlib.Path("HW-00-results.yml").open()))
+        assert grading_results['jdoe/checks/0/result'] == None
+
+        rtn = runner.invoke(app, ["print-summary","HW-00-config.yml"])
+        assert "Score: 50.00%" in rtn.stdout
+
+        rtn = runner.invoke(app, ["compact-results","HW-00-config.yml"])
+        assert rtn.exit_code == 0
+        assert not pathlib.Path("HW-00-results.yml.journal").exists()
+        grading_results = fspathtree.fspathtree(yaml.safe_load(pathlib.Path("HW-00-results.yml").open()))
+        assert grading_results['jdoe/checks/0/result'] == True
+        assert grading_results['jdoe/checks/1/result'] == False
+
+
+def test_grading_assignment_with_result_cache(setup_basic_grading_example_without_secondary_checks):
+    with working_dir(setup_basic_grading_example_without_secondary_checks) as d:
+        config = yaml.safe_load(pathlib.Path("HW-00-config.yml").read_text())
+        config["result_cache"] = True
+        yaml.safe_dump(config, pathlib.Path("HW-00-config.yml").open('w'))
+        rubric = yaml.safe_load(pathlib.Path("HW-00-rubric.yml").read_text())
+        rubric["checks"][1]["inputs"] = ["*.py"]
+        yaml.safe_dump(rubric, pathlib.Path("HW-00-rubric.yml").open('w'))
+
+        rtn = runner.invoke(app, ["setup-grading-files","HW-00-config.yml"])
+        assert rtn.exit_code == 0
+        rtn = runner.invoke(app, ["run-checks","HW-00-config.yml","--user-interface","cli"])
+        assert rtn.exit_code == 0
+        assert "CACHED" not in rtn.stdout
+        assert pathlib.Path("HW-00-results.yml.cache").exists()
+
+        # nothing changed, so nothing is ran again
+        rtn = runner.invoke(app, ["run-checks","HW-00-config.yml","--user-interface","cli","-f"])
+        assert rtn.exit_code == 0
+        assert rtn.stdout.count("CACHED") == 2
+        assert "Calling" not in rtn.stdout
+
+        # only the check whose inputs changed is ran
+        pathlib.Path("workspace/jdoe/tmp.txt").write_text("new content")
+        rtn = runner.invoke(app, ["run-checks","HW-00-config.yml","--user-interface","cli","-f"])
+        assert rtn.exit_code == 0
+        assert rtn.stdout.count("CACHED") == 1
+        assert "Calling 'test -e tmp.txt' as shell command" in rtn.stdout
+
+        rtn = runner.invoke(app, ["run-checks","HW-00-config.yml","--user-interface","cli","-f","--jobs","2"])
+        assert rtn.exit_code == 0
+        assert rtn.stdout.count("CACHED") == 2
+
+        grading_results = fspathtree.fspathtree(yaml.safe_load(pathlib.Path("HW-00-results.yml").open()))
+        assert grading_results['jdoe/checks/0/result'] == True
+        assert grading_results['jdoe/checks/1/result'] == False
+
+
+def test_grading_assignment_with_timeouts(setup_basic_grading_example_without_secondary_checks):
+    with working_dir(setup_basic_grading_example_without_secondary_checks) as d:
+        rubric = yaml.safe_load(pathlib.Path("HW-00-rubric.yml").read_text())
+        rubric["checks"][0]["handler"] = "echo started; sleep 30"
+        rubric["checks"][0]["timeout"] = 0.5
+        rubric["checks"][1]["handler"] = "HW_00_timeout_checks:LoopCheck"
+        rubric["checks"][1]["timeout"] = 0.5
+        yaml.safe_dump(rubric, pathlib.Path("HW-00-rubric.yml").open('w'))
+        pathlib.Path("HW_00_timeout_checks.py").write_text('''
+def LoopCheck():
+  while True:
+    pass
+        ''')
+
+        rtn = runner.invoke(app, ["setup-grading-files","HW-00-config.yml"])
+        assert rtn.exit_code == 0
+        for args in [[], ["-f", "--jobs", "2"], ["-f", "--async"]]:
+            rtn = runner.invoke(app, ["run-checks","HW-00-config.yml","--user-interface","cli"] + args)
+            assert rtn.exit_code == 0
+            assert rtn.stdout.count("TIMEOUT") == 2
+
+            grading_results = fspathtree.fspathtree(yaml.safe_load(pathlib.Path("HW-00-results.yml").open()))
+            assert grading_results['jdoe/checks/0/result'] == False
+            assert grading_results['jdoe/checks/0/status'] == "timeout"
+            assert "Check timed out after 0.5 seconds." in grading_results['jdoe/checks/0/notes'].tree
+            assert "command output:started\n" in grading_results['jdoe/checks/0/notes'].tree
+            assert grading_results['jdoe/checks/1/result'] == False
+            assert grading_results['jdoe/checks/1/status'] == "timeout"
+
+
+def test_grading_assignment_with_handler_workers(setup_basic_grading_example_without_secondary_checks):
+    with working_dir(setup_basic_grading_example_without_secondary_checks) as d:
+        config = yaml.safe_load(pathlib.Path("HW-00-config.yml").read_text())
+        config["handler_workers"] = 1
+        yaml.safe_dump(config, pathlib.Path("HW-00-config.yml").open('w'))
+
+        rtn = runner.invoke(app, ["setup-grading-files","HW-00-config.yml"])
+        assert rtn.exit_code == 0
+        rtn = runner.invoke(app, ["run-checks","HW-00-config.yml","--user-interface","cli"])
+        assert rtn.exit_code == 0
+
+        grading_results = fspathtree.fspathtree(yaml.safe_load(pathlib.Path("HW-00-results.yml").open()))
+        assert grading_results['jdoe/checks/0/result'] == True
+        assert grading_results['jdoe/checks/1/result'] == False
+
+
+def test_grading_assignment_with_handler_workers_and_async(setup_basic_grading_example_without_secondary_checks):
+    with working_dir(setup_basic_grading_example_without_secondary_checks) as d:
+        config = yaml.safe_load(pathlib.Path("HW-00-config.yml").read_text())
+        config["handler_workers"] = 2
+        config["students"].append({"name": "rshackleford"})
+        yaml.safe_dump(config, pathlib.Path("HW-00-config.yml").open('w'))
+        pathlib.Path("workspace/rshackleford").mkdir()
+        rubric = yaml.safe_load(pathlib.Path("HW-00-rubric.yml").read_text())
+        rubric["checks"][1]["handler"] = "HW_00_slow_checks:P2Check"
+        yaml.safe_dump(rubric, pathlib.Path("HW-00-rubric.yml").open('w'))
+        pathlib.Path("HW_00_slow_checks.py").write_text(f'''
+import time
+def P2Check(ctx):
+  start = time.time()
+  time.sleep(1)
+  with open({str(pathlib.Path("times.txt").absolute())!r}, "a") as f:
+    f.write(f"{{start}} {{time.time()}}\\n")
+  return {{'result':False,'notes':[]}}
+        ''')
+
+        rtn = runner.invoke(app, ["setup-grading-files","HW-00-config.yml"])
+        assert rtn.exit_code == 0
+        rtn = runner.invoke(app, ["run-checks","HW-00-config.yml","--user-interface","cli","--async"])
+        assert rtn.exit_code == 0
+
+        # the checks for both students ran at the same time
+        times = [list(map(float, line.split())) for line in pathlib.Path("times.txt").read_text().splitlines()]
+        assert len(times) == 2
+        assert max(start for start, end in times) < min(end for start, end in times)
+
+        grading_results = fspathtree.fspathtree(yaml.safe_load(pathlib.Path("HW-00-results.yml").open()))
+        assert grading_results['jdoe/checks/1/result'] == False
+        assert grading_results['rshackleford/checks/1/result'] == False
+
+
+def test_grading_assignment_with_sharded_results(setup_basic_grading_example_without_secondary_checks):
+    with working_dir(setup_basic_grading_example_without_secondary_checks) as d:
+        config = yaml.safe_load(pathlib.Path("HW-00-config.yml").read_text())
+        config["results_layout"] = "sharded"
+        config["students"].append({"name": "rshackleford"})
+        yaml.safe_dump(config, pathlib.Path("HW-00-config.yml").open('w'))
+
+        rtn = runner.invoke(app, ["setup-grading-files","HW-00-config.yml"])
+        assert rtn.exit_code == 0
+        manifest = yaml.safe_load(pathlib.Path("HW-00-results.yml").read_text())
+        assert list(manifest["results_shards"]) == ["jdoe", "rshackleford"]
+        rshackleford_shard = pathlib.Path("HW-00-results.yml.shards/rshackleford.yml")
+        rshackleford_text = rshackleford_shard.read_text()
+
+        # only the shard for the student being graded is touched
+        rshackleford_shard.unlink()
+        rtn = runner.invoke(app, ["run-checks","HW-00-config.yml","--user-interface","cli","-s","jdoe"])
+        assert rtn.exit_code == 0
+        assert not rshackleford_shard.exists()
+        rshackleford_shard.write_text(rshackleford_text)
+
+        grading_results = fspathtree.fspathtree(yaml.safe_load(pathlib.Path("HW-00-results.yml.shards/jdoe.yml").open()))
+        assert grading_results['jdoe/checks/0/result'] == True
+        assert grading_results['jdoe/checks/1/result'] == False
+
+        rtn = runner.invoke(app, ["print-summary","HW-00-config.yml"])
+        assert rtn.exit_code == 0
+        assert "Grading report for 'jdoe'" in rtn.stdout
+        assert "Grading report for 'rshackleford'" in rtn.stdout
+
+
+def test_results_with_top_level_keys_that_are_not_students(setup_basic_grading_example_without_secondary_checks, monkeypatch):
+    import pyassignmentgrader.cli
+
+    class FakeMainLoop:
+        def __init__(self, *args, **kwargs):
+            pass
+        def watch_pipe(self, callback):
+            return os.pipe()[1]
+        def remove_watch_pipe(self, fd):
+            os.close(fd)
+        def run(self):
+            pass
+
+    monkeypatch.setattr(pyassignmentgrader.cli.console_view.urwid, "MainLoop", FakeMainLoop)
+
+    with working_dir(setup_basic_grading_example_without_secondary_checks) as d:
+        for layout in ["single", "sharded"]:
+            config = yaml.safe_load(pathlib.Path("HW-00-config.yml").read_text())
+            config["results_layout"] = layout
+            yaml.safe_dump(config, pathlib.Path("HW-00-config.yml").open('w'))
+            rtn = runner.invoke(app, ["setup-grading-files","HW-00-config.yml","-x"])
+            assert rtn.exit_code == 0
+
+            results = yaml.safe_load(pathlib.Path("HW-00-results.yml").read_text())
+            results["working_directory"] = "."
+            yaml.safe_dump(results, pathlib.Path("HW-00-results.yml").open('w'), sort_keys=False)
+
+            rtn = runner.invoke(app, ["run-checks","HW-00-config.yml","--user-interface","tui"])
+            assert rtn.exit_code == 0
+            assert rtn.exception is None
+            rtn = runner.invoke(app, ["run-checks","HW-00-config.yml","--user-interface","cli"])
+            assert rtn.exit_code == 0
+            assert "exception" not in rtn.stdout
+
+            rtn = runner.invoke(app, ["print-summary","HW-00-config.yml"])
+            assert "Score: 50.00%" in rtn.stdout
+            assert yaml.safe_load(pathlib.Path("HW-00-results.yml").read_text())["working_directory"] == "."
+
+
+def test_preprocessing_pipeline(setup_basic_grading_example_without_secondary_checks):
+    with working_dir(setup_basic_grading_example_without_secondary_checks) as d:
+        config = yaml.safe_load(pathlib.Path("HW-00-config.yml").read_text())
+        config["students"] = [{"name": "jdoe"}, {"name": "rshackleford"}, {"name": "bhill"}]
+        config["preprocessing"] = [
+            "mkdir unpacked",
+            "mkdir unpacked/{name}",
+            {"cmd": "touch {name}.txt", "working_directory": "unpacked/{name}"},
+            "test {name} != rshackleford",
+            "ls unpacked > listing.txt",
+            "test -e unpacked/{name}/{name}.txt && echo {name} >> done.txt",
+        ]
+        yaml.safe_dump(config, pathlib.Path("HW-00-config.yml").open('w'))
+
+        rtn = runner.invoke(app, ["setup-grading-files","HW-00-config.yml","-j","3"])
+        assert rtn.exit_code == 0
+        print(rtn.stdout)
+
+        for name in ["jdoe", "rshackleford", "bhill"]:
+            assert pathlib.Path(f"unpacked/{name}/{name}.txt").exists()
+        # barriers wait for every per-student command before them.
+        assert pathlib.Path("listing.txt").read_text().split() == ["bhill", "jdoe", "rshackleford"]
+        assert sorted(pathlib.Path("done.txt").read_text().split()) == ["bhill", "jdoe", "rshackleford"]
+
+        assert "Preprocessing summary" in rtn.stdout
+        assert "`mkdir unpacked/{name}` ran 3 command(s)" in rtn.stdout
+        assert "1 failed: rshackleford" in rtn.stdout
+
+
+def test_preprocessing_python_functions_run_in_their_working_directory(setup_basic_grading_example_without_secondary_checks):
+    with working_dir(setup_basic_grading_example_without_secondary_checks) as d:
+        config = yaml.safe_load(pathlib.Path("HW-00-config.yml").read_text())
+        config["preprocessing"] = [
+            "mkdir unpacked",
+            {"cmd": "HW_00_preprocessing:Prep", "working_directory": "unpacked"},
+        ]
+        yaml.safe_dump(config, pathlib.Path("HW-00-config.yml").open('w'))
+        pathlib.Path("HW_00_preprocessing.py").write_text('''
+import os
+import pathlib
+def Prep(ctx):
+  pathlib.Path("cwd.txt").write_text(os.getcwd())
+  assert ctx["working_directory"].path == pathlib.Path(os.getcwd())
+''')
+
+        rtn = runner.invoke(app, ["setup-grading-files","HW-00-config.yml"])
+        assert rtn.exit_code == 0
+        assert "Error" not in rtn.stdout
+        assert pathlib.Path("unpacked/cwd.txt").read_text() == str(pathlib.Path("unpacked").absolute())
+        # the process working directory is restored afterwards
+        assert pathlib.Path().absolute() == pathlib.Path(d).absolute()
+
+
+def test_preprocessing_task_graph():
+    from pyassignmentgrader.preprocessing import get_preprocessing_tasks
+
+    config = fspathtree.fspathtree()
+    config["students/0/name"] = "a"
+    config["students/1/name"] = "b"
+    config["preprocessing/0"] = "mkdir x"
+    config["preprocessing/1"] = "mkdir x/{name}"
+    config["preprocessing/2"] = "touch x/{name}/f"
+    config["preprocessing/3"] = "ls x"
+    config["preprocessing/4"] = "rm x/{name}/f"
+
+    tasks = get_preprocessing_tasks(config)
+    assert [(t["step"], t["student"]) for t in tasks] == [
+        (0, None), (1, "a"), (1, "b"), (2, "a"), (2, "b"), (3, None), (4, "a"), (4, "b")
+    ]
+    assert [t["deps"] for t in tasks] == [set(), {0}, {0}, {1}, {2}, {3, 4}, {5}, {5}]
+
+
+def test_preprocessing_archive_extraction(setup_basic_grading_example_without_secondary_checks):
+    import tarfile
+    import zipfile
+
+    with working_dir(setup_basic_grading_example_without_secondary_checks) as d:
+        pathlib.Path("submissions").mkdir()
+        files = {
+            "gradebook/HW00_jdoe_attempt_1_main.py": b"print('first')\n",
+            "gradebook/HW00_jdoe_attempt_2_main.py": b"print('second')\n",
+            "gradebook/HW00_rshackleford_attempt_1_data.txt": b"x" * 2048,
+            "gradebook/HW00_rshackleford_attempt_1_notes.txt": b"notes\n",
+            "gradebook/HW00_unknown_attempt_1_main.py": b"",
+            "gradebook/HW00_bhill_attempt_1_../../escape.txt": b"",
+        }
+        for name, data in files.items():
+            pathlib.Path("submissions", name.replace("/", "_")).write_bytes(data)
+        with tarfile.open("gradebook.tar.bz2", "w:bz2") as tf:
+            for name in files:
+                tf.add(pathlib.Path("submissions", name.replace("/", "_")), arcname=name)
+
+        config = yaml.safe_load(pathlib.Path("HW-00-config.yml").read_text())
+        config["students"] = [{"name": "jdoe"}, {"name": "rshackleford"}, {"name": "bhill"}]
+        config["preprocessing"] = [
+            {
+                "type": "extract",
+                "archive": "gradebook*.tar.bz2",
+                "destination": "unpacked/{name}",
+                "pattern": r"_{name}_attempt_\d+_(?P<path>.+)$",
+                "max_member_size": "1K",
+            },
+        ]
+        yaml.safe_dump(config, pathlib.Path("HW-00-config.yml").open('w'))
+
+        rtn = runner.invoke(app, ["setup-grading-files","HW-00-config.yml","-j","2"])
+        print(rtn.stdout)
+        assert rtn.exit_code == 0
+
+        # later attempts overwrite earlier ones.
+        assert pathlib.Path("unpacked/jdoe/main.py").read_bytes() == b"print('second')\n"
+        assert pathlib.Path("unpacked/rshackleford/notes.txt").read_bytes() == b"notes\n"
+        assert not pathlib.Path("unpacked/rshackleford/data.txt").exists()
+        assert not pathlib.Path("unpacked/unknown").exists()
+        assert not pathlib.Path("escape.txt").exists()
+        assert "Skipped 1 file(s) larger than 1K" in rtn.stdout
+        assert "No files found for: bhill" in rtn.stdout
+
+        # zip archives are supported too.
+        with zipfile.ZipFile("gradebook.zip", "w") as zf:
+            zf.writestr("bhill/main.py", "print('zip')\n")
+        config["preprocessing"] = [{"type": "extract", "archive": "gradebook.zip", "destination": "unpacked/{name}"}]
+        yaml.safe_dump(config, pathlib.Path("HW-00-config.yml").open('w'))
+        rtn = runner.invoke(app, ["setup-grading-files","HW-00-config.yml","-x"])
+        assert rtn.exit_code == 0
+        assert pathlib.Path("unpacked/bhill/main.py").read_bytes() == b"print('zip')\n"
+
+        # a step without an archive fails without stopping the rest of the setup.
+        config["preprocessing"] = [{"type": "extract"}, "touch after.txt"]
+        yaml.safe_dump(config, pathlib.Path("HW-00-config.yml").open('w'))
+        rtn = runner.invoke(app, ["setup-grading-files","HW-00-config.yml","-x"])
+        assert rtn.exit_code == 0
+        assert "Extract step needs an `archive` key" in rtn.stdout
+        assert "`extract` ran 1 command(s)" in rtn.stdout
+        assert "Preprocessing command `extract` returned non-zero" in rtn.stdout
+        assert pathlib.Path("after.txt").exists()
@@ -0,0 +1,269 @@
+from pyassignmentgrader.results import *
+from pyassignmentgrader.ui.console import GradingItemController
+from .utils import setup_temporary_directory
+import fspathtree
+import os
+import pathlib
+import pytest
+import time
+
+
+class FakeLoop:
+    '''
+    The parts of urwid.MainLoop used by the controller. The pipe is read by the test instead of the loop.
+    '''
+
+    def __init__(self):
+        self.callback = None
+        self.read_fd = None
+
+    def watch_pipe(self, callback):
+        self.callback = callback
+        self.read_fd, write_fd = os.pipe()
+        return write_fd
+
+    def remove_watch_pipe(self, write_fd):
+        os.close(write_fd)
+        os.close(self.read_fd)
+
+    def wait(self):
+        data = os.read(self.read_fd, 1024)
+        return self.callback(data)
+
+
+def test_handlers_run_in_background(setup_temporary_directory):
+    d = setup_temporary_directory
+    pathlib.Path(d / "jdoe").mkdir()
+    results = GradingResults()
+    results.data = fspathtree.fspathtree(
+        {
+            "working_directory": str(d),
+            "jdoe": {
+                "working_directory": "jdoe",
+                "checks": [
+                    {"tag": "P1", "handler": "sleep 0.5 && echo slow", "result": None, "notes": []},
+                    {"tag": "P2", "handler": "echo fast", "result": None, "notes": []},
+                ],
+            },
+        }
+    )
+    check_paths = [results.data["/jdoe/checks/0"].path(), results.data["/jdoe/checks/1"].path()]
+    controller = GradingItemController(results, check_paths)
+    loop = FakeLoop()
+    controller.attach(loop)
+
+    start = time.perf_counter()
+    controller.action_goto_next(None)
+    assert time.perf_counter() - start < 0.4
+    assert controller.handler_running
+    assert controller.current_handler_output is None
+
+    # move on before the slow handler finishes. its output should be dropped.
+    controller.action_goto_next(None)
+    loop.wait()
+    while controller.handler_running:
+        loop.wait()
+    assert controller.current_check["tag"] == "P2"
+    assert "  fast" in controller.current_handler_output["notes"]
+
+    controller.action_goto_prev(None)
+    loop.wait()
+    while controller.handler_running:
+        loop.wait()
+    assert controller.current_check["tag"] == "P1"
+    assert "  slow" in controller.current_handler_output["notes"]
+
+    controller.action_quit()
+
+
+def test_handlers_are_prefetched(setup_temporary_directory):
+    d = setup_temporary_directory
+    pathlib.Path(d / "jdoe").mkdir()
+    results = GradingResults()
+    results.data = fspathtree.fspathtree(
+        {
+            "working_directory": str(d),
+            "jdoe": {
+                "working_directory": "jdoe",
+                "checks": [
+                    {"tag": f"P{i}", "handler": f"sleep 0.2 && echo {i}", "result": None, "notes": []}
+                    for i in range(4)
+                ],
+            },
+        }
+    )
+    check_paths = [results.data[f"/jdoe/checks/{i}"].path() for i in range(4)]
+    controller = GradingItemController(results, check_paths, prefetch=2)
+    loop = FakeLoop()
+    controller.attach(loop)
+
+    controller.action_goto_next(None)
+    keys = [(str(p), results.data[p]["handler"]) for p in check_paths]
+    assert keys[0] in controller.handler_cache
+    assert keys[1] in controller.handler_cache
+    assert keys[2] in controller.handler_cache
+    assert keys[3] not in controller.handler_cache
+
+    time.sleep(0.5)
+    # the next check was run in the background, so its output is available right away.
+    controller.action_goto_next(None)
+    assert not controller.handler_running
+    assert "  1" in controller.current_handler_output["notes"]
+    # saving (or leaving) a check evicts its output
+    assert keys[0] not in controller.handler_cache
+    assert keys[3] in controller.handler_cache
+
+    # old outputs are not used
+    controller.prefetch_max_age = 0
+    controller.action_goto_next(None)
+    assert controller.handler_running
+
+    controller.action_quit()
+
+
+def test_quitting_kills_running_handlers(setup_temporary_directory):
+    d = setup_temporary_directory
+    pathlib.Path(d / "jdoe").mkdir()
+    results = GradingResults()
+    results.data = fspathtree.fspathtree(
+        {
+            "working_directory": str(d),
+            "jdoe": {
+                "working_directory": "jdoe",
+                "checks": [
+                    {"tag": "P1", "handler": "sleep 30", "result": None, "notes": []},
+                ],
+            },
+        }
+    )
+    controller = GradingItemController(results, [results.data["/jdoe/checks/0"].path()])
+    loop = FakeLoop()
+    controller.attach(loop)
+
+    controller.action_goto_next(None)
+    time.sleep(0.2)
+    assert len(controller.running_process_groups) == 1
+    futures = [future for start, future in controller.handler_cache.values()]
+
+    start = time.perf_counter()
+    controller.action_quit()
+    assert time.perf_counter() - start < 5
+    assert all(future.done() for future in futures)
+    assert len(controller.running_process_groups) == 0
+
+
+def test_shell_handlers_use_the_check_limits(setup_temporary_directory):
+    d = setup_temporary_directory
+    pathlib.Path(d / "jdoe").mkdir()
+    results = GradingResults()
+    results.data = fspathtree.fspathtree(
+        {
+            "working_directory": str(d),
+            "jdoe": {
+                "working_directory": "jdoe",
+                "checks": [
+                    {"tag": "P1", "handler": "echo started; sleep 30", "timeout": 0.5, "result": None, "notes": []},
+                    {"tag": "P2", "handler": "seq 1 100000", "output_limit": 100, "result": None, "notes": []},
+                ],
+            },
+        }
+    )
+    check_paths = [results.data["/jdoe/checks/0"].path(), results.data["/jdoe/checks/1"].path()]
+    controller = GradingItemController(results, check_paths)
+
+    start = time.perf_counter()
+    controller.action_goto_next(None)
+    assert time.perf_counter() - start < 5
+    assert controller.current_handler_output["result"] == False
+    assert "Check timed out after 0.5 seconds." in controller.current_handler_output["notes"]
+    assert "  started" in controller.current_handler_output["notes"]
+
+    controller.action_goto_next(None)
+    assert controller.current_handler_output["result"] == True
+    assert len(controller.current_handler_output["notes"]) < 50
+
+
+def test_live_score(setup_temporary_directory):
+    d = setup_temporary_directory
+    results = GradingResults()
+    results.data = fspathtree.fspathtree(
+        {
+            "working_directory": str(d),
+            "jdoe": {
+                "checks": [
+                    {"tag": "P1", "handler": "manual", "weight": 1, "result": None, "notes": []},
+                    {"tag": "P2", "handler": "manual", "weight": 3, "result": True, "notes": []},
+                ],
+            },
+            "rshackleford": {
+                "checks": [
+                    {"tag": "P1", "handler": "manual", "weight": 1, "result": None, "notes": []},
+                ],
+            },
+        }
+    )
+    check_paths = [results.data["/jdoe/checks/0"].path(), results.data["/jdoe/checks/1"].path()]
+    controller = GradingItemController(results, check_paths)
+    # only the students being graded are scored
+    assert results.check_table.students == ["jdoe"]
+    assert results.data["jdoe/awarded"] == 3
+    assert results.data["jdoe/available"] == 4
+
+    controller.action_goto_next(None)
+    info = "".join(str(w.get_text()[0]) + "\n" for w in controller.InfoText.list_walker)
+    assert "Score: 3/4 (75.00%)" in info
+
+    controller.result_action = controller.ResultAction.PASS
+    controller.action_goto_next(None)
+    assert results.data["jdoe/awarded"] == 4
+    assert results.dirty == set()
+    info = "".join(str(w.get_text()[0]) + "\n" for w in controller.InfoText.list_walker)
+    assert "Score: 4/4 (100.00%)" in info
+
+
+def test_file_previews_are_paged(setup_temporary_directory):
+    d = setup_temporary_directory
+    pathlib.Path(d / "jdoe").mkdir()
+    pathlib.Path(d / "jdoe/data.txt").write_text("".join(f"line {i}\n" for i in range(1000)))
+    results = GradingResults()
+    results.data = fspathtree.fspathtree(
+        {
+            "working_directory": str(d),
+            "jdoe": {
+                "working_directory": "jdoe",
+                "checks": [
+                    {
+                        "tag": "P1",
+                        "handler": "pyassignmentgrader.utils:CheckFileContents(filename='data.txt',cwd=ctx['working_directory'],head=10,tail=5)",
+                        "result": None,
+                        "notes": [],
+                    },
+                ],
+            },
+        }
+    )
+    controller = GradingItemController(
+        results, [results.data["/jdoe/checks/0"].path()], display_page_lines=100
+    )
+
+    def info_text():
+        return "\n".join(w.text for w in controller.InfoText.list_walker)
+
+    controller.action_goto_next(None)
+    text = info_text()
+    assert "line 9\n" in text
+    assert "line 10\n" not in text
+    assert "line 995\n" in text
+    assert "press 'm' to show more" in text
+
+    controller.action_show_more(None)
+    text = info_text()
+    assert "line 109\n" in text
+    assert "line 110\n" not in text
+
+    for i in range(9):
+        controller.action_show_more(None)
+    text = info_text()
+    assert "".join(f"line {i}\n" for i in range(1000)) in text
+    assert "bytes not shown" not in text
+    assert "press 'm' to show more" not in text
@@ -1,5 +1,5 @@
 from pyassignmentgrader.handlers.python_function import *
-from pyassignmentgrader.utils import working_dir
+from pyassignmentgrader.utils import working_dir, execution_context, CheckFileExists, CheckFileContents, ShellCheck
 from .utils import setup_temporary_directory
 import pytest
 import os
@@ -334,3 +334,204 @@ def test_error_handling():
         match=r"Could not parse the function specification 'pyassignmentgrader.utils.hello_world\(\)': Expected.*char 36.*",
     ) as excinfo:
         handler = PythonFunctionHandler("pyassignmentgrader.utils.hello_world")
+
+
+def test_builtin_checks_use_execution_context(setup_temporary_directory):
+    with working_dir(setup_temporary_directory) as d:
+        pathlib.Path("student").mkdir()
+        pathlib.Path("student/tmp.txt").write_text("")
+
+        with execution_context("student"):
+            result = CheckFileExists(filename="tmp.txt", cwd=".")
+            assert result["result"] == True
+            result = ShellCheck(cmd="test -e tmp.txt")
+            assert result["result"] == True
+            result = CheckFileContents(filename="tmp.txt")
+            assert result["display"]["File Contents"] == ""
+
+        assert os.getcwd() == str(d)
+        result = CheckFileExists(filename="tmp.txt", cwd=".")
+        assert result["result"] == False
+
+
+def test_resolved_handler_cache(setup_temporary_directory):
+    from pyassignmentgrader.runner import resolve_handler, clear_handler_cache
+    from pyassignmentgrader.handlers.compiler import _function_cache
+
+    clear_handler_cache()
+    handler = resolve_handler("pyassignmentgrader.utils:hello_world()")
+    assert handler is resolve_handler("pyassignmentgrader.utils:hello_world()")
+    assert handler({}) == "Hello World"
+
+    # the function is only imported once, even if the arguments differ
+    with working_dir(setup_temporary_directory) as d:
+        pathlib.Path("tmp.txt").write_text("")
+        handler = resolve_handler('pyassignmentgrader.utils:CheckFileExists(filename=ctx["file"],cwd=".")')
+        assert handler({"ctx": {"file": "tmp.txt"}})["result"] == True
+        assert handler({"ctx": {"file": "tmp2.txt"}})["result"] == False
+        handler = resolve_handler('pyassignmentgrader.utils:CheckFileExists(filename="tmp.txt",cwd=".")')
+        assert handler({})["result"] == True
+    assert len([key for key in _function_cache if key[1] == "CheckFileExists"]) == 1
+
+    assert resolve_handler("pyassignmentgrader.utils:helloworld()") is None
+
+
+def test_compiled_call_plan():
+    from pyassignmentgrader.handlers.compiler import compile_handler, Argument, HandlerSpecError
+
+    plan = compile_handler(
+        'pyassignmentgrader.utils:CheckFileExists("tmp.txt", aliases=["a.txt"], cwd=ctx["dir"])'
+    )
+    assert plan.module_name == "pyassignmentgrader.utils"
+    assert plan.function_name == "CheckFileExists"
+    assert plan.args[0].kind == Argument.LITERAL
+    assert plan.kwargs[0][1].kind == Argument.LITERAL
+    assert plan.kwargs[1][1].kind == Argument.EXPRESSION
+
+    args, kwargs = plan.bind({"ctx": {"dir": "student"}})
+    assert args == ["tmp.txt"]
+    assert kwargs == {"aliases": ["a.txt"], "cwd": "student"}
+    # mutable literals are not shared between calls
+    kwargs["aliases"].append("b.txt")
+    assert plan.bind({"ctx": {"dir": "student"}})[1]["aliases"] == ["a.txt"]
+
+    plan = compile_handler("pyassignmentgrader.utils:CheckFileExists(ctx, *args, **kwargs)")
+    assert plan.args[0].kind == Argument.NAME
+    args, kwargs = plan.bind({"ctx": 1, "args": [2, 3], "kwargs": {"cwd": "."}})
+    assert args == [1, 2, 3]
+    assert kwargs == {"cwd": "."}
+    with pytest.raises(NameError):
+        plan.bind({})
+
+    # literals that can not be built are compiled as expressions
+    plan = compile_handler("pyassignmentgrader.utils:CheckFileExists({[1]})")
+    assert plan.args[0].kind == Argument.EXPRESSION
+    with pytest.raises(TypeError):
+        plan.bind({})
+
+    # without an argument list, parameters without defaults are looked up by name
+    plan = compile_handler("pyassignmentgrader.utils:CheckFileExists")
+    assert plan.bind({"filename": "tmp.txt", "cwd": "."}) == (["tmp.txt", "."], {})
+
+    with pytest.raises(HandlerSpecError):
+        compile_handler("pyassignmentgrader.utils:CheckFileExists(")
+    with pytest.raises(HandlerSpecError):
+        compile_handler("pyassignmentgrader.utils.CheckFileExists")
+    with pytest.raises(AttributeError):
+        compile_handler("pyassignmentgrader.utils:CheckFileExist()")
+
+
+def test_function_spec_parse_cache():
+    from pyassignmentgrader.handlers.python_function import parse_function_spec
+
+    parse_function_spec.cache_clear()
+    for i in range(3):
+        handler = PythonFunctionHandler("pyassignmentgrader.utils:hello_world()")
+        assert handler.module_name == "pyassignmentgrader.utils"
+        assert handler.function_name == "hello_world"
+    info = parse_function_spec.cache_info()
+    assert info.misses == 1
+    assert info.hits == 2
+
+    # parse errors are not cached
+    for i in range(2):
+        with pytest.raises(RuntimeError):
+            PythonFunctionHandler("pyassignmentgrader.utils.hello_world")
+    assert parse_function_spec.cache_info().currsize == 1
+
+
+def test_handler_worker_pool(setup_temporary_directory):
+    from pyassignmentgrader.worker_pool import HandlerWorkerPool
+    import subprocess
+
+    with working_dir(setup_temporary_directory) as d:
+        pathlib.Path("student").mkdir()
+        pathlib.Path("student/tmp.txt").write_text("")
+        pathlib.Path("PoolChecks.py").write_text(
+            """
+import os
+def Pid():
+    return {'result':True,'notes':[],'display':{'pid':os.getpid()}}
+def Crash():
+    os._exit(3)
+def Fail():
+    raise ValueError("bad check")
+def Sleep():
+    import time
+    time.sleep(10)
+"""
+        )
+        path = [str(d.absolute())] + sys.path
+        with HandlerWorkerPool(workers=1, preload=["PoolChecks"], max_tasks=2, path=path) as pool:
+            ret = pool.call(
+                'pyassignmentgrader.utils:CheckFileExists(filename=ctx["file"],cwd=".")',
+                {"ctx": {"file": "tmp.txt"}},
+                d / "student",
+            )
+            assert ret["result"] == True
+
+            # workers are replaced after max_tasks calls
+            pid1 = pool.call("PoolChecks:Pid()", {}, d)["display"]["pid"]
+            pid2 = pool.call("PoolChecks:Pid()", {}, d)["display"]["pid"]
+            pid3 = pool.call("PoolChecks:Pid()", {}, d)["display"]["pid"]
+            assert pid1 != os.getpid()
+            assert pid2 != pid1
+            assert pid3 == pid2
+
+            with pytest.raises(ValueError, match="bad check"):
+                pool.call("PoolChecks:Fail()", {}, d)
+            with pytest.raises(RuntimeError, match="died"):
+                pool.call("PoolChecks:Crash()", {}, d)
+            with pytest.raises(subprocess.TimeoutExpired):
+                pool.call("PoolChecks:Sleep()", {}, d, timeout=0.5)
+            # the pool still works after a worker was lost
+            assert pool.call("PoolChecks:Pid()", {}, d)["result"] == True
+            assert pool.started == 5
+
+
+def test_file_checks_share_directory_index(setup_temporary_directory):
+    from pyassignmentgrader.utils import CheckDirectoryExists, clear_directory_indexes, get_directory_index
+
+    with working_dir(setup_temporary_directory) as d:
+        pathlib.Path("src").mkdir()
+        pathlib.Path("src/Main.py").write_text("")
+        pathlib.Path("README.txt").write_text("")
+        pathlib.Path(".hidden").write_text("")
+        # directories modified within the last couple of seconds are always scanned again.
+        for path in [".", "src"]:
+            os.utime(path, ns=(0, 10**9))
+        clear_directory_indexes()
+
+        index = get_directory_index(".")
+        assert get_directory_index(d) is index
+        assert CheckFileExists(filename="README.txt", cwd=".")["result"] == True
+        assert CheckDirectoryExists(dirname="src", cwd=".")["result"] == True
+        assert CheckFileExists(filename="src/Main.py", cwd=".")["result"] == True
+        assert CheckFileExists(filename="src", cwd=".")["result"] == False
+        assert get_directory_index(d) is index
+
+        result = CheckFileExists(filename="main.py", cwd=".")
+        assert result["result"] == False
+        assert result["notes"][1] == "Found these files in '.':"
+        assert sorted(result["notes"][2:]) == ["  .hidden", "  README.txt", "  src"]
+
+        # new files are picked up
+        pathlib.Path("tmp.txt").write_text("")
+        assert CheckFileExists(filename="tmp.txt", cwd=".")["result"] == True
+        assert get_directory_index(d) is not index
+
+        result = CheckFileExists(filename="src/main.py", cwd=".", ignore_case=True)
+        assert result["result"] == True
+        assert result["notes"][1] == "Found 'src/Main.py' instead, creating a link to expected filename: 'src/main.py' -> 'src/Main.py'."
+
+        result = CheckFileExists(filename="main.py", cwd=".", ignore_case=True)
+        assert result["result"] == False
+        result = CheckFileExists(filename="main.py", cwd=".", ignore_case=True, recursive=True)
+        assert result["result"] == True
+        assert pathlib.Path("main.py").is_symlink()
+
+        result = CheckFileExists(filename="readme.md", cwd=".", fuzzy=True)
+        assert result["result"] == False
+        result = CheckFileExists(filename="READMEE.txt", cwd=".", fuzzy=True)
+        assert result["result"] == True
+        assert result["notes"][1].startswith("Found 'README.txt' instead")
@@ -2,6 +2,7 @@ from pyassignmentgrader.results import *
 from pyassignmentgrader.rubric import *
 from io import StringIO
 import pytest
+import yaml
 
 
 def test_loading_results_file():
@@ -194,6 +195,26 @@ jdoe:
 
     assert len(lines) > 0
     assert lines[0] == "Grading report for 'jdoe':"
+    score = lines[-1]
+
+    # checks changed since the last score are picked up
+    results.data["jdoe/checks/1/result"] = True
+    results.mark_changed(results.data["jdoe/checks/1"])
+    lines = results.summary()
+    assert lines[-1] == "Score: 100.00%"
+    assert lines[-1] != score
+
+    # so is a tree that was replaced
+    results.load(StringIO("""
+rshackleford:
+  checks:
+    - tag: Problem 1
+      weight: 1
+      result: False
+  score: 0
+"""))
+    lines = results.summary()
+    assert lines[0] == "Grading report for 'rshackleford':"
 
     # print()
     # print("\n".join(lines))
@@ -229,3 +250,391 @@ checks:
     with pytest.raises(RuntimeError) as e_info:
         results.add_student("jdoe",rubric)
 
+
+
+def test_results_journal(tmp_path):
+    results_file = tmp_path / "results.yml"
+    results_file.write_text('''
+jdoe:
+  checks:
+    - tag: Problem 1
+      result: null
+      notes: []
+    - tag: Problem 2
+      result: null
+      notes: []
+''')
+    original_text = results_file.read_text()
+
+    # without a journal, checkpoints do not rewrite the results file
+    results = GradingResults()
+    results.load(results_file)
+    results.data['jdoe/checks/0/result'] = True
+    results.mark_changed(results.data['jdoe/checks/0'])
+    results.checkpoint(results_file)
+    assert results_file.read_text() == original_text
+
+    results = GradingResults()
+    results.load(results_file)
+    results.open_journal(results_file, compact_every=2)
+
+    results.data['jdoe/checks/1/result'] = True
+    results.data['jdoe/checks/1/notes'] = ['Looks good']
+    results.mark_changed(results.data['jdoe/checks/1'])
+    results.save(results_file)
+
+    journal_file = ResultsJournal.path_for(results_file)
+    assert results_file.read_text() == original_text
+    assert journal_file.exists()
+    assert len(journal_file.read_text().splitlines()) == 1
+
+    # the journal is replayed when the results are loaded.
+    loaded = GradingResults()
+    loaded.load(results_file)
+    assert loaded.data['jdoe/checks/0/result'] is None
+    assert loaded.data['jdoe/checks/1/result'] is True
+    assert loaded.data['jdoe/checks/1/notes'].tree == ['Looks good']
+
+    # an incomplete record is ignored
+    with journal_file.open('a') as f:
+        f.write('{"path": "/jdoe/checks/0", "resu')
+    loaded = GradingResults()
+    loaded.load(results_file)
+    assert loaded.data['jdoe/checks/0/result'] is None
+
+    # the journal is compacted into the results file once it is large enough.
+    results.data['jdoe/checks/0/result'] = False
+    results.mark_changed(results.data['jdoe/checks/0'])
+    results.save(results_file)
+    assert not journal_file.exists()
+
+    loaded = GradingResults()
+    loaded.load(results_file)
+    assert loaded.data['jdoe/checks/0/result'] is False
+    assert loaded.data['jdoe/checks/1/result'] is True
+
+
+def test_check_table():
+    results = GradingResults()
+    file = StringIO('''
+jdoe:
+  checks:
+    - tag: Problem 1
+      weight: 1
+      result: True
+    - tag: Problem 2
+      weight: 2
+      result: False
+      secondary_checks:
+        weight: 0.8
+        checks:
+            - result : True
+              weight : 2
+            - result:  NULL
+              weight : 1
+rshackleford:
+  checks:
+    - tag: Problem 1
+      weight: 1
+      result: 0.5
+    - tag: Problem 2
+      weight: 2
+      result: True
+      secondary_checks:
+        weight: 0.8
+        checks:
+            - result : NULL
+              weight : 2
+    ''')
+    results.load(file)
+    table = results.compile()
+
+    assert table.students == ['jdoe', 'rshackleford']
+    assert len(table) == 7
+    assert table.paths[2] == '/jdoe/checks/1/secondary_checks/checks/0'
+    assert list(table.parent) == [-1, -1, 1, 1, -1, -1, 5]
+    assert list(table.student) == [0, 0, 0, 0, 1, 1, 1]
+    assert table.get_result(0) is True
+    assert table.get_result(3) is None
+    assert table.get_result(4) == 0.5
+
+    warnings, errors = results.score()
+    # the secondary checks for rshackleford were not used, so they do not give a warning
+    assert len(warnings) == 1
+    assert "jdoe" in warnings[0]
+    assert results.data["jdoe/available"] == 3
+    assert results.data["jdoe/awarded"] == pytest.approx(1 + 2*0.8*2/3)
+    assert results.data["rshackleford/available"] == 3
+    assert results.data["rshackleford/awarded"] == 2.5
+
+
+def test_scoring_errors():
+    results = GradingResults()
+    file = StringIO('''
+jdoe:
+  checks:
+    - tag: Problem 1
+      result: False
+      secondary_checks:
+        checks:
+            - result : True
+    ''')
+    results.load(file)
+    with pytest.raises(RuntimeError, match="no weight"):
+        results.score()
+
+    results = GradingResults()
+    file = StringIO('''
+jdoe:
+  checks:
+    - tag: Problem 1
+    ''')
+    results.load(file)
+    with pytest.raises(RuntimeError, match="does not contain a result"):
+        results.score()
+
+
+def test_incremental_rescore():
+    results = GradingResults()
+    results.data = ft.fspathtree({
+        "jdoe": {"checks": [
+            {"tag": "P1", "weight": 1, "result": True},
+            {"tag": "P2", "weight": 2, "result": True, "secondary_checks": {
+                "weight": 0.5,
+                "checks": [{"weight": 1, "result": True}, {"weight": 1, "result": False}],
+            }},
+        ]},
+        "rshackleford": {"checks": [
+            {"tag": "P1", "weight": 1, "result": False},
+        ]},
+    })
+    results.score()
+    assert results.data["jdoe/awarded"] == 3
+    assert results.data["rshackleford/awarded"] == 0
+
+    # a check that is not marked as changed is not picked up
+    results.data["rshackleford/checks/0/result"] = True
+    results.data["jdoe/checks/1/result"] = False
+    results.mark_changed(results.data["jdoe/checks/1"])
+    assert results.dirty == {"/jdoe/checks/1"}
+    results.rescore()
+    assert results.dirty == set()
+    assert results.data["jdoe/awarded"] == pytest.approx(1 + 2*0.5*0.5)
+    assert results.data["rshackleford/awarded"] == 0
+
+    results.data["jdoe/checks/1/secondary_checks/checks/1/result"] = True
+    results.mark_changed(results.data["jdoe/checks/1/secondary_checks/checks/1"])
+    results.mark_changed(results.data["rshackleford/checks/0"])
+    results.rescore()
+    assert results.data["jdoe/awarded"] == 2
+    assert results.data["rshackleford/awarded"] == 1
+
+    # new checks are handled by scoring everything again
+    results.data["jdoe/checks/2"] = {"tag": "P3", "weight": 1, "result": True}
+    results.mark_changed(results.data["jdoe/checks/2"])
+    results.rescore()
+    assert results.data["jdoe/available"] == 4
+    assert results.data["jdoe/awarded"] == 3
+
+
+def test_numpy_scoring_engine():
+    pytest.importorskip("numpy")
+    import random
+    rng = random.Random(1)
+
+    def make_checks(depth):
+        checks = []
+        for i in range(rng.randint(1, 5)):
+            check = {
+                "weight": rng.choice([1, 2, 0.5, 1.5]),
+                "result": rng.choice([True, False, False, None, 0, 1, 0.25]),
+            }
+            if depth < 2 and rng.random() < 0.5:
+                check["secondary_checks"] = {
+                    "weight": rng.choice([1, 0.5]),
+                    "checks": make_checks(depth + 1),
+                }
+            checks.append(check)
+        return checks
+
+    data = {f"student{i}": {"checks": make_checks(0)} for i in range(200)}
+    table = CheckTable.compile(ft.fspathtree(data))
+    expected = table.score("python")
+    actual = table.score("numpy")
+    assert actual == expected
+    assert [type(a) for a in actual[0] + actual[1]] == [type(a) for a in expected[0] + expected[1]]
+
+    results = GradingResults()
+    results.data = ft.fspathtree({"jdoe": {"checks": [{"result": False, "secondary_checks": {"checks": [{"result": True}]}}]}})
+    with pytest.raises(RuntimeError, match="no weight"):
+        results.score(engine="numpy")
+    results.data = ft.fspathtree({"jdoe": {"checks": [{"result": True}, {"tag": "Problem 2"}]}})
+    with pytest.raises(RuntimeError, match="does not contain a result"):
+        results.score(engine="numpy")
+    with pytest.raises(ValueError, match="Unknown scoring engine"):
+        results.score(engine="fortran")
+
+
+def test_streaming_summary(tmp_path):
+    results_file = tmp_path / "results.yml"
+    results_file.write_text('''
+jdoe:
+  checks:
+    - tag: Problem 1
+      desc: First
+      weight: 2
+      result: true
+      notes: []
+    - tag: Problem 2
+      desc: Second
+      weight: 1
+      result: false
+      notes: [Missing]
+      secondary_checks:
+        weight: 0.5
+        checks:
+          - tag: Problem 2.1
+            weight: 1
+            result: true
+            notes: []
+rshackleford:
+  checks:
+    - tag: Problem 1
+      desc: First
+      weight: 2
+      result: false
+      notes: []
+    - tag: Problem 2
+      desc: Second
+      weight: 1
+      result: null
+      notes: []
+''')
+    results = GradingResults()
+    results.load(results_file)
+    warnings, errors = results.score()
+    expected = results.summary()
+
+    streamed = []
+    streamed_warnings = []
+    for w, e, lines in GradingResults.iter_summary(results_file):
+        streamed_warnings += w
+        streamed += lines
+    assert streamed == expected
+    assert streamed_warnings == warnings
+
+    # one document per student
+    documents = [yaml.safe_dump({name: results.data[name].tree}) for name in results.data.tree]
+    results_file.write_text("---\n".join(documents))
+    streamed = [line for w, e, lines in GradingResults.iter_summary(results_file) for line in lines]
+    assert streamed == expected
+
+    # the journal is applied to each student as it is read
+    results.open_journal(results_file)
+    results.data['rshackleford/checks/0/result'] = True
+    results.mark_changed(results.data['rshackleford/checks/0'])
+    results.save(results_file)
+    names = [name for name, tree in GradingResults.iter_students(results_file)]
+    assert names == ["jdoe", "rshackleford"]
+    tree = dict(GradingResults.iter_students(results_file))["rshackleford"]
+    assert tree["checks"][0]["result"] is True
+
+
+def test_sharded_results(tmp_path):
+    results_file = tmp_path / "results.yml"
+    results_file.write_text('''
+jdoe:
+  checks:
+    - tag: Problem 1
+      weight: 1
+      result: true
+      notes: []
+rshackleford:
+  checks:
+    - tag: Problem 1
+      weight: 1
+      result: null
+      notes: []
+''')
+    results = GradingResults()
+    results.load(results_file)
+    expected = results.data.tree.copy()
+    results.use_shards(results_file)
+    results.dump(results_file)
+
+    manifest = yaml.safe_load(results_file.read_text())
+    assert manifest == {"results_shards": {
+        "jdoe": "results.yml.shards/jdoe.yml",
+        "rshackleford": "results.yml.shards/rshackleford.yml",
+    }}
+    jdoe_shard = tmp_path / "results.yml.shards/jdoe.yml"
+    rshackleford_shard = tmp_path / "results.yml.shards/rshackleford.yml"
+    assert yaml.safe_load(jdoe_shard.read_text()) == {"jdoe": expected["jdoe"]}
+
+    # shards are only loaded when they are accessed
+    loaded = GradingResults()
+    loaded.load(results_file)
+    shards = loaded.data.tree
+    assert list(shards) == ["jdoe", "rshackleford"]
+    assert not shards.is_loaded("jdoe")
+    assert loaded.data['jdoe/checks/0/result'] is True
+    assert shards.is_loaded("jdoe")
+    assert not shards.is_loaded("rshackleford")
+
+    # only changed shards are written
+    mtimes = {shard: shard.stat().st_mtime_ns for shard in (jdoe_shard, rshackleford_shard)}
+    loaded.dump(results_file)
+    assert jdoe_shard.stat().st_mtime_ns == mtimes[jdoe_shard]
+    loaded.data['jdoe/checks/0/result'] = False
+    loaded.dump(results_file)
+    assert yaml.safe_load(jdoe_shard.read_text())["jdoe"]["checks"][0]["result"] is False
+    assert rshackleford_shard.stat().st_mtime_ns == mtimes[rshackleford_shard]
+
+    # journal records are applied when a shard is loaded, and written out when the journal is compacted.
+    results.load(results_file)
+    results.open_journal(results_file)
+    results.data['rshackleford/checks/0/result'] = False
+    results.mark_changed(results.data['rshackleford/checks/0'])
+    results.save(results_file)
+    loaded = GradingResults()
+    loaded.load(results_file)
+    assert loaded.data['rshackleford/checks/0/result'] is False
+    assert loaded.data.tree.journal_records == {}
+    loaded = GradingResults()
+    loaded.load(results_file)
+    loaded.compact(results_file)
+    assert not ResultsJournal.path_for(results_file).exists()
+    assert yaml.safe_load(rshackleford_shard.read_text())["rshackleford"]["checks"][0]["result"] is False
+
+    names = [name for name, tree in GradingResults.iter_students(results_file)]
+    assert names == ["jdoe", "rshackleford"]
+    loaded.score()
+    streamed = [line for w, e, lines in GradingResults.iter_summary(results_file) for line in lines]
+    assert streamed == loaded.summary()
+
+    # dumping to a stream writes the plain layout
+    text = StringIO()
+    loaded.dump(text)
+    assert list(yaml.safe_load(text.getvalue())) == ["jdoe", "rshackleford"]
+
+
+def test_result_cache_keys(tmp_path):
+    (tmp_path / "src/lib").mkdir(parents=True)
+    (tmp_path / "src/main.py").write_text("main")
+    (tmp_path / "src/lib/util.py").write_text("util")
+    (tmp_path / "README").write_text("readme")
+
+    cache = ResultCache()
+    everything = [tmp_path / "README", tmp_path / "src/lib/util.py", tmp_path / "src/main.py"]
+    assert cache.input_files(tmp_path) == everything
+    assert cache.input_files(tmp_path, ["**/*"]) == everything
+    assert cache.input_files(tmp_path, ["src"]) == everything[1:]
+
+    check = {"handler": "true"}
+    key = cache.key_for(check, "true", tmp_path)
+    assert cache.key_for(dict(check), "true", tmp_path) == key
+    # the limits are part of the key
+    assert cache.key_for(dict(check, timeout=1), "true", tmp_path) != key
+    assert cache.key_for(dict(check, output_limit=100), "true", tmp_path) != key
+    (tmp_path / "src/lib/util.py").write_text("changed")
+    assert cache.key_for(check, "true", tmp_path) != key
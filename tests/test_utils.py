@@ -4,6 +4,9 @@ from pathlib import Path
 import pytest
 import fspathtree
 import yaml
+import resource
+import subprocess
+import time
 
 def test_dirstack(setup_temporary_directory):
     with working_dir(setup_temporary_directory) as d:
@@ -82,6 +85,36 @@ def test_working_directory_for_nodes(setup_temporary_directory):
         assert get_working_directory_for_node(config['/jdoe/checks/']) == "dir1/jdoe"
         assert get_working_directory_for_node(config['/jdoe']) == "dir1/jdoe"
 
+def test_working_directory_map():
+    config = fspathtree.fspathtree()
+    config['/working_directory'] = 'dir1'
+    config['/jdoe/working_directory'] = 'jdoe'
+    config['/jdoe/checks/0/working_directory'] = 'dir2'
+    config['/jdoe/checks/0/result'] = True
+    config['/jdoe/checks/0/secondary_checks/working_directory'] = 'extra'
+    config['/jdoe/checks/0/secondary_checks/checks/0/working_directory'] = 'dir3'
+    config['/jdoe/checks/1/result'] = True
+    config['/rshack/checks/0/result'] = True
+
+    wds = WorkingDirectoryMap(config)
+    for path in ['/jdoe', '/jdoe/checks', '/jdoe/checks/0', '/jdoe/checks/1',
+                 '/jdoe/checks/0/secondary_checks/checks/0', '/rshack/checks/0']:
+        assert wds.get(path) == get_working_directory_for_node(config[path])
+    assert wds.get('/jdoe/checks/0/secondary_checks/checks/0') == "dir1/jdoe/dir2/extra/dir3"
+    assert wds.get('/jdoe/checks/0/secondary_checks/checks/0', start='/jdoe') == "dir2/extra/dir3"
+    assert wds.get('/jdoe', start='/') == "jdoe"
+    # the map is built one student at a time
+    assert list(wds.nodes) == ['jdoe', 'rshack']
+
+    config['/jdoe/checks/1/working_directory'] = 'dir4'
+    wds.update(config['/jdoe/checks/1'])
+    assert 'jdoe' not in wds.nodes
+    assert wds.get('/jdoe/checks/1') == "dir1/jdoe/dir4"
+    config['/working_directory'] = 'dir5'
+    wds.update(config['/'])
+    assert wds.get('/rshack/checks/0') == "dir5"
+
+
 def test_context_object_for_nodes():
     pass
     txt = '''
@@ -134,3 +167,236 @@ jdoe:
     render_tree(config)
 
     assert config['/jdoe/checks/0/desc'] == "Checking for file file-1.txt in jdoe (1234) homework directory."
+
+
+def test_tree_rendering_matches_per_leaf_contexts():
+    txt = '''
+context:
+  course: PHYS 1100
+jdoe:
+    checks:
+      - desc: "{course}: {file} for {username}"
+        notes: ["{directory}", "{{literal}}", 3]
+        context:
+          file: file-1.txt
+          directory: "{username}-{student_id}.d"
+      - desc: "{username} has no check context"
+    context:
+      username: jdoe
+      student_id: 1234
+      label: "{course} homework"
+    summary: "{label}"
+'''
+    def render_per_leaf(tree):
+        for key in tree.get_all_leaf_node_paths():
+            ctx = get_context_for_node(tree[key.parts[:-1]])
+            if isinstance(tree[key], str):
+                tree[key] = tree[key].format(**ctx)
+
+    expected = fspathtree.fspathtree(yaml.safe_load(txt))
+    render_per_leaf(expected)
+    config = fspathtree.fspathtree(yaml.safe_load(txt))
+    render_tree(config)
+    assert config.tree == expected.tree
+    assert config['/jdoe/checks/0/desc'] == "PHYS 1100: file-1.txt for jdoe"
+    assert config['/jdoe/checks/0/notes/0'] == "jdoe-1234.d"
+
+    # a branch is rendered with the context of the nodes above it
+    config = fspathtree.fspathtree(yaml.safe_load(txt))
+    render_tree(config['/jdoe/checks'])
+    assert config['/jdoe/checks/1/desc'] == "jdoe has no check context"
+
+
+def test_execution_context(setup_temporary_directory):
+    with working_dir(setup_temporary_directory) as d:
+        Path("level-1.d/level-2.d").mkdir(parents=True)
+        cwd = Path().absolute()
+
+        assert get_execution_context().path == cwd
+
+        with execution_context('level-1.d') as ctx:
+            assert os.getcwd() == str(cwd)
+            assert ctx.path == cwd/'level-1.d'
+            assert get_execution_context() == ctx
+            assert resolve_path('file.txt') == cwd/'level-1.d/file.txt'
+
+            with execution_context('level-2.d') as ctx2:
+                assert os.getcwd() == str(cwd)
+                assert ctx2.path == cwd/'level-1.d/level-2.d'
+                assert os.fspath(ctx2) == str(cwd/'level-1.d/level-2.d')
+
+            assert get_execution_context() == ctx
+
+        assert get_execution_context().path == cwd
+
+
+def test_execution_context_is_per_thread(setup_temporary_directory):
+    import threading
+    with working_dir(setup_temporary_directory) as d:
+        cwd = Path().absolute()
+        seen = {}
+        def worker(name):
+            with execution_context(name):
+                barrier.wait()
+                seen[name] = get_execution_context().path
+
+        barrier = threading.Barrier(2)
+        threads = [threading.Thread(target=worker,args=(name,)) for name in ['a','b']]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert seen['a'] == cwd/'a'
+        assert seen['b'] == cwd/'b'
+
+
+def test_yaml_helpers():
+    data = {'jdoe': {'checks': [{'tag': 'P1', 'result': None, 'weight': 0.5, 'notes': ['a: b', '']}]}}
+    text = dump_yaml(data, sort_keys=False)
+    assert text.startswith("jdoe:")
+    assert load_yaml(text) == data
+    assert load_yaml(text) == yaml.safe_load(text)
+
+
+def test_output_capture(setup_temporary_directory):
+    capture = OutputCapture(limit=10)
+    capture.feed(b"hello")
+    capture.close()
+    assert not capture.truncated
+    assert capture.text() == "hello"
+
+    log_file = setup_temporary_directory / "logs/output.log"
+    capture = OutputCapture(limit=10, log_file=log_file)
+    for i in range(100):
+        capture.feed(f"{i:03}\n".encode("utf-8"))
+    capture.close()
+    assert capture.truncated
+    assert capture.size == 400
+    text = capture.text()
+    assert text.startswith("000\n0")
+    assert text.endswith("\n099\n")
+    assert "390 bytes of output omitted" in text
+    assert str(log_file) in text
+    assert log_file.read_text() == "".join(f"{i:03}\n" for i in range(100))
+
+    # the log file is only kept if the output did not fit
+    log_file = setup_temporary_directory / "logs/short.log"
+    returncode, capture = run_command("echo hello", limit=10, log_file=log_file)
+    assert returncode == 0
+    assert capture.text() == "hello\n"
+    assert not log_file.exists()
+
+    returncode, capture = run_command("seq 1 100000; exit 2", limit=100, log_file=log_file)
+    assert returncode == 2
+    assert len(capture.text()) < 300
+    assert capture.text().endswith("100000\n")
+    assert log_file.stat().st_size == capture.size
+
+    # no log file is left behind if the command could not be started
+    log_file = setup_temporary_directory / "logs/missing.log"
+    with pytest.raises(OSError):
+        run_command("echo hello", cwd=setup_temporary_directory / "missing", log_file=log_file)
+    assert not log_file.exists()
+
+    result = ShellCheck("seq 1 100000", output_limit=100)
+    assert result["result"] == True
+    assert len(result["notes"]) < 50
+
+
+def test_resource_limits():
+    assert parse_size(100) == 100
+    assert parse_size("2K") == 2048
+    assert parse_size("512M") == 512 * 1024**2
+    assert parse_size("1GB") == 1024**3
+    assert get_resource_limits({"timeout": 2, "max_memory": "1K"}) == {
+        "timeout": 2,
+        "max_memory": 1024,
+        "max_cpu_seconds": None,
+    }
+
+    start = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired) as e:
+        run_command("echo start; sleep 10 & sleep 10; wait", timeout=0.5)
+    assert time.monotonic() - start < 5
+    assert e.value.output.text() == "start\n"
+
+    returncode, capture = run_command("while true; do :; done", max_cpu_seconds=1)
+    assert killed_by_resource_limit(returncode)
+
+    # the limits are set by the shell, the command itself is run unchanged.
+    returncode, capture = run_command("ulimit -v; ulimit -S -t; ulimit -H -t; echo 'it''s' \"$0\"", max_memory=64 * 1024**2, max_cpu_seconds=2)
+    assert returncode == 0
+    assert capture.text() == "65536\n2\n3\nits /bin/sh\n"
+
+    import asyncio
+    from pyassignmentgrader.async_runner import run_command_async
+    returncode, capture = asyncio.run(run_command_async("while true; do :; done", max_cpu_seconds=1))
+    assert killed_by_resource_limit(returncode)
+
+    assert call_with_limits(lambda: {"result": True}, timeout=5) == {"result": True}
+
+    def fail():
+        raise ValueError("bad check")
+
+    with pytest.raises(ValueError, match="bad check"):
+        call_with_limits(fail)
+
+    def loop():
+        while True:
+            pass
+
+    start = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired):
+        call_with_limits(loop, timeout=0.5)
+    assert time.monotonic() - start < 5
+    with pytest.raises(ResourceLimitError):
+        call_with_limits(loop, max_cpu_seconds=1)
+
+    def allocate():
+        return len(bytearray(512 * 1024**2))
+
+    # the limit is on the total address space, which includes what the test process already uses.
+    in_use = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    if Path("/proc/self/statm").exists():
+        in_use = int(Path("/proc/self/statm").read_text().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    with pytest.raises(MemoryError):
+        call_with_limits(allocate, max_memory=in_use + 256 * 1024**2)
+
+
+def test_file_preview(tmp_path):
+    from pyassignmentgrader.utils import preview_file
+    import pickle
+
+    lines = [f"line {i}\n" for i in range(100)]
+    path = tmp_path / "data.txt"
+    path.write_text("".join(lines))
+
+    preview = preview_file(path, head_lines=3, tail_lines=2)
+    assert preview.startswith("line 0\nline 1\nline 2\n... ")
+    assert preview.endswith("line 98\nline 99\n")
+    assert preview.omitted == len("".join(lines[3:98]))
+
+    text, offset = preview.page(lines=10)
+    assert text == "".join(lines[3:13])
+    text, offset = preview.page(offset, lines=1000)
+    assert text == "".join(lines[13:98])
+    assert preview.render("".join(lines[3:98]), offset) == "".join(lines)
+
+    # previews are handed back from worker processes
+    assert pickle.loads(pickle.dumps(preview)).page(offset=None, lines=1)[0] == "line 3\n"
+
+    # small files are shown in full
+    assert preview_file(path) == "".join(lines)
+
+    # the head and tail are limited in size, even for a single long line
+    path.write_text("x" * 100000)
+    preview = preview_file(path, max_bytes=1000)
+    assert preview.startswith("x" * 1000 + "\n... 98000 bytes not shown ...\n")
+    assert len(preview) < 3000
+
+    path.write_bytes(b"\x00\x01" * 100)
+    assert preview_file(path) == "Binary file (200 bytes)."
+
+    path.write_text("")
+    assert preview_file(path) == ""